@@ -0,0 +1,246 @@
+#!/home/dh_kfekwx/bin/python3
+
+# Address normalization shared by the ATTOM and geocode cache keys, saved-coordinate lookups and the
+# valuator_data.address_key column used to find files for the same property.
+#
+# Addresses arrive from Google Places autocomplete, manual entry, ATTOM address1/address2 and Nominatim queries.
+# They are reduced to one spelling: upper case, no punctuation, single spaces, USPS Publication 28 street suffix,
+# directional and secondary unit abbreviations, and the unit split from the street:
+#
+#   "4529 North Winona Court, Apt. #2B"  ->  street "4529 N WINONA CT", unit "APT 2B"
+#
+# Suffixes and directionals are only abbreviated where they act as one, so "123 North St", "500 Court Street"
+# and "1 Avenue of the Americas" keep the words that are the street's name.
+
+import re
+
+# USPS Publication 28, Appendix C1: standard suffix abbreviation -> every spelling it replaces.
+# TRAILER is left out because TRLR is also a unit designator.
+_SUFFIX_SPELLINGS = {
+    'ALY': 'ALLEE ALLEY ALLY', 'ANX': 'ANEX ANNEX ANNX', 'ARC': 'ARCADE', 'AVE': 'AV AVEN AVENU AVENUE AVN AVNUE',
+    'BYU': 'BAYOO BAYOU', 'BCH': 'BEACH', 'BND': 'BEND', 'BLF': 'BLUF BLUFF', 'BLFS': 'BLUFFS',
+    'BTM': 'BOT BOTTM BOTTOM', 'BLVD': 'BOUL BOULEVARD BOULV', 'BR': 'BRNCH BRANCH', 'BRG': 'BRDGE BRIDGE',
+    'BRK': 'BROOK', 'BRKS': 'BROOKS', 'BG': 'BURG', 'BGS': 'BURGS', 'BYP': 'BYPA BYPAS BYPASS BYPS',
+    'CP': 'CAMP CMP', 'CYN': 'CANYN CANYON CNYN', 'CPE': 'CAPE', 'CSWY': 'CAUSEWAY CAUSWA',
+    'CTR': 'CEN CENT CENTER CENTR CENTRE CNTER CNTR', 'CTRS': 'CENTERS', 'CIR': 'CIRC CIRCL CIRCLE CRCL CRCLE',
+    'CIRS': 'CIRCLES', 'CLF': 'CLIFF', 'CLFS': 'CLIFFS', 'CLB': 'CLUB', 'CMN': 'COMMON', 'CMNS': 'COMMONS',
+    'COR': 'CORNER', 'CORS': 'CORNERS', 'CRSE': 'COURSE', 'CT': 'COURT', 'CTS': 'COURTS', 'CV': 'COVE',
+    'CVS': 'COVES', 'CRK': 'CREEK', 'CRES': 'CRESCENT CRSENT CRSNT', 'CRST': 'CREST', 'XING': 'CROSSING CRSSNG',
+    'XRD': 'CROSSROAD', 'XRDS': 'CROSSROADS', 'CURV': 'CURVE', 'DL': 'DALE', 'DM': 'DAM', 'DV': 'DIV DIVIDE DVD',
+    'DR': 'DRIV DRIVE DRV', 'DRS': 'DRIVES', 'EST': 'ESTATE', 'ESTS': 'ESTATES',
+    'EXPY': 'EXP EXPR EXPRESS EXPRESSWAY EXPW', 'EXT': 'EXTENSION EXTN EXTNSN', 'EXTS': 'EXTENSIONS',
+    'FALL': '', 'FLS': 'FALLS', 'FRY': 'FERRY FRRY', 'FLD': 'FIELD', 'FLDS': 'FIELDS', 'FLT': 'FLAT',
+    'FLTS': 'FLATS', 'FRD': 'FORD', 'FRDS': 'FORDS', 'FRST': 'FOREST FORESTS', 'FRG': 'FORG FORGE',
+    'FRGS': 'FORGES', 'FRK': 'FORK', 'FRKS': 'FORKS', 'FT': 'FORT FRT', 'FWY': 'FREEWAY FREEWY FRWAY FRWY',
+    'GDN': 'GARDEN GARDN GRDEN GRDN', 'GDNS': 'GARDENS GRDNS', 'GTWY': 'GATEWAY GATEWY GATWAY GTWAY',
+    'GLN': 'GLEN', 'GLNS': 'GLENS', 'GRN': 'GREEN', 'GRNS': 'GREENS', 'GRV': 'GROV GROVE', 'GRVS': 'GROVES',
+    'HBR': 'HARB HARBOR HARBR HRBOR', 'HBRS': 'HARBORS', 'HVN': 'HAVEN', 'HTS': 'HT HEIGHTS',
+    'HWY': 'HIGHWAY HIGHWY HIWAY HIWY HWAY', 'HL': 'HILL', 'HLS': 'HILLS', 'HOLW': 'HLLW HOLLOW HOLLOWS HOLWS',
+    'INLT': 'INLET', 'IS': 'ISLAND ISLND', 'ISS': 'ISLANDS ISLNDS', 'ISLE': 'ISLES',
+    'JCT': 'JCTION JCTN JUNCTION JUNCTN JUNCTON', 'JCTS': 'JCTNS JUNCTIONS', 'KY': 'KEY', 'KYS': 'KEYS',
+    'KNL': 'KNOL KNOLL', 'KNLS': 'KNOLLS', 'LK': 'LAKE', 'LKS': 'LAKES', 'LAND': '', 'LNDG': 'LANDING LNDNG',
+    'LN': 'LANE', 'LGT': 'LIGHT', 'LGTS': 'LIGHTS', 'LF': 'LOAF', 'LCK': 'LOCK', 'LCKS': 'LOCKS',
+    'LDG': 'LDGE LODG LODGE', 'LOOP': 'LOOPS', 'MALL': '', 'MNR': 'MANOR', 'MNRS': 'MANORS', 'MDW': 'MEADOW',
+    'MDWS': 'MEADOWS MEDOWS', 'MEWS': '', 'ML': 'MILL', 'MLS': 'MILLS', 'MSN': 'MISSN MSSN MISSION',
+    'MTWY': 'MOTORWAY', 'MT': 'MNT MOUNT', 'MTN': 'MNTAIN MNTN MOUNTAIN MOUNTIN MTIN', 'MTNS': 'MNTNS MOUNTAINS',
+    'NCK': 'NECK', 'ORCH': 'ORCHARD ORCHRD', 'OVAL': 'OVL', 'OPAS': 'OVERPASS', 'PARK': 'PRK PARKS',
+    'PKWY': 'PARKWAY PARKWY PKWAY PKY PARKWAYS PKWYS', 'PASS': '', 'PSGE': 'PASSAGE', 'PATH': 'PATHS',
+    'PIKE': 'PIKES', 'PNE': 'PINE', 'PNES': 'PINES', 'PL': 'PLACE', 'PLN': 'PLAIN', 'PLNS': 'PLAINS',
+    'PLZ': 'PLAZA PLZA', 'PT': 'POINT', 'PTS': 'POINTS', 'PRT': 'PORT', 'PRTS': 'PORTS', 'PR': 'PRAIRIE PRR',
+    'RADL': 'RAD RADIAL RADIEL', 'RAMP': '', 'RNCH': 'RANCH RANCHES RNCHS', 'RPD': 'RAPID', 'RPDS': 'RAPIDS',
+    'RST': 'REST', 'RDG': 'RDGE RIDGE', 'RDGS': 'RIDGES', 'RIV': 'RIVER RVR RIVR', 'RD': 'ROAD', 'RDS': 'ROADS',
+    'RTE': 'ROUTE', 'ROW': '', 'RUE': '', 'RUN': '', 'SHL': 'SHOAL', 'SHLS': 'SHOALS', 'SHR': 'SHOAR SHORE',
+    'SHRS': 'SHOARS SHORES', 'SKWY': 'SKYWAY', 'SPG': 'SPNG SPRING SPRNG', 'SPGS': 'SPNGS SPRINGS SPRNGS',
+    'SPUR': 'SPURS', 'SQ': 'SQR SQRE SQU SQUARE', 'SQS': 'SQRS SQUARES', 'STA': 'STATION STATN STN',
+    'STRA': 'STRAV STRAVEN STRAVENUE STRAVN STRVN STRVNUE', 'STRM': 'STREAM STREME', 'ST': 'STREET STRT STR',
+    'STS': 'STREETS', 'SMT': 'SUMIT SUMITT SUMMIT', 'TER': 'TERR TERRACE', 'TRWY': 'THROUGHWAY',
+    'TRCE': 'TRACE TRACES', 'TRAK': 'TRACK TRACKS TRK TRKS', 'TRFY': 'TRAFFICWAY', 'TRL': 'TRAIL TRAILS TRLS',
+    'TUNL': 'TUNEL TUNLS TUNNEL TUNNELS TUNNL', 'TPKE': 'TRNPK TURNPIKE TURNPK', 'UPAS': 'UNDERPASS',
+    'UN': 'UNION', 'UNS': 'UNIONS', 'VLY': 'VALLEY VALLY VLLY', 'VLYS': 'VALLEYS', 'VIA': 'VDCT VIADCT VIADUCT',
+    'VW': 'VIEW', 'VWS': 'VIEWS', 'VLG': 'VILL VILLAG VILLAGE VILLG VILLIAGE', 'VLGS': 'VILLAGES', 'VL': 'VILLE',
+    'VIS': 'VIST VISTA VST VSTA', 'WALK': 'WALKS', 'WALL': '', 'WAY': 'WY', 'WAYS': '', 'WL': 'WELL', 'WLS': 'WELLS',
+}
+STREET_SUFFIXES = {spelling: standard for standard, spellings in _SUFFIX_SPELLINGS.items()
+                   for spelling in [standard, *spellings.split()]}
+
+DIRECTIONALS = {
+    'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W',
+    'NORTHEAST': 'NE', 'NORTHWEST': 'NW', 'SOUTHEAST': 'SE', 'SOUTHWEST': 'SW',
+    **{d: d for d in ('N', 'S', 'E', 'W', 'NE', 'NW', 'SE', 'SW')},
+}
+
+# USPS Publication 28, Appendix C2: secondary unit designators that take a number ("APT 2B") ...
+NUMBERED_UNITS = {
+    'APARTMENT': 'APT', 'APT': 'APT', 'BUILDING': 'BLDG', 'BLDG': 'BLDG', 'DEPARTMENT': 'DEPT', 'DEPT': 'DEPT',
+    'FLOOR': 'FL', 'FL': 'FL', 'HANGAR': 'HNGR', 'HNGR': 'HNGR', 'KEY': 'KEY', 'LOT': 'LOT', 'PIER': 'PIER',
+    'ROOM': 'RM', 'RM': 'RM', 'SLIP': 'SLIP', 'SPACE': 'SPC', 'SPC': 'SPC', 'STOP': 'STOP', 'SUITE': 'STE',
+    'STE': 'STE', 'TRAILER': 'TRLR', 'TRLR': 'TRLR', 'UNIT': 'UNIT', '#': '#',
+}
+# ... and those that stand alone at the end of the line ("REAR")
+BARE_UNITS = {
+    'BASEMENT': 'BSMT', 'BSMT': 'BSMT', 'FRONT': 'FRNT', 'FRNT': 'FRNT', 'LOBBY': 'LBBY', 'LBBY': 'LBBY',
+    'LOWER': 'LOWR', 'LOWR': 'LOWR', 'OFFICE': 'OFC', 'OFC': 'OFC', 'PENTHOUSE': 'PH', 'PH': 'PH',
+    'REAR': 'REAR', 'SIDE': 'SIDE', 'UPPER': 'UPPR', 'UPPR': 'UPPR',
+}
+_UNIT_WORDS = frozenset(NUMBERED_UNITS) | frozenset(BARE_UNITS)
+_COUNTRY_NAMES = frozenset(['USA', 'US', 'UNITED STATES', 'UNITED STATES OF AMERICA'])
+
+# Periods and apostrophes join their neighbours ("N.W." -> "NW", "O'Neil" -> "ONEIL"); other punctuation separates words.
+# "#" becomes a word of its own so "#2B", "# 2B" and "Apt #2B" all split the same way. Hyphens and slashes are kept
+# for house numbers and units like "123-A" and "1/2".
+_PUNCTUATION = str.maketrans({**{c: ' ' for c in ',;:()[]{}"!?*_|\\<>=+@$%^~`'}, '.': None, "'": None, '#': ' # '})
+_PUNCTUATION_CHARS = frozenset(chr(c) for c in _PUNCTUATION) - {'.', ','}
+_ZIP = re.compile(r'(\d{5})')
+
+
+def _words(text):
+    """Upper-case text and split it into words, applying _PUNCTUATION."""
+    text = text.upper()
+    # str.translate costs more than the rest of a parse, so the usual periods and commas are replaced directly
+    if '.' in text:
+        text = text.replace('.', '')
+    if ',' in text:
+        text = text.replace(',', ' ')
+    if not _PUNCTUATION_CHARS.isdisjoint(text):
+        text = text.translate(_PUNCTUATION)
+    return text.split()
+
+
+def _split_unit(words):
+    """Split the secondary unit off a street's words: (street words, unit designator, unit identifier)."""
+    # The unit follows at least the street name, so "123 Front St" or "12 Lot Rd" keep their name
+    start = 2 if words[0][:1].isdigit() else 1
+    count = len(words)
+    for i in range(start, count):
+        word = words[i]
+        designator = NUMBERED_UNITS.get(word)
+        if designator is not None:
+            rest = words[i + 1:]
+            if rest and rest[0] == '#':
+                rest = rest[1:]
+            # "#" alone is always a unit; a word like KEY or PIER only when a suffix does not follow ("Harbor Key Dr")
+            if rest and (word == '#' or rest[0] not in STREET_SUFFIXES):
+                return words[:i], designator, ' '.join(rest)
+            if word == '#':
+                return words[:i], '', ''
+        elif i == count - 1 and i > start and word in BARE_UNITS:
+            return words[:i], BARE_UNITS[word], ''
+    return words, '', ''
+
+
+def _parse(text):
+    """Return (street words, unit designator, unit identifier) for one street line."""
+    words = _words(text)
+    if not words:
+        return words, '', ''
+    if '-' in words:
+        words = [word for word in words if word != '-']  # "123 Main St - Apt 4"
+        if not words:
+            return words, '', ''
+    designator = unit = ''
+    if not _UNIT_WORDS.isdisjoint(words):
+        words, designator, unit = _split_unit(words)
+
+    # Abbreviate from the end inwards, and only while another word is left to be the street's name
+    first = 1 if words[0][:1].isdigit() and len(words) > 1 else 0
+    end = len(words)
+    if end - first >= 2:
+        directional = DIRECTIONALS.get(words[-1])
+        if directional is not None:
+            words[-1] = directional  # Post-directional: "Main St North"
+            end -= 1
+    if end - first >= 2:
+        suffix = STREET_SUFFIXES.get(words[end - 1])
+        if suffix is not None:
+            words[end - 1] = suffix
+            end -= 1
+    if end - first >= 2:
+        directional = DIRECTIONALS.get(words[first])
+        if directional is not None:
+            words[first] = directional  # Pre-directional: "North Main St"
+    return words, designator, unit
+
+
+def split_unit(text):
+    """Normalize a street line and split off its unit: "4529 Winona Court Apt #2" -> ("4529 WINONA CT", "APT 2")."""
+    words, designator, unit = _parse(text or '')
+    return ' '.join(words), f"{designator} {unit}".strip()
+
+
+def normalize_street(text):
+    """Normalized street line including its unit ("4529 Winona Court, Apt 2" -> "4529 WINONA CT APT 2")."""
+    words, designator, unit = _parse(text or '')
+    if designator:
+        words.append(designator)
+    if unit:
+        words.append(unit)
+    return ' '.join(words)
+
+
+def normalize_line(text):
+    """Normalize a one-line address ("4529 Winona Ct, Denver, CO 80212, USA") for use as a cache key.
+
+    The first comma-separated part is the street; a later part that starts with a unit designator is the unit;
+    the rest (city, state, ZIP) is only cleaned up. A trailing country name is dropped.
+    """
+    parts = (text or '').split(',')
+    cleaned = [normalize_street(parts[0])]
+    for part in parts[1:]:
+        words = _words(part)
+        if words and words[0] in _UNIT_WORDS:
+            rest = words[2:] if words[1:2] == ['#'] else words[1:]
+            cleaned.append(' '.join([NUMBERED_UNITS.get(words[0]) or BARE_UNITS[words[0]], *rest]))
+        elif words:
+            cleaned.append(' '.join(words))
+    if len(cleaned) > 1 and cleaned[-1] in _COUNTRY_NAMES:
+        cleaned.pop()
+    return ' '.join(part for part in cleaned if part)
+
+
+def unit_identifier(unit):
+    """The unit without its designator, so "Apt 2B", "Unit 2b" and "#2B" all give "2B"."""
+    words = _words(unit or '')
+    while words and (words[0] in NUMBERED_UNITS or words[0] in BARE_UNITS) and len(words) > 1:
+        words.pop(0)
+    return ' '.join(words)
+
+
+def address_key(address, unit=None, zip_code=None):
+    """Key identifying one property: "STREET|ZIP5|UNIT", e.g. "4529 WINONA CT|80212|2B".
+
+    The unit comes from `unit`, or from the street line when `unit` is empty. City names are left out because
+    one ZIP is often written with several of them. Returns None when there is no street.
+    """
+    words, designator, street_unit = _parse(address or '')
+    if not words:
+        return None
+    match = _ZIP.match((zip_code or '').strip())
+    return f"{' '.join(words)}|{match.group(1) if match else ''}|{unit_identifier(unit) if unit else street_unit}"
+
+
+def address_keys(rows):
+    """address_key() for many (address, unit, zip) rows at once, for bulk imports and backfills; None where there is no street."""
+    parse, identifier, zip_match = _parse, unit_identifier, _ZIP.match
+    keys = []
+    append = keys.append
+    for address, unit, zip_code in rows:
+        words, designator, street_unit = parse(address or '')
+        if not words:
+            append(None)
+            continue
+        match = zip_match(zip_code.strip()) if zip_code else None
+        append(f"{' '.join(words)}|{match.group(1) if match else ''}|{identifier(unit) if unit else street_unit}")
+    return keys
+
+
+def key_prefix(address, zip_code):
+    """The "STREET|ZIP5|" part of address_key(), which every unit at that street address shares."""
+    words, _, _ = _parse(address or '')
+    match = _ZIP.match((zip_code or '').strip())
+    return f"{' '.join(words)}|{match.group(1) if match else ''}|" if words and match else None
+
+
+def one_line(address, city=None, state=None, zip_code=None):
+    """Join address parts the way Step 2 sends them to the geocoder: "4529 Winona Ct, Denver, CO 80212"."""
+    parts = [part.strip() for part in (address, city, f"{state or ''} {zip_code or ''}") if part and part.strip()]
+    return ', '.join(parts) if address and address.strip() else None
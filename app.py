@@ -1,167 +1,94 @@
 #!/home/dh_kfekwx/bin/python3
-import sqlite3
-from flask import Flask, request, redirect, url_for, render_template, session, jsonify
+from dotenv import load_dotenv
+load_dotenv()  # Load environment variables from .env before the local modules below read their settings
+from flask import Flask, Response, request, redirect, url_for, render_template, session, jsonify, stream_with_context
 # from app import app as application
 from auth import register_user, validate_user  # from auth.py
-import requests  # Intended to support ATTOM API integration on future deployment.
-from dotenv import load_dotenv
+from search import create_search_index, search_files
+from spatial import LOCATION_SLOTS, create_location_index, nearby
+from suggest import SUGGEST_MONTHS, SUGGEST_RADIUS_MILES, create_sale_changes, suggest_comps
+from valuation import value_files
+from market_rates import create_market_rates_tables, rates_for_files, update_job
+from writer import get_writer
+from http_client import client
+import geocode
+import gazetteer
+from geocode import GeocodeError, create_geocode_indexes, geocode_flight
+from attom import BASE_URL, COMP_ADDRESS_FIELDS, detail_cache, detail_flight, enrich_comps, enrich_file
+from jobs import runner
+from export import csv_chunks, export_columns, gzip_chunks, iter_rows, ndjson_chunks
+from addresses import address_key, one_line
+from db import VALUATOR_DB, USERS_DB, COMP_FIELDS, COMP_LOOKUP_SQL, backfill_address_keys, connection, create_comparables_table, create_valuator_table, get_db, get_schema, init_app, migrate_comparables
 import os
+import json
+import sqlite3
 from flup.server.fcgi import WSGIServer
 
-load_dotenv()  # Load environment variables from .env
-
 GOOGLE_GEOCODING_API_KEY = os.getenv('GOOGLE_GEOCODING_API_KEY')
 print("Loaded API Key: ", GOOGLE_GEOCODING_API_KEY)  # Debugging statement
 ATTOM_API_KEY = os.getenv('ATTOM_API_KEY')
 print("Loaded ATTOM API Key: ", ATTOM_API_KEY)  # Debugging statement
-BASE_URL = "https://api.gateway.attomdata.com/propertyapi/v1.0.0/property/detail"
 print(f"BASE_URL: {BASE_URL}")
 
 
 app = Flask(__name__)
 app.secret_key = 'test'  # Change this to a more secure key in production
+init_app(app)  # Return pooled SQLite connections at the end of each request
+runner.register('attom', enrich_file)  # ATTOM subject enrichment runs as a background job queued by form_step1
+# Market adjustment rates are refitted in the background after Step 2 saves, once enough of an area's files changed
+runner.register('market-rates', update_job)
+
+# Start the background job workers in whichever process serves the first request (app.run, FastCGI or Passenger).
+@app.before_request
+def start_job_workers():
+    runner.start()
 
 def init_users_db():
     try:
-        conn = sqlite3.connect('users.db')  # Connect to users.db
-        cursor = conn.cursor()
-        # Users table for login authentication, separated in order not to have to clear users when valuator data is cleared.
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL
-            )
-        ''')
-        print("Users table created (or already exists).")  
-        conn.commit()
+        with connection(USERS_DB) as conn:  # Connect to users.db
+            cursor = conn.cursor()
+            # Users table for login authentication, separated in order not to have to clear users when valuator data is cleared.
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password TEXT NOT NULL
+                )
+            ''')
+            print("Users table created (or already exists).")  
+            conn.commit()
     except Exception as e:
         print(f"Error occurred while initializing the users database: {e}") 
-    finally:
-        conn.close()  
 
 def init_db():
     try:
         print("Initializing the database...")
 
-        conn = sqlite3.connect('valuator.db')
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA foreign_keys = ON;")
-
-        # Create consolidated table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS valuator_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                file_number TEXT UNIQUE NOT NULL,
-                address TEXT,
-                unit TEXT,
-                city TEXT,
-                state TEXT,
-                zip TEXT,
-                latitude REAL,
-                longitude REAL,
-                property_type TEXT,
-                borrower_name TEXT,
-                county TEXT,
-                parcel_number TEXT,
-                subject_data_source TEXT,
-                subject_mls TEXT,
-                subject_original_list_price REAL,
-                subject_original_list_date TEXT,
-                subject_sale_price REAL,
-                subject_sale_date TEXT,
-                subject_cdom INTEGER,
-                subject_site_size REAL,
-                subject_location TEXT,
-                subject_view TEXT,
-                subject_year_built INTEGER DEFAULT NULL,
-                subject_des_style TEXT,
-                subject_condition TEXT,
-                subject_beds INTEGER,
-                subject_full_baths INTEGER,
-                subject_half_baths INTEGER,
-                subject_gla REAL,
-                subject_basement TEXT,
-                subject_garage TEXT,
-                additional_comments TEXT,
-                comp1_address TEXT,
-                comp1_unit TEXT,
-                comp1_city TEXT,
-                comp1_state TEXT,
-                comp1_zip TEXT,
-                comp1_data_source TEXT,
-                comp1_mls TEXT,
-                comp1_original_list_price REAL,
-                comp1_original_list_date TEXT,
-                comp1_sale_price REAL,
-                comp1_sale_date TEXT,
-                comp1_cdom INTEGER,
-                comp1_site_size REAL,
-                comp1_location TEXT,
-                comp1_view TEXT,
-                comp1_year_built INTEGER DEFAULT NULL,
-                comp1_des_style TEXT,
-                comp1_condition TEXT,
-                comp1_beds INTEGER,
-                comp1_full_baths INTEGER,
-                comp1_half_baths INTEGER,
-                comp1_gla REAL,
-                comp1_basement TEXT,
-                comp1_garage TEXT,
-                comp2_address TEXT,
-                comp2_unit TEXT,
-                comp2_city TEXT,
-                comp2_state TEXT,
-                comp2_zip TEXT,
-                comp2_data_source TEXT,
-                comp2_mls TEXT,
-                comp2_original_list_price REAL,
-                comp2_original_list_date TEXT,
-                comp2_sale_price REAL,
-                comp2_sale_date TEXT,
-                comp2_cdom INTEGER,
-                comp2_site_size REAL,
-                comp2_location TEXT,
-                comp2_view TEXT,
-                comp2_year_built INTEGER DEFAULT NULL,
-                comp2_des_style TEXT,
-                comp2_condition TEXT,
-                comp2_beds INTEGER,
-                comp2_full_baths INTEGER,
-                comp2_half_baths INTEGER,
-                comp2_gla REAL,
-                comp2_basement TEXT,
-                comp2_garage TEXT,
-                comp3_address TEXT,
-                comp3_unit TEXT,
-                comp3_city TEXT,
-                comp3_state TEXT,
-                comp3_zip TEXT,
-                comp3_data_source TEXT,
-                comp3_mls TEXT,
-                comp3_original_list_price REAL,
-                comp3_original_list_date TEXT,
-                comp3_sale_price REAL,
-                comp3_sale_date TEXT,
-                comp3_cdom INTEGER,
-                comp3_site_size REAL,
-                comp3_location TEXT,
-                comp3_view TEXT,
-                comp3_year_built INTEGER DEFAULT NULL,
-                comp3_des_style TEXT,
-                comp3_condition TEXT,
-                comp3_beds INTEGER,
-                comp3_full_baths INTEGER,
-                comp3_half_baths INTEGER,
-                comp3_gla REAL,
-                comp3_basement TEXT,
-                comp3_garage TEXT
-            )
-        ''')
-        print("valuator_data table created successfully!")  # Debugging statement
-
-        conn.commit()
-        conn.close()
+        with connection(VALUATOR_DB) as conn:
+            # Create consolidated table
+            create_valuator_table(conn)
+            print("valuator_data table created successfully!")  # Debugging statement
+
+            # Comparables live in their own table, one row per comp, so a file can carry any number of them.
+            create_comparables_table(conn)
+            conn.commit()
+            copied = migrate_comparables(conn)
+            if copied:
+                print(f"Migrated {copied} comparables out of the legacy valuator_data columns.")
+            keyed = backfill_address_keys(conn)
+            if keyed:
+                print(f"Filled the address key of {keyed} files.")
+            # Full-text search over addresses, borrowers, parcels and comments, kept in sync by triggers
+            create_search_index(conn)
+            # R*Tree over subject and comp coordinates for radius searches, also kept in sync by triggers
+            create_location_index(conn)
+            # Log of changed files, so each worker's comp suggestion index reloads only what changed
+            create_sale_changes(conn)
+            # Market-derived adjustment rates per ZIP and county, refitted from sale_changes
+            create_market_rates_tables(conn)
+            # Saved subject and comp coordinates answer repeat geocode lookups
+            create_geocode_indexes(conn)
+            get_schema(conn)  # Warm the schema registry before the first request
     except Exception as e:
         print(f"Error occurred while initializing the database: {e}")  # Detailed error message
 
@@ -225,12 +152,10 @@ def check_file_number():
     data = request.get_json()  # Get JSON data from the request
     file_number = data.get('file_number')
 
-    conn = sqlite3.connect('valuator.db')
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
 
-    cursor.execute('SELECT * FROM valuator_data WHERE file_number = ?', (file_number,))
+    cursor.execute('SELECT 1 FROM valuator_data WHERE file_number = ?', (file_number,))
     existing_entry = cursor.fetchone()
-    conn.close()
 
     return jsonify({'exists': bool(existing_entry)})
 
@@ -246,23 +171,66 @@ def get_lat_lng():
 
         print(f"Fetching coordinates for: {address}")
 
-        url = f"https://maps.googleapis.com/maps/api/geocode/json?address={address}&key={GOOGLE_GEOCODING_API_KEY}"
-        response = requests.get(url)
-        geocode_data = response.json()
-
-        print("Geocoding API Response:", geocode_data)
+        # Cached and already-saved addresses are answered without calling Google. Step 1 stores the answer as the
+        # subject's exact coordinates, so a ZIP centroid is never returned here.
+        location = geocode.geocode(address, approximate=False)
 
-        if (geocode_data['status'] == 'OK'):
-            location = geocode_data['results'][0]['geometry']['location']
-            return jsonify({'latitude': location['lat'], 'longitude': location['lng']})
+        if location is not None:
+            return jsonify(location)
         else:
-            print(f"Error from Google API: {geocode_data.get('status', 'Unknown error')}")
-            return jsonify({'error': geocode_data.get('status', 'Unknown error')}), 500
+            print("Error from Google API: ZERO_RESULTS")
+            return jsonify({'error': 'ZERO_RESULTS'}), 500
+    except GeocodeError as e:
+        print(f"Error from Google API: {e.status}")
+        return jsonify({'error': e.status}), 500
     except Exception as e:
         print(f"Server Error in /get-lat-lng: {e}")
         print(f"Address received for geocoding: {address}")
         return jsonify({'error': 'Internal Server Error'}), 500
 
+# Geocode the subject and every comp for the Step 2 map in one call:
+# POST {"addresses": [{"label": "Subject", "address": "4529 Winona Ct, Denver, CO 80212"}, ...]}.
+# Markers come back in request order. Cached and saved addresses cost no Google call; the rest run in parallel within the Google rate limit.
+GEOCODE_BATCH_LIMIT = 25
+
+@app.route('/api/geocode-batch', methods=['POST'])
+def api_geocode_batch():
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    data = request.get_json(silent=True) or {}
+    items = data.get('addresses')
+    if not isinstance(items, list) or len(items) > GEOCODE_BATCH_LIMIT:
+        return jsonify({"error": f"addresses must be a list of at most {GEOCODE_BATCH_LIMIT} items"}), 400
+    if not all(isinstance(item, dict) and isinstance(item.get('address'), str) and item['address'].strip() for item in items):
+        return jsonify({"error": "Every item needs a non-empty address"}), 400
+
+    markers = []
+    for item, location in zip(items, geocode.geocode_many([item['address'] for item in items])):
+        marker = {"label": item.get('label'), "address": item['address']}
+        if isinstance(location, GeocodeError):
+            marker["error"] = location.status
+        elif isinstance(location, Exception):
+            print(f"Error geocoding {item['address']}: {location}")
+            marker["error"] = "Internal Server Error"
+        elif location is None:
+            marker["error"] = "ZERO_RESULTS"
+        else:
+            marker.update(location)
+        markers.append(marker)
+    return jsonify({"markers": markers})
+
+# City, state, county and ZIP centroid from the offline gazetteer, for prefilling forms without a network call.
+@app.route('/api/zip/<zip_code>', methods=['GET'])
+def api_zip(zip_code):
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    zip_info = gazetteer.lookup(zip_code)
+    if zip_info is None:
+        return jsonify({"error": "No data found"}), 404
+    return jsonify(zip_info)
+
 # Form Step 1 is intended to collect data for the first step of the form. Functioning as intended. 
 # TODO: Future functionality could include API integration to populate certain data from employer internal source. 
 @app.route('/form-step1', methods=['GET', 'POST'])
@@ -279,8 +247,8 @@ def form_step1():
         city = request.form.get('city')
         state = request.form.get('state')
         zip_code = request.form.get('zip')
-        latitude = request.form.get('latitude')
-        longitude = request.form.get('longitude')
+        # Blank or unparsable coordinates are stored as NULL, not '', so the file stays out of spatial searches
+        latitude, longitude = saved_location(request.form.get('latitude'), request.form.get('longitude')) or (None, None)
         property_type = request.form.get('property_type')
         borrower_name = request.form.get('borrower_name')
         file_number = request.form.get('file_number')
@@ -289,7 +257,7 @@ def form_step1():
         print(f"Latitude: {latitude}, Longitude: {longitude}")
 
         # Check if file number already exists
-        conn = sqlite3.connect('valuator.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('SELECT file_number FROM valuator_data WHERE file_number = ?', (file_number,))
         existing_entry = cursor.fetchone()
@@ -301,66 +269,26 @@ def form_step1():
         # Debugging: Confirm data being inserted into the DB
         print("Inserting into DB:", address, unit, city, state, zip_code, latitude, longitude, property_type, borrower_name, file_number)
 
-        # Enable foreign keys
-        cursor.execute("PRAGMA foreign_keys = ON;")
-
-        # Insert into consolidated table
-        cursor.execute('''
-            INSERT INTO valuator_data (file_number, address, unit, city, state, zip, latitude, longitude, property_type, borrower_name)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (file_number, address, unit, city, state, zip_code, latitude, longitude, property_type, borrower_name))
-        conn.commit()
-
-        # Fetch subject data from ATTOM API
-        headers = {
-            "Accept": "application/json",
-            "APIKey": ATTOM_API_KEY
+        # Insert into consolidated table through the single writer, which group-commits concurrent submissions
+        schema = get_schema(conn)
+        writer = get_writer()
+        new_file = {
+            'file_number': file_number, 'address': address, 'unit': unit, 'city': city, 'state': state, 'zip': zip_code,
+            'latitude': latitude, 'longitude': longitude, 'property_type': property_type, 'borrower_name': borrower_name,
+            'address_key': address_key(address, unit, zip_code)
         }
-        params = {
-            "address1": address,
-            "address2": f"{city}, {state} {zip_code}"
-        }
-
-        response = requests.get(BASE_URL, headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            if data["status"]["code"] == 0 and data["status"]["total"] > 0:
-                property_data = data["property"][0]
-
-                # Extract all needed data
-                county = property_data["area"].get("countrysecsubd", "")
-                parcel_number = property_data["identifier"].get("apn", "")
-                gla = property_data["building"]["size"].get("livingsize", None)
-                year_built = property_data["summary"].get("yearbuilt", None)
-                beds = property_data["building"]["rooms"].get("beds", None)
-                full_baths = property_data["building"]["rooms"].get("bathsfull", None)
-                half_baths = property_data["building"]["rooms"].get("bathstotal", 0) - full_baths if full_baths else 0
-                condition = property_data["building"]["construction"].get("condition", "")
-                view = property_data["building"]["summary"].get("view", "")
-                site_size = property_data["lot"].get("lotsize2", None)
-                garage = property_data["building"]["parking"].get("garagetype", "")
-                basement = property_data["building"]["interior"].get("bsmtsize", None)
-
-                # Update database
-                cursor.execute('''
-                    UPDATE valuator_data
-                    SET 
-                        county = ?, parcel_number = ?, subject_gla = ?, subject_year_built = ?, 
-                        subject_beds = ?, subject_full_baths = ?, subject_half_baths = ?, subject_condition = ?, 
-                        subject_view = ?, subject_site_size = ?, subject_garage = ?, subject_basement = ?
-                    WHERE file_number = ?
-                ''', (
-                    county, parcel_number, gla, year_built, beds, full_baths, half_baths, 
-                    condition, view, site_size, garage, basement, file_number
-                ))
-                conn.commit()
-                print("Subject data fetched and saved successfully.")
-            else:
-                print("No data found from ATTOM API.")
-        else:
-            print(f"Error fetching data from ATTOM API: {response.status_code} - {response.text}")
+        # County from the offline ZIP gazetteer, so the file has one before (or without) ATTOM enrichment
+        zip_info = gazetteer.lookup(zip_code)
+        new_file['county'] = zip_info['county'] if zip_info else None
+        try:
+            writer.execute(schema.insert('valuator_data', new_file), tuple(new_file.values()))
+        except sqlite3.IntegrityError:
+            # Another submission took this file number between the check above and the insert
+            error_message = f"File number {file_number} already exists. Please enter a unique file number."
+            return render_template('form_step1.html', error_message=error_message)
 
-        conn.close()
+        # Fetch subject data from ATTOM in the background; form_step2 polls /api/enrichment-status until it lands
+        runner.enqueue('attom', file_number)
 
         return redirect(url_for('form_step2', file_number=file_number))
 
@@ -372,198 +300,175 @@ def form_step1():
 # - (Enhancement) OpenStreetMap markers are inconsistent (possibly due to listener conflicts or load timing).
 # - (Enhancement) Additional features could include a map view of the property and comparables. Ideally, MAP would zoom in to the property and comparables.
 # - (Enhancement) ATTOM API integration. Approximately 30% of the data should be populated from the ATTOM API.
+# Columns Step 2 pre-populates, named as the template expects them.
+STEP2_COLUMNS = [
+    'id', 'file_number', 'address', 'unit', 'city', 'state', 'zip', 'latitude', 'longitude', 'borrower_name',
+    'property_type', 'county', 'parcel_number', 'subject_data_source', 'subject_mls', 'subject_location',
+    'subject_gla', 'subject_year_built', 'subject_beds', 'subject_full_baths', 'subject_half_baths',
+    'subject_condition', 'subject_view', 'subject_des_style', 'subject_site_size', 'subject_garage',
+    'subject_basement', 'additional_comments'
+]
+# Subject columns Step 2 posts under a subject_ prefixed field name; the other columns are posted under their own name
+SUBJECT_FORM_NAMES = {column: f"subject_{column}" for column in ('address', 'unit', 'city', 'state', 'zip')}
+
+def saved_location(latitude, longitude):
+    """(latitude, longitude) as floats, or None when either is missing or not a number (older rows stored '')."""
+    try:
+        return float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+
+def locate_comps(conn, schema, file_id, comps):
+    """Set latitude/longitude on each posted comp: kept from the saved comp when its address is unchanged,
+    otherwise geocoded on the server (cache, saved coordinates, then Google, in parallel).
+
+    ZIP-centroid approximations and failures leave the comp without coordinates, so they are retried on the next save.
+    """
+    located = {row['slot']: row for row in schema.fetch_all(conn, 'comparables', ['slot', 'address', 'latitude', 'longitude'],
+                                                             'file_id = ? AND latitude IS NOT NULL', (file_id,))}
+    pending = []
+    for slot, comp in comps.items():
+        stored = located.get(slot)
+        same_address = stored and stored['address'] == comp['address']
+        comp['latitude'] = stored['latitude'] if same_address else None
+        comp['longitude'] = stored['longitude'] if same_address else None
+        line = None if same_address else one_line(*(comp[field] for field in COMP_ADDRESS_FIELDS))
+        if line:
+            pending.append((comp, line))
+
+    for (comp, line), location in zip(pending, geocode.geocode_many([line for _, line in pending])):
+        if isinstance(location, Exception):
+            print(f"Error geocoding comp {line}: {location}")
+        elif location and not location.get('approximate'):
+            comp['latitude'], comp['longitude'] = location['latitude'], location['longitude']
+
 @app.route('/form-step2/<file_number>', methods=['GET', 'POST'])
 def form_step2(file_number):
     if not session.get('user_id'):
         return redirect(url_for('index'))
 
     # Fetch the data from valuator_data using the file_number
-    conn = sqlite3.connect('valuator.db')
-    cursor = conn.cursor()
-
-    # Enable foreign keys
-    cursor.execute("PRAGMA foreign_keys = ON;")
+    conn = get_db()
+    schema = get_schema(conn)
 
-    cursor.execute('SELECT * FROM valuator_data WHERE file_number = ?', (file_number,))
-    existing_entry = cursor.fetchone()
+    # Pre-populate form with the existing data from valuator_data
+    prepopulated_data = schema.fetch_one(conn, 'valuator_data', STEP2_COLUMNS, 'file_number = ?', (file_number,))
 
     # If no entry exists for the provided file number, redirect back to Step 1
-    if not existing_entry:
-        conn.close()
+    if not prepopulated_data:
         return redirect(url_for('form_step1'))
-
-    # Pre-populate form with the existing data from valuator_data
-    prepopulated_data = {
-        'file_number': existing_entry[1],
-        'address': existing_entry[2],
-        'unit': existing_entry[3],
-        'city': existing_entry[4],
-        'state': existing_entry[5],
-        'zip': existing_entry[6],
-        'latitude': existing_entry[7],
-        'longitude': existing_entry[8],
-        'borrower_name': existing_entry[10],
-        'property_type': existing_entry[9],
-        'county': existing_entry[11],
-        'parcel_number': existing_entry[12],
-        'subject_gla': existing_entry[29],
-        'subject_year_built': existing_entry[23],
-        'subject_beds': existing_entry[26],
-        'subject_full_baths': existing_entry[27],
-        'subject_half_baths': existing_entry[28],
-        'subject_condition': existing_entry[25],
-        'subject_view': existing_entry[22],
-        'subject_site_size': existing_entry[20],
-        'subject_garage': existing_entry[31],
-        'subject_basement': existing_entry[30],
-        'comp1_full_baths': existing_entry[52],
-        'comp2_full_baths': existing_entry[76],
-        'comp3_full_baths': existing_entry[100]
-    }
+    file_id = prepopulated_data.pop('id')
+
+    # Pre-populate saved comparables as comp{slot}_{field}, and collect saved coordinates for the map
+    location = saved_location(prepopulated_data['latitude'], prepopulated_data['longitude'])
+    saved_markers = [{'label': 'Subject', 'address': one_line(*(prepopulated_data[field] for field in COMP_ADDRESS_FIELDS)),
+                      'latitude': location[0], 'longitude': location[1]}] if location else []
+    for comp in schema.fetch_all(conn, 'comparables', ['slot', *COMP_FIELDS, 'latitude', 'longitude'], 'file_id = ?', (file_id,), order_by='slot'):
+        slot = comp.pop('slot')
+        location = saved_location(comp.pop('latitude'), comp.pop('longitude'))
+        if location:
+            saved_markers.append({'label': f"Comp {slot}", 'address': one_line(*(comp[field] for field in COMP_ADDRESS_FIELDS)),
+                                  'latitude': location[0], 'longitude': location[1]})
+        prepopulated_data.update({f"comp{slot}_{field}": value for field, value in comp.items()})
 
     if request.method == 'POST':
         # Collect subject data with defaults for optional fields
         subject_data = {
-            'subject_address': request.form.get('subject_address', ""),
-            'subject_unit': request.form.get('subject_unit', ""),
-            'subject_city': request.form.get('subject_city', ""),
-            'subject_state': request.form.get('subject_state', ""),
-            'subject_zip': request.form.get('subject_zip', ""),
-            'subject_county': request.form.get('subject_county', ""),
-            'subject_parcel_number': request.form.get('parcel_number', ""),
+            'address': request.form.get('subject_address', ""),
+            'unit': request.form.get('subject_unit', ""),
+            'city': request.form.get('subject_city', ""),
+            'state': request.form.get('subject_state', ""),
+            'zip': request.form.get('subject_zip', ""),
+            'county': request.form.get('county', ""),
+            'parcel_number': request.form.get('parcel_number', ""),
             'subject_data_source': request.form.get('subject_data_source', ""),
             'subject_mls': request.form.get('subject_mls', ""),
-            'subject_original_list_price': request.form.get('subject_original_list_price', None),
+            'subject_original_list_price': request.form.get('subject_original_list_price') or None,
             'subject_original_list_date': request.form.get('subject_original_list_date', ""),
-            'subject_sale_price': request.form.get('subject_sale_price', None),
+            'subject_sale_price': request.form.get('subject_sale_price') or None,
             'subject_sale_date': request.form.get('subject_sale_date', ""),
-            'subject_cdom': request.form.get('subject_cdom', None),
-            'subject_site_size': request.form.get('subject_site_size', None),
+            'subject_cdom': request.form.get('subject_cdom') or None,
+            'subject_site_size': request.form.get('subject_site_size') or None,
             'subject_location': request.form.get('subject_location', ""),
             'subject_view': request.form.get('subject_view', ""),
             'subject_des_style': request.form.get('subject_des_style', ""),
             'subject_condition': request.form.get('subject_condition', ""),
-            'subject_beds': request.form.get('subject_beds', None),
-            'subject_full_baths': request.form.get('subject_full_baths', None),
-            'subject_half_baths': request.form.get('subject_half_baths', None),
-            'subject_gla': request.form.get('subject_gla', None),
+            'subject_beds': request.form.get('subject_beds') or None,
+            'subject_full_baths': request.form.get('subject_full_baths') or None,
+            'subject_half_baths': request.form.get('subject_half_baths') or None,
+            'subject_gla': request.form.get('subject_gla') or None,
             'subject_basement': request.form.get('subject_basement', ""),
             'subject_garage': request.form.get('subject_garage', ""),
             'additional_comments': request.form.get('additional_comments', "")
         }
-
-        # Collect Comparable 1 data with defaults for optional fields
-        comp1_data = {
-            'comp1_address': request.form.get('comp1_address', ""),
-            'comp1_unit': request.form.get('comp1_unit', ""),
-            'comp1_city': request.form.get('comp1_city', ""),
-            'comp1_state': request.form.get('comp1_state', ""),
-            'comp1_zip': request.form.get('comp1_zip', ""),
-            'comp1_data_source': request.form.get('comp1_data_source', ""),
-            'comp1_mls': request.form.get('comp1_mls', ""),
-            'comp1_original_list_price': request.form.get('comp1_orig_list_price', None),
-            'comp1_original_list_date': request.form.get('comp1_orig_list_date', ""),
-            'comp1_sale_price': request.form.get('comp1_sale_price', None),
-            'comp1_sale_date': request.form.get('comp1_sale_date', ""),
-            'comp1_cdom': request.form.get('comp1_cdom', None),
-            'comp1_site_size': request.form.get('comp1_site_size', None),
-            'comp1_location': request.form.get('comp1_location', ""),
-            'comp1_view': request.form.get('comp1_view', ""),
-            'comp1_des_style': request.form.get('comp1_des_style', ""),
-            'comp1_condition': request.form.get('comp1_condition', ""),
-            'comp1_beds': request.form.get('comp1_beds', None),
-            'comp1_full_baths': request.form.get('comp1_full_baths', None),
-            'comp1_half_baths': request.form.get('comp1_half_baths', None),
-            'comp1_gla': request.form.get('comp1_gla', None),
-            'comp1_basement': request.form.get('comp1_basement', ""),
-            'comp1_garage': request.form.get('comp1_garage', "")
-        }
-
-        # Collect Comparable 2 data with defaults for optional fields
-        comp2_data = {
-            'comp2_address': request.form.get('comp2_address', ""),
-            'comp2_unit': request.form.get('comp2_unit', ""),
-            'comp2_city': request.form.get('comp2_city', ""),
-            'comp2_state': request.form.get('comp2_state', ""),
-            'comp2_zip': request.form.get('comp2_zip', ""),
-            'comp2_data_source': request.form.get('comp2_data_source', ""),
-            'comp2_mls': request.form.get('comp2_mls', ""),
-            'comp2_original_list_price': request.form.get('comp2_orig_list_price', None),
-            'comp2_original_list_date': request.form.get('comp2_orig_list_date', ""),
-            'comp2_sale_price': request.form.get('comp2_sale_price', None),
-            'comp2_sale_date': request.form.get('comp2_sale_date', ""),
-            'comp2_cdom': request.form.get('comp2_cdom', None),
-            'comp2_site_size': request.form.get('comp2_site_size', None),
-            'comp2_location': request.form.get('comp2_location', ""),
-            'comp2_view': request.form.get('comp2_view', ""),
-            'comp2_des_style': request.form.get('comp2_des_style', ""),
-            'comp2_condition': request.form.get('comp2_condition', ""),
-            'comp2_beds': request.form.get('comp2_beds', None),
-            'comp2_full_baths': request.form.get('comp2_full_baths', None),
-            'comp2_half_baths': request.form.get('comp2_half_baths', None),
-            'comp2_gla': request.form.get('comp2_gla', None),
-            'comp2_basement': request.form.get('comp2_basement', ""),
-            'comp2_garage': request.form.get('comp2_garage', "")
-        }
-
-        # Collect Comparable 3 data with defaults for optional fields
-        comp3_data = {
-            'comp3_address': request.form.get('comp3_address', ""),
-            'comp3_unit': request.form.get('comp3_unit', ""),
-            'comp3_city': request.form.get('comp3_city', ""),
-            'comp3_state': request.form.get('comp3_state', ""),
-            'comp3_zip': request.form.get('comp3_zip', ""),
-            'comp3_data_source': request.form.get('comp3_data_source', ""),
-            'comp3_mls': request.form.get('comp3_mls', ""),
-            'comp3_original_list_price': request.form.get('comp3_orig_list_price', None),
-            'comp3_original_list_date': request.form.get('comp3_orig_list_date', ""),
-            'comp3_sale_price': request.form.get('comp3_sale_price', None),
-            'comp3_sale_date': request.form.get('comp3_sale_date', ""),
-            'comp3_cdom': request.form.get('comp3_cdom', None),
-            'comp3_site_size': request.form.get('comp3_site_size', None),
-            'comp3_location': request.form.get('comp3_location', ""),
-            'comp3_view': request.form.get('comp3_view', ""),
-            'comp3_des_style': request.form.get('comp3_des_style', ""),
-            'comp3_condition': request.form.get('comp3_condition', ""),
-            'comp3_beds': request.form.get('comp3_beds', None),
-            'comp3_full_baths': request.form.get('comp3_full_baths', None),
-            'comp3_half_baths': request.form.get('comp3_half_baths', None),
-            'comp3_gla': request.form.get('comp3_gla', None),
-            'comp3_basement': request.form.get('comp3_basement', ""),
-            'comp3_garage': request.form.get('comp3_garage', "")
-        }
-
-        # Combine all data for insertion
-        combined_data = {**subject_data, **comp1_data, **comp2_data, **comp3_data}
-
-        # Fetch database columns
-        cursor.execute("PRAGMA table_info(valuator_data);")
-        db_columns_info = cursor.fetchall()
-        db_columns = [info[1] for info in db_columns_info if info[1] != 'id']  # Exclude 'id'
-
-        # Adjust combined_data to include only DB fields
-        valid_data = {key: combined_data.get(key) for key in db_columns}
-
-        # Prepare the INSERT statement
-        placeholders = ', '.join(['?'] * len(valid_data))
-        columns = ', '.join(valid_data.keys())
+        # Only columns the form posts are written, so a save keeps what the form has no input for (imported sale data)
+        subject_data = {column: value for column, value in subject_data.items() if SUBJECT_FORM_NAMES.get(column, column) in request.form}
+        subject_data['address_key'] = address_key(*(subject_data.get(column, prepopulated_data[column]) for column in ('address', 'unit', 'zip')))
+
+        # Collect every comparable posted as comp{slot}_*, storing blanks as NULL and skipping comps left entirely empty.
+        # Slots run 1..LOCATION_SLOTS - 1: slot 0 stands for the subject (valuation padding, file_locations ids).
+        slots = sorted(slot for slot in (int(key[4:-len('_address')]) for key in request.form
+                                         if key.startswith('comp') and key.endswith('_address') and key[4:-len('_address')].isdigit())
+                       if 1 <= slot < LOCATION_SLOTS)
+        # Fields the form does not post (year_built, say, from ATTOM or an import) keep the saved comp's value while its address is unchanged.
+        comps = {}
+        for slot in slots:
+            posted = {field: request.form.get(f"comp{slot}_{field}") or None for field in COMP_FIELDS if f"comp{slot}_{field}" in request.form}
+            if not any(posted.values()):
+                continue
+            same_address = prepopulated_data.get(f"comp{slot}_address") == posted.get('address')
+            comps[slot] = {field: posted[field] if field in posted else prepopulated_data.get(f"comp{slot}_{field}") if same_address else None
+                           for field in COMP_FIELDS}
+
+        # Geocode new and edited comps before taking the writer, so a page view can draw them without geocoding
+        locate_comps(conn, schema, file_id, comps)
+
+        # Runs on the writer thread, as one unit within its group commit
+        def save(writer_conn):
+            writer_conn.execute(schema.update('valuator_data', subject_data, 'id = ?'), (*subject_data.values(), file_id))
+            writer_conn.execute('DELETE FROM comparables WHERE file_id = ?', (file_id,))
+            writer_conn.executemany(schema.insert('comparables', ['file_id', 'slot', *COMP_FIELDS, 'latitude', 'longitude']),
+                                    [(file_id, slot, *comp.values()) for slot, comp in comps.items()])
 
         try:
-            cursor.execute(f'''
-                INSERT INTO valuator_data ({columns}) VALUES ({placeholders})
-            ''', tuple(valid_data.values()))
-            conn.commit()
-            print("Data inserted successfully.")
+            get_writer().run(save)
+            print(f"Data saved successfully with {len(comps)} comparables.")
         except Exception as e:
-            print(f"Error inserting data: {e}")
+            print(f"Error saving data: {e}")
             return "An error occurred while saving the data.", 500
-        finally:
-            conn.close()
+        # The save is committed; a failed enqueue only delays the refit until the next save or a manual update
+        try:
+            runner.enqueue('market-rates', 'all')
+        except Exception as e:
+            print(f"Error queueing market rates update: {e}")
 
         # Redirect after successful submission
         return redirect(url_for('dashboard'))  # Example redirection
 
-    return render_template('form_step2.html', **prepopulated_data)  # Render Form Step 2 for GET requests
+    job = runner.status(conn, 'attom', file_number)
+    return render_template('form_step2.html', enrichment_status=job['status'] if job else '', saved_markers=saved_markers, **prepopulated_data)  # Render Form Step 2 for GET requests
+
+# /api/subject-data response keys and the valuator_data columns they come from.
+SUBJECT_API_FIELDS = {
+    "address": "address",
+    "unit": "unit",
+    "city": "city",
+    "state": "state",
+    "zip": "zip",
+    "county": "county",
+    "parcel_number": "parcel_number",
+    "gla": "subject_gla",
+    "year_built": "subject_year_built",
+    "beds": "subject_beds",
+    "full_baths": "subject_full_baths",
+    "half_baths": "subject_half_baths",
+    "condition": "subject_condition",
+    "view": "subject_view",
+    "site_size": "subject_site_size",
+    "garage": "subject_garage",
+    "basement": "subject_basement"
+}
+SUBJECT_BATCH_LIMIT = 1000
 
 @app.route('/api/subject-data', methods=['GET'])
 def api_subject_data():
@@ -573,47 +478,52 @@ def api_subject_data():
         return jsonify({"error": "Missing required parameters"}), 400
 
     try:
-        conn = sqlite3.connect('valuator.db')
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA foreign_keys = ON;")
-
-        cursor.execute('SELECT * FROM valuator_data WHERE file_number = ?', (file_number,))
-        existing_entry = cursor.fetchone()
-        conn.close()
+        conn = get_db()
+        existing_entry = get_schema(conn).fetch_one(conn, 'valuator_data', SUBJECT_API_FIELDS.values(), 'file_number = ?', (file_number,))
 
         if not existing_entry:
             return jsonify({"error": "No data found"}), 404
 
         # Extract subject data from the database
-        subject_data = {
-            "address": existing_entry[2],
-            "unit": existing_entry[3],
-            "city": existing_entry[4],
-            "state": existing_entry[5],
-            "zip": existing_entry[6],
-            "county": existing_entry[11],
-            "parcel_number": existing_entry[12],
-            "gla": existing_entry[29],
-            "year_built": existing_entry[23],
-            "beds": existing_entry[26],
-            "full_baths": existing_entry[27],
-            "half_baths": existing_entry[28],
-            "condition": existing_entry[25],
-            "view": existing_entry[22],
-            "site_size": existing_entry[20],
-            "garage": existing_entry[31],
-            "basement": existing_entry[30]
-        }
+        subject_data = {key: existing_entry[column] for key, column in SUBJECT_API_FIELDS.items()}
 
         return jsonify(subject_data)
     except Exception as e:
         print(f"Error in api_subject_data: {e}")
         return jsonify({"error": str(e)}), 500
 
+# Batch variant: POST {"file_numbers": [...]} and get {file_number: subject data} back from a single query.
+# File numbers with no saved file map to {"error": "No data found"}, the same body the GET endpoint returns.
+@app.route('/api/subject-data', methods=['POST'])
+def api_subject_data_batch():
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    data = request.get_json(silent=True) or {}
+    file_numbers = data.get('file_numbers')
+
+    if not isinstance(file_numbers, list) or not all(isinstance(file_number, str) for file_number in file_numbers):
+        return jsonify({"error": "file_numbers must be a list of strings"}), 400
+    file_numbers = list(dict.fromkeys(file_numbers))  # Drop duplicates, keep request order
+    if len(file_numbers) > SUBJECT_BATCH_LIMIT:
+        return jsonify({"error": f"At most {SUBJECT_BATCH_LIMIT} file numbers per request"}), 400
+
+    try:
+        conn = get_db()
+        # json_each turns the whole list into one bound parameter, so the IN list has no variable limit and still uses the file_number index
+        rows = get_schema(conn).fetch_all(conn, 'valuator_data', ['file_number', *SUBJECT_API_FIELDS.values()],
+                                          'file_number IN (SELECT value FROM json_each(?))', (json.dumps(file_numbers),))
+        found = {row['file_number']: {key: row[column] for key, column in SUBJECT_API_FIELDS.items()} for row in rows}
+
+        return jsonify({file_number: found.get(file_number, {"error": "No data found"}) for file_number in file_numbers})
+    except Exception as e:
+        print(f"Error in api_subject_data_batch: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/comp-data', methods=['GET'])
 def api_comp_data():
     file_number = request.args.get('file_number')
-    comp_number = request.args.get('comp_number')  # comp1, comp2, or comp3
+    comp_number = request.args.get('comp_number')  # Comparable slot: 1, 2, 3, ...
     address = request.args.get('address')
     city = request.args.get('city')
     zip_code = request.args.get('zip')
@@ -625,51 +535,17 @@ def api_comp_data():
     try:
         comp_number = int(comp_number)  # Ensure comp_number is an integer
 
-        conn = sqlite3.connect('valuator.db')
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA foreign_keys = ON;")
-
-        # Query the database for the matching file number and other parameters
-        cursor.execute('''
-            SELECT * FROM valuator_data 
-            WHERE file_number = ? AND
-                  comp{0}_address = ? AND
-                  comp{0}_city = ? AND
-                  comp{0}_zip = ?
-        '''.format(comp_number), (file_number, address, city, zip_code))
+        cursor = get_db().cursor()
+
+        # Query the comparables table for the matching file number, slot and address
+        cursor.execute(COMP_LOOKUP_SQL, (file_number, comp_number, address, city, zip_code))
         existing_entry = cursor.fetchone()
-        conn.close()
 
         if not existing_entry:
             return jsonify({"error": "No data found"}), 404
 
         # Extract comp data from the database
-        comp_data = {
-            "address": existing_entry[33 + (comp_number - 1) * 24],
-            "unit": existing_entry[34 + (comp_number - 1) * 24],
-            "city": existing_entry[35 + (comp_number - 1) * 24],
-            "state": existing_entry[36 + (comp_number - 1) * 24],
-            "zip": existing_entry[37 + (comp_number - 1) * 24],
-            "data_source": existing_entry[38 + (comp_number - 1) * 24],
-            "mls": existing_entry[39 + (comp_number - 1) * 24],
-            "original_list_price": existing_entry[40 + (comp_number - 1) * 24],
-            "original_list_date": existing_entry[41 + (comp_number - 1) * 24],
-            "sale_price": existing_entry[42 + (comp_number - 1) * 24],
-            "sale_date": existing_entry[43 + (comp_number - 1) * 24],
-            "cdom": existing_entry[44 + (comp_number - 1) * 24],
-            "site_size": existing_entry[45 + (comp_number - 1) * 24],
-            "location": existing_entry[46 + (comp_number - 1) * 24],
-            "view": existing_entry[47 + (comp_number - 1) * 24],
-            "year_built": existing_entry[48 + (comp_number - 1) * 24],
-            "des_style": existing_entry[49 + (comp_number - 1) * 24],
-            "condition": existing_entry[50 + (comp_number - 1) * 24],
-            "beds": existing_entry[51 + (comp_number - 1) * 24],
-            "full_baths": existing_entry[52 + (comp_number - 1) * 24],
-            "half_baths": existing_entry[53 + (comp_number - 1) * 24],
-            "gla": existing_entry[54 + (comp_number - 1) * 24],
-            "basement": existing_entry[55 + (comp_number - 1) * 24],
-            "garage": existing_entry[56 + (comp_number - 1) * 24]
-        }
+        comp_data = dict(zip(COMP_FIELDS, existing_entry))
 
         return jsonify(comp_data)
     except ValueError:
@@ -678,6 +554,236 @@ def api_comp_data():
         print(f"Error in api_comp_data: {e}")
         return jsonify({"error": str(e)}), 500
 
+# Fetch ATTOM details for all of a file's comps at once: POST {"file_number": ..., "comps": [{"slot", "address", "city", "state", "zip"}, ...]}.
+# Lookups run in parallel (ATTOM_CONCURRENCY at a time per worker) and are saved in one transaction, so the wait is about one ATTOM call, not one per comp.
+# Without "comps", every saved comp with an address is looked up. Only empty comp fields are filled.
+COMP_ENRICH_LIMIT = 20
+
+@app.route('/api/comp-data/enrich', methods=['POST'])
+def api_enrich_comps():
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    data = request.get_json(silent=True) or {}
+    file_number = data.get('file_number')
+    comps = data.get('comps')
+    if not file_number:
+        return jsonify({"error": "Missing required parameters"}), 400
+    if comps is not None:
+        if not isinstance(comps, list) or len(comps) > COMP_ENRICH_LIMIT:
+            return jsonify({"error": f"comps must be a list of at most {COMP_ENRICH_LIMIT} comparables"}), 400
+        try:
+            comps = [{'slot': int(comp['slot']), **{name: str(comp.get(name) or '').strip() for name in COMP_ADDRESS_FIELDS}} for comp in comps]
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "Every comp needs an integer slot"}), 400
+        # Slot 0 stands for the subject (valuation padding, file_locations ids), as in form_step2
+        if not all(1 <= comp['slot'] < LOCATION_SLOTS for comp in comps):
+            return jsonify({"error": f"Comp slots must be between 1 and {LOCATION_SLOTS - 1}"}), 400
+        if len({comp['slot'] for comp in comps}) != len(comps):
+            return jsonify({"error": "Duplicate comp slot"}), 400
+        comps = [comp for comp in comps if comp['address']]
+
+    try:
+        report = enrich_comps(file_number, comps)
+    except Exception as e:
+        print(f"Error in api_enrich_comps: {e}")
+        return jsonify({"error": str(e)}), 500
+    if report is None:
+        return jsonify({"error": "No data found"}), 404
+    return jsonify({"file_number": file_number, "comps": report})
+
+# Status of the background ATTOM enrichment for a file: pending, running, done or failed (404 if none was queued).
+@app.route('/api/enrichment-status', methods=['GET'])
+def api_enrichment_status():
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    file_number = request.args.get('file_number')
+    if not file_number:
+        return jsonify({"error": "Missing required parameters"}), 400
+
+    job = runner.status(get_db(), 'attom', file_number)
+    if job is None:
+        return jsonify({"error": "No enrichment queued for this file"}), 404
+    return jsonify({"file_number": file_number, **job})
+
+# Operational counters for sizing caches, pools and request coalescing. Hit and coalescing counts are per worker process; stored entries and bytes are shared.
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    return jsonify({
+        "attom_cache": detail_cache.stats(get_db()),
+        "geocode_cache": geocode.stats(get_db()),
+        "http": client.stats(),
+        "coalescing": {flight.name: flight.stats() for flight in (detail_flight, geocode_flight)},
+    })
+
+# Search/autocomplete over subject and comp addresses, borrower names, parcel numbers and comments.
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    query = request.args.get('q', '')
+    try:
+        limit = min(int(request.args.get('limit', 10)), 50)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    try:
+        return jsonify({"results": search_files(get_db(), query, limit)})
+    except Exception as e:
+        print(f"Error in api_search: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# Prior subjects and comps near a point, nearest first: ?lat=&lng= or ?file_number= to center on a saved subject.
+# ?radius=<miles> (default 1), ?months=N keeps only properties sold in the last N months, ?kind=subject|comp narrows the results,
+# ?limit=N (default 100, at most NEARBY_MAX_RESULTS) caps their number.
+NEARBY_MAX_RADIUS_MILES = 25
+NEARBY_MAX_RESULTS = 500
+NEARBY_MAX_MONTHS = 1200
+
+@app.route('/api/nearby', methods=['GET'])
+def api_nearby():
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    try:
+        radius = float(request.args.get('radius', 1))
+        months = request.args.get('months', type=int)
+        limit = min(int(request.args.get('limit', 100)), NEARBY_MAX_RESULTS)
+        kind = request.args.get('kind')
+        if not 0 < radius <= NEARBY_MAX_RADIUS_MILES:
+            return jsonify({"error": f"radius must be between 0 and {NEARBY_MAX_RADIUS_MILES} miles"}), 400
+        # A month count SQLite's date() cannot apply would silently drop the date filter, and a limit below 1 would slice from the end
+        if months is not None and not 1 <= months <= NEARBY_MAX_MONTHS:
+            return jsonify({"error": f"months must be between 1 and {NEARBY_MAX_MONTHS}"}), 400
+        if limit < 1:
+            return jsonify({"error": f"limit must be between 1 and {NEARBY_MAX_RESULTS}"}), 400
+        if kind not in (None, 'subject', 'comp'):
+            return jsonify({"error": "kind must be subject or comp"}), 400
+
+        conn = get_db()
+        file_number = request.args.get('file_number')
+        if file_number:
+            subject = conn.execute("SELECT latitude, longitude FROM valuator_data WHERE file_number = ?", (file_number,)).fetchone()
+            location = saved_location(*subject) if subject else None
+            if location is None:
+                return jsonify({"error": "No coordinates found for this file"}), 404
+            lat, lng = location
+        else:
+            lat, lng = float(request.args['lat']), float(request.args['lng'])
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            return jsonify({"error": "lat/lng out of range"}), 400
+
+        since = conn.execute("SELECT date('now', ?)", (f"-{months} months",)).fetchone()[0] if months else None
+        results = nearby(conn, lat, lng, radius, since=since, kinds=(kind,) if kind else ('subject', 'comp'), limit=limit)
+        return jsonify({"latitude": lat, "longitude": lng, "radius_miles": radius, "sold_since": since, "results": results})
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat and lng (or file_number) are required and must be numbers"}), 400
+    except Exception as e:
+        print(f"Error in api_nearby: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# Comp suggestions for a saved file: earlier sales near the subject ranked by similarity, best first (see suggest.py).
+# ?k=N (default 6), ?radius=<miles> (default SUGGEST_RADIUS_MILES) and ?months=N (default SUGGEST_MONTHS) of sales.
+SUGGEST_MAX_RESULTS = 50
+
+@app.route('/api/comp-suggestions/<file_number>', methods=['GET'])
+def api_comp_suggestions(file_number):
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    try:
+        k = int(request.args.get('k', 6))
+        radius = float(request.args.get('radius', SUGGEST_RADIUS_MILES))
+        months = int(request.args.get('months', SUGGEST_MONTHS))
+    except ValueError:
+        return jsonify({"error": "k, radius and months must be numbers"}), 400
+    if not 0 < k <= SUGGEST_MAX_RESULTS:
+        return jsonify({"error": f"k must be between 1 and {SUGGEST_MAX_RESULTS}"}), 400
+    if not 0 < radius <= NEARBY_MAX_RADIUS_MILES:
+        return jsonify({"error": f"radius must be between 0 and {NEARBY_MAX_RADIUS_MILES} miles"}), 400
+    if months <= 0:
+        return jsonify({"error": "months must be positive"}), 400
+
+    try:
+        suggestions = suggest_comps(get_db(), file_number, k, radius, months)
+    except Exception as e:
+        print(f"Error in api_comp_suggestions: {e}")
+        return jsonify({"error": str(e)}), 500
+    if suggestions is None:
+        return jsonify({"error": "No coordinates found for this file"}), 404
+    return jsonify({"file_number": file_number, "radius_miles": radius, "months": months, "suggestions": suggestions})
+
+# Sales comparison valuation: POST {"file_numbers": [...]} (or "file_number"), optionally with "rates": {"gla": 60, ...}
+# in dollars per unit to override the defaults. Each file is adjusted at its ZIP's or county's market rates where
+# market_rates.py has fitted them (rates_source names the area, or "default"). Returns each file's rates, adjusted
+# comp prices, net/gross adjustment percentages and indicated value (see valuation.py).
+VALUATION_BATCH_LIMIT = 1000
+
+@app.route('/api/valuation', methods=['POST'])
+def api_valuation():
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    data = request.get_json(silent=True) or {}
+    file_numbers = data.get('file_numbers', [data['file_number']] if 'file_number' in data else None)
+    if not isinstance(file_numbers, list) or not file_numbers or not all(isinstance(file_number, str) for file_number in file_numbers):
+        return jsonify({"error": "file_number or file_numbers (a list of strings) is required"}), 400
+    file_numbers = list(dict.fromkeys(file_numbers))
+    if len(file_numbers) > VALUATION_BATCH_LIMIT:
+        return jsonify({"error": f"At most {VALUATION_BATCH_LIMIT} file numbers per request"}), 400
+    rates = data.get('rates') or {}
+    if not isinstance(rates, dict):
+        return jsonify({"error": "rates must be an object of dollar amounts"}), 400
+
+    try:
+        conn = get_db()
+        market = rates_for_files(conn, file_numbers)
+        valuations = value_files(conn, file_numbers, rates, base_rates={file_number: found[1] for file_number, found in market.items()})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error in api_valuation: {e}")
+        return jsonify({"error": str(e)}), 500
+    for file_number, valuation in valuations.items():
+        valuation['rates_source'] = market[file_number][0] if file_number in market else 'default'
+    return jsonify({
+        "rate_overrides": rates,
+        "valuations": {file_number: valuations.get(file_number, {"error": "No data found"}) for file_number in file_numbers},
+    })
+
+# Stream valuator_data as NDJSON (default) or CSV for analytics.
+# ?after=<id> resumes after the last id received, ?limit=N caps the row count, ?gzip=1 compresses the response.
+@app.route('/api/export', methods=['GET'])
+def api_export():
+    if not session.get('user_id'):
+        return jsonify({"error": "Authentication required"}), 401
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({"error": "after and limit must be integers"}), 400
+
+    conn = get_db()
+    columns = export_columns(get_schema(conn))
+    rows = iter_rows(conn, columns, after=after, limit=limit)
+    chunks = ndjson_chunks(columns, rows) if export_format == 'ndjson' else csv_chunks(columns, rows)
+
+    headers = {'Content-Disposition': f'attachment; filename=valuator_data.{export_format}'}
+    if request.args.get('gzip') == '1':
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    mimetype = 'application/x-ndjson' if export_format == 'ndjson' else 'text/csv'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
 
 if __name__ == "__main__":
     # Initialize the DB before running the server
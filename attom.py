@@ -0,0 +1,292 @@
+#!/home/dh_kfekwx/bin/python3
+
+import os
+import requests
+
+import db
+from addresses import normalize_line
+from cache import PersistentCache
+from http_client import client
+from jobs import JobFailed, RetryableJobError
+from singleflight import SingleFlight
+from writer import get_writer
+
+# Point ATTOM_BASE_URL at fake_upstream.py for offline load tests
+BASE_URL = os.getenv('ATTOM_BASE_URL', "https://api.gateway.attomdata.com/propertyapi/v1.0.0/property/detail")
+
+# Property details rarely change, so hits are kept for a month; "no result" answers expire sooner in case ATTOM adds the parcel.
+detail_cache = PersistentCache(
+    'attom-detail',
+    ttl=int(os.getenv('ATTOM_CACHE_TTL_SECONDS', str(30 * 24 * 3600))),
+    negative_ttl=int(os.getenv('ATTOM_CACHE_NEGATIVE_TTL_SECONDS', str(24 * 3600))),
+    lru_size=int(os.getenv('ATTOM_CACHE_LRU_SIZE', '2048')),
+)
+
+# Files opened on the same subdivision at once ask for the same parcels; overlapping cache misses share one ATTOM call.
+detail_flight = SingleFlight('attom-detail')
+
+
+def cache_key(address1, address2):
+    """Cache key for an ATTOM address1/address2 pair, so spelling variants of one address share an entry."""
+    return f"{normalize_line(address1)}|{normalize_line(address2)}"
+
+
+def fetch_property_detail(address, city, state, zip_code):
+    """Return the first ATTOM property detail record for an address, or None if ATTOM has none.
+
+    Answers, including "no result", come from detail_cache when possible, and concurrent misses for the same
+    address share one request. Raises RetryableJobError for timeouts, throttling and 5xx responses, and
+    JobFailed for other errors; errors are never cached.
+    """
+    params = {
+        "address1": address,
+        "address2": f"{city}, {state} {zip_code}"
+    }
+    key = cache_key(params["address1"], params["address2"])
+    property_data = detail_cache.get(key)
+    if property_data is detail_cache.MISSING:
+        property_data = detail_flight.do(key, _load_property_detail, key, params)
+    return property_data
+
+
+def _load_property_detail(key, params):
+    property_data = request_property_detail(params)
+    detail_cache.set(key, property_data)
+    return property_data
+
+
+def request_property_detail(params):
+    """Call the ATTOM property detail endpoint; see fetch_property_detail for the result and errors."""
+    headers = {
+        "Accept": "application/json",
+        "APIKey": os.getenv('ATTOM_API_KEY')
+    }
+    try:
+        response = client.get('attom', BASE_URL, headers=headers, params=params)
+    except requests.RequestException as e:
+        raise RetryableJobError(f"ATTOM request failed: {e}")
+
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RetryableJobError(f"ATTOM returned {response.status_code}")
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    status = data.get("status", {})
+    if response.status_code == 200 and status.get("code") == 0 and status.get("total", 0) > 0:
+        return data["property"][0]
+    # ATTOM answers "no match" with a 400 and msg SuccessWithoutResult rather than an empty 200
+    if response.status_code == 200 or status.get("msg") == "SuccessWithoutResult":
+        return None
+    raise JobFailed(f"ATTOM returned {response.status_code}: {response.text[:200]}")
+
+
+def _text(value):
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+
+def _integer(value):
+    if type(value) is int:
+        return value
+    try:
+        return int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _number(value):
+    if type(value) is int or type(value) is float:
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# valuator_data column -> (path into an ATTOM property record, coercion). Paths follow output.json.
+# A missing section, missing key or unparseable value leaves the column None instead of raising.
+PROPERTY_FIELDS = {
+    'county': (('area', 'countrysecsubd'), _text),
+    'parcel_number': (('identifier', 'apn'), _text),
+    'latitude': (('location', 'latitude'), _number),
+    'longitude': (('location', 'longitude'), _number),
+    'subject_gla': (('building', 'size', 'livingsize'), _number),
+    'subject_year_built': (('summary', 'yearbuilt'), _integer),
+    'subject_beds': (('building', 'rooms', 'beds'), _integer),
+    'subject_full_baths': (('building', 'rooms', 'bathsfull'), _integer),
+    'subject_half_baths': (('building', 'rooms', 'bathshalf'), _integer),
+    'subject_condition': (('building', 'construction', 'condition'), _text),
+    'subject_view': (('building', 'summary', 'view'), _text),
+    'subject_des_style': (('building', 'summary', 'archStyle'), _text),
+    'subject_site_size': (('lot', 'lotsize2'), _number),
+    'subject_garage': (('building', 'parking', 'garagetype'), _text),
+    'subject_basement': (('building', 'interior', 'bsmtsize'), _integer),
+}
+# Filled only where the file has none yet; Step 1 stores the coordinates the appraiser picked on the map
+PROPERTY_FILL_ONLY = ('latitude', 'longitude')
+# Values already of this type skip their coercion call, which is most of the parsing cost
+_EXACT_TYPES = {_integer: int, _number: float}
+# Fields grouped by the section holding them, so each section is walked once per record
+_SECTIONS = {}
+for _name, (_path, _convert) in PROPERTY_FIELDS.items():
+    _SECTIONS.setdefault(_path[:-1], []).append((_name, _path[-1], _convert, _EXACT_TYPES.get(_convert)))
+_SECTIONS = list(_SECTIONS.items())
+
+
+class PropertyRecord:
+    """One ATTOM property record as valuator_data columns, each typed or None."""
+
+    __slots__ = tuple(PROPERTY_FIELDS)
+
+    def as_dict(self, skip_missing=False):
+        """The columns as a dict, optionally leaving out those ATTOM did not provide."""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        return {name: value for name, value in values.items() if value is not None} if skip_missing else values
+
+    def __repr__(self):
+        return f"PropertyRecord({self.as_dict(skip_missing=True)})"
+
+
+def parse_property(property_data):
+    """Extract PROPERTY_FIELDS from one ATTOM property detail record into a PropertyRecord."""
+    record = PropertyRecord()
+    for path, fields in _SECTIONS:
+        section = property_data
+        for key in path:
+            try:
+                section = section[key]
+            except (KeyError, TypeError, IndexError):
+                section = None
+                break
+        if isinstance(section, dict):
+            for name, key, convert, exact_type in fields:
+                value = section.get(key)
+                if value is not None and type(value) is not exact_type:
+                    value = convert(value)
+                setattr(record, name, value)
+        else:
+            for field in fields:
+                setattr(record, field[0], None)
+    if record.subject_half_baths is None and record.subject_full_baths is not None:
+        # Older records carry no bathshalf; bathstotal counts each half bath as 0.5
+        total = _number(((property_data.get('building') or {}).get('rooms') or {}).get('bathstotal'))
+        if total is not None and total >= record.subject_full_baths:
+            record.subject_half_baths = round((total - record.subject_full_baths) * 2)
+    return record
+
+
+def parse_response(data):
+    """Parse every property on a page of an ATTOM response (pagesize can be more than 1)."""
+    return [parse_property(property_data) for property_data in data.get('property') or ()]
+
+
+# comparables columns filled from ATTOM and the PropertyRecord fields they come from
+COMP_ATTOM_FIELDS = {
+    'gla': 'subject_gla',
+    'year_built': 'subject_year_built',
+    'beds': 'subject_beds',
+    'full_baths': 'subject_full_baths',
+    'half_baths': 'subject_half_baths',
+    'condition': 'subject_condition',
+    'view': 'subject_view',
+    'site_size': 'subject_site_size',
+    'garage': 'subject_garage',
+    'basement': 'subject_basement',
+    'des_style': 'subject_des_style',
+}
+COMP_ADDRESS_FIELDS = ['address', 'city', 'state', 'zip']
+
+
+def parse_comp(property_data):
+    """Map an ATTOM property detail record to comparables columns."""
+    record = parse_property(property_data)
+    return {column: getattr(record, key) for column, key in COMP_ATTOM_FIELDS.items()}
+
+
+def fetch_property_details(addresses):
+    """Fetch details for many (address, city, state, zip) tuples in parallel, at most ATTOM_CONCURRENCY at a time.
+
+    Returns one entry per address, in order: the record, None when ATTOM has none, or the exception raised.
+    """
+    return client.run_parallel('attom', lambda address: fetch_property_detail(*address), addresses)
+
+
+def _upsert_comps(conn, file_id, rows):
+    # ATTOM only fills columns left empty, unless the comp's address changed: then the stored details
+    # and coordinates belonged to another property and are replaced.
+    columns = ['file_id', 'slot', *COMP_ADDRESS_FIELDS, *COMP_ATTOM_FIELDS]
+    same = "comparables.address IS excluded.address"
+    assignments = [f"{name} = excluded.{name}" for name in COMP_ADDRESS_FIELDS]
+    assignments += [f"{name} = CASE WHEN {same} THEN COALESCE(comparables.{name}, excluded.{name}) ELSE excluded.{name} END"
+                    for name in COMP_ATTOM_FIELDS]
+    assignments += [f"{name} = CASE WHEN {same} THEN comparables.{name} END" for name in ('latitude', 'longitude')]
+    conn.executemany(f"""
+        INSERT INTO comparables ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+        ON CONFLICT (file_id, slot) DO UPDATE SET {', '.join(assignments)}
+    """, [(file_id, slot, *(comp[name] for name in COMP_ADDRESS_FIELDS), *(attom_data.get(name) for name in COMP_ATTOM_FIELDS))
+          for slot, comp, attom_data in rows])
+
+
+def enrich_comps(file_number, comps=None):
+    """Fetch ATTOM details for a file's comps in parallel and save them all in one transaction.
+
+    comps is a list of {'slot', 'address', 'city', 'state', 'zip'} dicts; slots not saved yet are created.
+    By default every saved comp with an address is looked up. Returns {slot: {'status', **comp columns}} with
+    status 'updated', 'not found' or 'error' (comps that errored are left untouched), or None if there is no such file.
+    """
+    with db.connection() as conn:
+        row = conn.execute("SELECT id FROM valuator_data WHERE file_number = ?", (file_number,)).fetchone()
+        if row is None:
+            return None
+        file_id = row[0]
+        if comps is None:
+            comps = db.get_schema(conn).fetch_all(conn, 'comparables', ['slot', *COMP_ADDRESS_FIELDS],
+                                                  "file_id = ? AND COALESCE(address, '') != ''", (file_id,), order_by='slot')
+
+    results = fetch_property_details([tuple(comp[name] for name in COMP_ADDRESS_FIELDS) for comp in comps])
+    report, rows = {}, []
+    for comp, property_data in zip(comps, results):
+        slot = comp['slot']
+        if isinstance(property_data, Exception):
+            report[slot] = {'status': 'error', 'error': str(property_data) or type(property_data).__name__}
+            continue
+        attom_data = parse_comp(property_data) if property_data is not None else {}
+        rows.append((slot, comp, attom_data))
+        report[slot] = {'status': 'updated' if attom_data else 'not found', **attom_data}
+
+    if rows:
+        get_writer().run(_upsert_comps, file_id, rows)
+    return report
+
+
+def enrich_file(file_number):
+    """Job handler for 'attom': fetch the subject's ATTOM detail and save it on the file.
+
+    Returns 'updated' or 'not found' as the job result.
+    """
+    with db.connection() as conn:
+        schema = db.get_schema(conn)
+        subject = schema.fetch_one(conn, 'valuator_data', ['address', 'city', 'state', 'zip'], 'file_number = ?', (file_number,))
+    if not subject:
+        raise JobFailed(f"File {file_number} no longer exists")
+
+    property_data = fetch_property_detail(subject['address'], subject['city'], subject['state'], subject['zip'])
+    if property_data is None:
+        print(f"No data found from ATTOM API for {file_number}.")
+        return 'not found'
+    # Only columns ATTOM provided are written, so a sparse record never blanks what the file already has
+    attom_data = parse_property(property_data).as_dict(skip_missing=True)
+    location = [attom_data.pop(name, None) for name in PROPERTY_FILL_ONLY]
+
+    def save(conn):
+        if attom_data:
+            conn.execute(schema.update('valuator_data', attom_data, 'file_number = ?'), (*attom_data.values(), file_number))
+        if None not in location:
+            conn.execute("UPDATE valuator_data SET latitude = ?, longitude = ? WHERE file_number = ? AND COALESCE(latitude, '') = ''",
+                         (*location, file_number))
+
+    get_writer().run(save)
+    print(f"Subject data fetched and saved successfully for {file_number}.")
+    return 'updated'
@@ -0,0 +1,892 @@
+#!/home/dh_kfekwx/bin/python3
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+import db
+
+COMP_INSERT = f"INSERT INTO comparables (file_id, slot, {', '.join(db.COMP_FIELDS)}) VALUES (?, ?, {', '.join(['?'] * len(db.COMP_FIELDS))})"
+
+
+def make_bench_db(path, rows, journal_mode):
+    """Create a small valuator_data table with `rows` files for benchmarking."""
+    conn = sqlite3.connect(path)
+    conn.execute(f"PRAGMA journal_mode = {journal_mode};")
+    conn.execute('''
+        CREATE TABLE valuator_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_number TEXT UNIQUE NOT NULL,
+            address TEXT,
+            subject_gla REAL
+        )
+    ''')
+    conn.executemany(
+        'INSERT INTO valuator_data (file_number, address, subject_gla) VALUES (?, ?, ?)',
+        ((f"F{i:07d}", f"{i} MAIN ST", 1000 + i % 2000) for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+def run_workers(threads, seconds, op):
+    """Call op(rng) from `threads` threads for `seconds`; return (ops, locked_errors)."""
+    counts = [0] * threads
+    locked = [0] * threads
+    stop = time.perf_counter() + seconds
+
+    def worker(n):
+        rng = random.Random(n)
+        while time.perf_counter() < stop:
+            try:
+                op(rng)
+                counts[n] += 1
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                locked[n] += 1
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(counts), sum(locked)
+
+
+def bench_connections(args):
+    """Compare connect-per-request against the pooled WAL connection layer on a read-heavy mix."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _bench_connections(args, tmpdir)
+
+
+def _bench_connections(args, tmpdir):
+
+    def workload(get_conn, put_conn):
+        def op(rng):
+            conn = get_conn()
+            try:
+                file_number = f"F{rng.randrange(args.rows):07d}"
+                if rng.random() < args.write_ratio:
+                    conn.execute('UPDATE valuator_data SET subject_gla = subject_gla + 1 WHERE file_number = ?', (file_number,))
+                    conn.commit()
+                else:
+                    conn.execute('SELECT * FROM valuator_data WHERE file_number = ?', (file_number,)).fetchone()
+            finally:
+                put_conn(conn)
+        return op
+
+    # Before: what every handler used to do.
+    legacy_path = os.path.join(tmpdir, 'legacy.db')
+    make_bench_db(legacy_path, args.rows, 'DELETE')
+
+    def legacy_connect():
+        conn = sqlite3.connect(legacy_path)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        return conn
+
+    ops, locked = run_workers(args.threads, args.seconds, workload(legacy_connect, lambda conn: conn.close()))
+    print(f"connect-per-request: {ops / args.seconds:10.0f} req/s  locked errors: {locked}")
+
+    # After: pooled connections with the configured pragmas.
+    pooled_path = os.path.join(tmpdir, 'pooled.db')
+    make_bench_db(pooled_path, args.rows, 'WAL')
+    pool = db.ConnectionPool(pooled_path, size=args.threads)
+    ops, locked = run_workers(args.threads, args.seconds, workload(pool.acquire, pool.release))
+    pool.close_all()
+    print(f"pooled WAL:          {ops / args.seconds:10.0f} req/s  locked errors: {locked}  connections opened: {pool.opened}")
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def fake_comp(rng, n):
+    """Return one synthetic comparable as a dict keyed by db.COMP_FIELDS."""
+    return {
+        'address': f"{rng.randrange(1, 9999)} ELM ST", 'unit': None, 'city': 'DENVER', 'state': 'CO',
+        'zip': f"80{rng.randrange(200, 300)}", 'data_source': 'MLS', 'mls': f"M{n}",
+        'original_list_price': rng.randrange(200000, 900000), 'original_list_date': '2024-01-15',
+        'sale_price': rng.randrange(200000, 900000), 'sale_date': '2024-03-01', 'cdom': rng.randrange(1, 120),
+        'site_size': rng.randrange(2000, 12000), 'location': 'N;Res;', 'view': 'N;Res;',
+        'year_built': rng.randrange(1900, 2024), 'des_style': 'Ranch', 'condition': 'C3',
+        'beds': rng.randrange(1, 6), 'full_baths': rng.randrange(1, 4), 'half_baths': rng.randrange(0, 2),
+        'gla': rng.randrange(700, 4000), 'basement': 'Full', 'garage': '2 Car Attached',
+    }
+
+
+def build_synthetic_db(path, files, layout, max_comps=3, seed=0):
+    """Build a valuator database with `files` files in either the 'wide' (legacy) or 'normalized' layout."""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = OFF;")
+    db.create_valuator_table(conn)
+    if layout == 'wide':
+        for slot in db.LEGACY_COMP_SLOTS:
+            for name, col_type in db.COMP_COLUMNS:
+                conn.execute(f"ALTER TABLE valuator_data ADD COLUMN comp{slot}_{name} {col_type}")
+    else:
+        db.create_comparables_table(conn)
+
+    wide_columns = [f"comp{slot}_{name}" for slot in db.LEGACY_COMP_SLOTS for name in db.COMP_FIELDS]
+    subject_columns = 'file_number, address, city, state, zip, subject_gla, subject_beds, subject_year_built, address_key'
+    for start in range(0, files, 10000):
+        subjects, comps = [], []
+        for i in range(start, min(files, start + 10000)):
+            subject = (f"F{i:07d}", f"{i} MAIN ST", 'DENVER', 'CO', f"802{i % 40:02d}", rng.randrange(700, 4000), rng.randrange(1, 6), rng.randrange(1900, 2024),
+                       f"{i} MAIN ST|802{i % 40:02d}|")
+            file_comps = [fake_comp(rng, i * 10 + slot) for slot in range(1, rng.randrange(0, max_comps + 1) + 1)]
+            if layout == 'wide':
+                values = [None] * len(wide_columns)
+                for slot, comp in enumerate(file_comps[:len(db.LEGACY_COMP_SLOTS)]):
+                    values[slot * len(db.COMP_FIELDS):(slot + 1) * len(db.COMP_FIELDS)] = comp.values()
+                subjects.append(subject + tuple(values))
+            else:
+                subjects.append(subject)
+                comps.extend((i + 1, slot, *comp.values()) for slot, comp in enumerate(file_comps, 1))
+        if layout == 'wide':
+            columns = subject_columns + ', ' + ', '.join(wide_columns)
+            placeholders = ', '.join(['?'] * (9 + len(wide_columns)))
+        else:
+            columns, placeholders = subject_columns, ', '.join(['?'] * 9)
+        conn.executemany(f"INSERT INTO valuator_data ({columns}) VALUES ({placeholders})", subjects)
+        if comps:
+            conn.executemany(COMP_INSERT, comps)
+        conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    return conn
+
+
+def database_size(conn):
+    """Return the size of the main database file in bytes."""
+    return conn.execute("PRAGMA page_count;").fetchone()[0] * conn.execute("PRAGMA page_size;").fetchone()[0]
+
+
+def bench_comparables(args):
+    """Compare storage and form_step2 read/save latency for the wide comp columns against the comparables table."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for layout in ('wide', 'normalized'):
+            started = time.perf_counter()
+            conn = build_synthetic_db(os.path.join(tmpdir, f"{layout}.db"), args.files, layout)
+            built = time.perf_counter() - started
+            rng = random.Random(1)
+            reads, saves = [], []
+            for _ in range(args.samples):
+                file_id = rng.randrange(1, args.files + 1)
+                file_comps = [fake_comp(rng, n) for n in range(3)]
+
+                started = time.perf_counter()
+                row = conn.execute("SELECT * FROM valuator_data WHERE file_number = ?", (f"F{file_id - 1:07d}",)).fetchone()
+                if layout == 'normalized':
+                    conn.execute("SELECT * FROM comparables WHERE file_id = ? ORDER BY slot", (row[0],)).fetchall()
+                reads.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                if layout == 'wide':
+                    assignments = ', '.join(f"comp{slot}_{name} = ?" for slot in db.LEGACY_COMP_SLOTS for name in db.COMP_FIELDS)
+                    conn.execute(f"UPDATE valuator_data SET {assignments} WHERE id = ?", (*(v for comp in file_comps for v in comp.values()), file_id))
+                else:
+                    conn.execute("DELETE FROM comparables WHERE file_id = ?", (file_id,))
+                    conn.executemany(COMP_INSERT, [(file_id, slot, *comp.values()) for slot, comp in enumerate(file_comps, 1)])
+                conn.commit()
+                saves.append(time.perf_counter() - started)
+
+            print(f"{layout:<10} files: {args.files}  build: {built:6.1f}s  size: {database_size(conn) / 1e6:8.1f} MB  "
+                  f"read p50/p99: {percentile(reads, 50) * 1e6:6.0f}/{percentile(reads, 99) * 1e6:6.0f} us  "
+                  f"save p50/p99: {percentile(saves, 50) * 1e6:6.0f}/{percentile(saves, 99) * 1e6:6.0f} us")
+            conn.close()
+
+
+def bench_plans(args):
+    """Check that every hot-path query in db.INDEXED_QUERIES is served by an index, on an empty and an analyzed database."""
+    import geocode
+    import spatial
+
+    queries = dict(db.INDEXED_QUERIES)
+    queries['nearby'] = (spatial.NEARBY_SQL, {'south': 39.7, 'north': 39.8, 'west': -105.0, 'east': -104.9,
+                                              'since': None, 'subjects': True, 'comps': True})
+    queries['geocode_stored_location'] = (geocode.STORED_LOCATION_SQL, {'prefix': '1 MAIN ST|80212|', 'prefix_end': '1 MAIN ST|80212}', 'zip': '80212'})
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        empty = sqlite3.connect(os.path.join(tmpdir, 'empty.db'))
+        db.create_valuator_table(empty)
+        db.create_comparables_table(empty)
+        spatial.create_location_index(empty)
+        geocode.create_geocode_indexes(empty)
+        populated = build_synthetic_db(os.path.join(tmpdir, 'populated.db'), args.files, 'normalized')
+        spatial.create_location_index(populated)
+        geocode.create_geocode_indexes(populated)
+        populated.execute("ANALYZE;")
+        for label, conn in (('empty', empty), ('analyzed', populated)):
+            for name, (sql, params) in queries.items():
+                scans = db.full_table_scans(conn, sql, params)
+                status = 'FAIL' if scans else 'ok'
+                failures += bool(scans)
+                print(f"{status:<5}{label:<10}{name:<30}{' | '.join(db.query_plan(conn, sql, params))}")
+        empty.close()
+        populated.close()
+    if failures:
+        raise SystemExit(f"{failures} query plan(s) fell back to a full table scan")
+
+
+def bench_subject_batch(args):
+    """Time resolving a batch of file numbers with one json_each query against one query per file."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = build_synthetic_db(os.path.join(tmpdir, 'batch.db'), args.files, 'normalized')
+        rng = random.Random(2)
+        file_numbers = [f"F{rng.randrange(args.files + args.batch):07d}" for _ in range(args.batch)]  # Some will not exist
+        columns = ['file_number', 'address', 'city', 'state', 'zip', 'subject_gla', 'subject_beds', 'subject_year_built']
+        select = f"SELECT {', '.join(columns)} FROM valuator_data"
+
+        started = time.perf_counter()
+        for file_number in file_numbers:
+            conn.execute(f"{select} WHERE file_number = ?", (file_number,)).fetchone()
+        single = time.perf_counter() - started
+
+        started = time.perf_counter()
+        found = conn.execute(f"{select} WHERE file_number IN (SELECT value FROM json_each(?))", (json.dumps(file_numbers),)).fetchall()
+        batched = time.perf_counter() - started
+        conn.close()
+    print(f"{args.batch} file numbers ({len(found)} found) over {args.files} files: "
+          f"one query each {single * 1e3:.1f} ms, one batch query {batched * 1e3:.1f} ms")
+
+
+def bench_search(args):
+    """Time /api/search-style prefix, substring and typo queries against a synthetic database."""
+    import search
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = build_synthetic_db(os.path.join(tmpdir, 'search.db'), args.files, 'normalized')
+        started = time.perf_counter()
+        search.create_search_index(conn)
+        print(f"indexed {args.files} files in {time.perf_counter() - started:.1f}s")
+        rng = random.Random(3)
+        for label, make_query in (
+            ('prefix', lambda: f"{rng.randrange(args.files)} MA"),
+            ('substring', lambda: f"{rng.randrange(1, 9999)} EL"),
+            ('typo', lambda: f"{rng.randrange(args.files)} MAIM ST"),
+        ):
+            timings = []
+            for _ in range(args.samples):
+                query = make_query()
+                started = time.perf_counter()
+                search.search_files(conn, query)
+                timings.append(time.perf_counter() - started)
+            print(f"{label:<10} p50: {percentile(timings, 50) * 1e3:7.2f} ms  p99: {percentile(timings, 99) * 1e3:7.2f} ms")
+        conn.close()
+
+
+def bench_nearby(args):
+    """Time R*Tree radius searches against a haversine scan of every located subject and comp."""
+    import spatial
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = build_synthetic_db(os.path.join(tmpdir, 'nearby.db'), args.files, 'normalized')
+        # Scatter subjects and comps over a metro-sized area (about 40 x 35 miles)
+        conn.create_function('jitter', 2, lambda low, high, rng=random.Random(4): rng.uniform(low, high))
+        conn.execute("UPDATE valuator_data SET latitude = jitter(39.5, 40.1), longitude = jitter(-105.3, -104.6)")
+        conn.execute("UPDATE comparables SET latitude = jitter(39.5, 40.1), longitude = jitter(-105.3, -104.6)")
+        conn.commit()
+        started = time.perf_counter()
+        spatial.create_location_index(conn)
+        points = conn.execute("SELECT count(*) FROM file_locations").fetchone()[0]
+        print(f"indexed {points} points in {time.perf_counter() - started:.1f}s")
+
+        rng = random.Random(5)
+        centers = [(rng.uniform(39.5, 40.1), rng.uniform(-105.3, -104.6)) for _ in range(args.samples)]
+        timings, found = [], 0
+        for lat, lng in centers:
+            started = time.perf_counter()
+            found += len(spatial.nearby(conn, lat, lng, args.radius, limit=None))
+            timings.append(time.perf_counter() - started)
+        print(f"rtree  {args.radius} mi  p50: {percentile(timings, 50) * 1e3:7.2f} ms  p99: {percentile(timings, 99) * 1e3:7.2f} ms  "
+              f"({found / len(centers):.0f} results per search)")
+
+        timings = []
+        for lat, lng in centers[:args.scan_samples]:
+            started = time.perf_counter()
+            rows = conn.execute("SELECT latitude, longitude FROM valuator_data UNION ALL SELECT latitude, longitude FROM comparables").fetchall()
+            sorted(distance for distance in (spatial.haversine_miles(lat, lng, *row) for row in rows) if distance <= args.radius)
+            timings.append(time.perf_counter() - started)
+        print(f"scan   {args.radius} mi  p50: {percentile(timings, 50) * 1e3:7.2f} ms")
+        conn.close()
+
+
+def bench_writes(args):
+    """Compare per-request write transactions against the single-writer group-commit queue under concurrent form saves."""
+    import writer
+
+    def save(conn, rng):
+        # One form_step2-style save: update the subject and replace its comps
+        file_id = rng.randrange(1, args.files + 1)
+        conn.execute("UPDATE valuator_data SET subject_gla = ? WHERE id = ?", (rng.randrange(700, 4000), file_id))
+        conn.execute("DELETE FROM comparables WHERE file_id = ?", (file_id,))
+        conn.executemany(COMP_INSERT, [(file_id, slot, *fake_comp(rng, slot).values()) for slot in (1, 2, 3)])
+
+    def timed(op, latencies):
+        def run(rng):
+            started = time.perf_counter()
+            op(rng)
+            latencies.append(time.perf_counter() - started)
+        return run
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mode in ('transaction', 'queue'):
+            path = os.path.join(tmpdir, f'{mode}.db')
+            build_synthetic_db(path, args.files, 'normalized').close()
+            latencies = []
+            if mode == 'transaction':
+                # Before: every handler opens its own BEGIN IMMEDIATE transaction on a pooled connection
+                pool = db.ConnectionPool(path, size=args.writers)
+
+                def op(rng):
+                    conn = pool.acquire()
+                    try:
+                        conn.execute(f"PRAGMA synchronous = {writer.WRITE_SYNCHRONOUS};")
+                        with db.transaction(conn):
+                            save(conn, rng)
+                    finally:
+                        pool.release(conn)
+            else:
+                queue = writer.WriteQueue(path)
+
+                def op(rng):
+                    queue.run(save, rng)
+
+            ops, locked = run_workers(args.writers, args.seconds, timed(op, latencies))
+            batch = f"  mean batch: {queue.intents / queue.batches:.1f}" if mode == 'queue' else ''
+            print(f"{mode:<12} {args.writers} writers: {ops / args.seconds:7.0f} saves/s  p50: {percentile(latencies, 50) * 1e3:7.2f} ms  "
+                  f"p99: {percentile(latencies, 99) * 1e3:7.2f} ms  locked errors: {locked}{batch}")
+
+
+def bench_attom_parse(args):
+    """Parse synthetic ATTOM detail pages into PropertyRecords and report records per second."""
+    import attom
+    import fake_upstream
+
+    sample = fake_upstream.load_sample()
+    rng = random.Random(5)
+    records = []
+    for n in range(args.distinct):
+        status, body = fake_upstream.attom_response(sample, f"{n} MAIN ST", "DENVER, CO 80212", not_found_rate=0)
+        record = body["property"][0]
+        if rng.random() < args.sparse:
+            # Sparse records: ATTOM leaves out whole sections for many parcels
+            for section in rng.sample(['building', 'lot', 'area', 'summary', 'location'], 2):
+                record.pop(section, None)
+        records.append(record)
+    pages = [{"status": {"code": 0, "pagesize": args.pagesize}, "property": [records[(start + i) % len(records)] for i in range(args.pagesize)]}
+             for start in range(0, args.records, args.pagesize)]
+
+    for _ in range(args.rounds):
+        started = time.perf_counter()
+        parsed = sum(len(attom.parse_response(page)) for page in pages)
+        elapsed = time.perf_counter() - started
+        print(f"parsed {parsed} records in pages of {args.pagesize}: {parsed / elapsed:,.0f} records/s ({elapsed / parsed * 1e6:.2f} us each)")
+
+
+# Address normalization cases that must not regress: input street line -> (street, unit) from addresses.split_unit.
+ADDRESS_GOLDEN = [
+    ("4529 North Winona Court, Apt. #2B", ("4529 N WINONA CT", "APT 2B")),
+    ("  4529   winona   ct  ", ("4529 WINONA CT", "")),
+    ("4529 W. 38th Avenue", ("4529 W 38TH AVE", "")),
+    ("123 Main Street North", ("123 MAIN ST N", "")),
+    ("1600 Pennsylvania Ave NW", ("1600 PENNSYLVANIA AVE NW", "")),
+    ("123 N.W. Main St.", ("123 NW MAIN ST", "")),
+    ("123 North St", ("123 NORTH ST", "")),
+    ("500 Court Street", ("500 COURT ST", "")),
+    ("1 Avenue of the Americas", ("1 AVENUE OF THE AMERICAS", "")),
+    ("8 Park", ("8 PARK", "")),
+    ("Winona Ct", ("WINONA CT", "")),
+    ("123 Main St #4", ("123 MAIN ST", "# 4")),
+    ("123 Main St # 4", ("123 MAIN ST", "# 4")),
+    ("123 main st apt 4b", ("123 MAIN ST", "APT 4B")),
+    ("123 Main St - Suite 200", ("123 MAIN ST", "STE 200")),
+    ("123 Main St Unit #A-1", ("123 MAIN ST", "UNIT A-1")),
+    ("123 Main St Rear", ("123 MAIN ST", "REAR")),
+    ("123 Harbor Key Dr", ("123 HARBOR KEY DR", "")),
+    ("12 Lot Rd", ("12 LOT RD", "")),
+    ("500 N Front St", ("500 N FRONT ST", "")),
+    ("77 O'Neil Boulevard", ("77 ONEIL BLVD", "")),
+    ("", ("", "")),
+]
+
+
+def bench_addresses(args):
+    """Check the address normalizer against ADDRESS_GOLDEN and report address_keys() throughput on distinct addresses."""
+    import addresses
+
+    failures = 0
+    for text, expected in ADDRESS_GOLDEN:
+        got = addresses.split_unit(text)
+        if got != expected:
+            failures += 1
+            print(f"FAIL {text!r}: expected {expected}, got {got}")
+    same = {addresses.address_key(*row) for row in [("4529 Winona Court", "Unit 2b", "80212-1234"), ("4529 winona ct #2B", "", "80212"),
+                                                     ("4529 Winona Ct., Apt 2B", None, "80212")]}
+    if same != {"4529 WINONA CT|80212|2B"}:
+        failures += 1
+        print(f"FAIL address_key spellings of one unit gave {sorted(same)}")
+    print(f"golden: {len(ADDRESS_GOLDEN) + 1 - failures}/{len(ADDRESS_GOLDEN) + 1} ok")
+
+    rng = random.Random(3)
+    names = ['Main', 'Winona', 'Oak', 'Maple', 'Pennsylvania', 'Federal', 'Sheridan', 'Lowell', 'Tennyson', 'Zuni']
+    suffixes = ['Street', 'St.', 'Avenue', 'Ave', 'Court', 'Ct', 'Drive', 'Blvd', 'Way', 'Place']
+    rows = []
+    for _ in range(args.addresses):
+        street = f"{rng.randrange(1, 20000)} {rng.choice(['', '', 'North ', 'W. '])}{rng.choice(names)} {rng.choice(suffixes)}"
+        if rng.random() < 0.2:
+            street += f" Apt {rng.randrange(1, 400)}"
+        rows.append((street, rng.choice([None, None, None, 'Unit 2', '#3B']), f"802{rng.randrange(100):02d}"))
+    for _ in range(args.rounds):
+        started = time.perf_counter()
+        addresses.address_keys(rows)
+        elapsed = time.perf_counter() - started
+        print(f"address_keys: {len(rows) / elapsed:,.0f} addresses/s ({elapsed / len(rows) * 1e6:.2f} us each)")
+    if failures:
+        raise SystemExit(f"{failures} address normalization case(s) failed")
+
+
+def reference_valuation(grid, rates):
+    """Indicated values computed comp by comp in plain Python, as a check on (and baseline for) valuation.adjust."""
+    import valuation
+
+    rates = valuation.rate_vector(rates).tolist()
+    subjects, comps, prices = grid.subjects.tolist(), grid.comps.tolist(), grid.prices.tolist()
+    values = []
+    for subject, file_comps, file_prices in zip(subjects, comps, prices):
+        total_weight = total = 0.0
+        for comp, price in zip(file_comps, file_prices):
+            if not price > 0:
+                continue
+            lines = [(s - c) * rate for s, c, rate in zip(subject, comp, rates)]
+            lines = [line for line in lines if line == line]  # Missing features are not adjusted
+            weight = 1.0 / (sum(abs(line) for line in lines) / price + valuation.WEIGHT_FLOOR)
+            total_weight += weight
+            total += weight * (price + sum(lines))
+        values.append(total / total_weight if total_weight else float('nan'))
+    return values
+
+
+def bench_valuation(args):
+    """Value batches of files from the database with valuation.py and compare against a plain-Python loop."""
+    import valuation
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = build_synthetic_db(os.path.join(tmpdir, 'valuation.db'), args.files, 'normalized', max_comps=args.comps)
+        # The synthetic subjects only carry GLA, beds and year built; give them the other adjusted features
+        conn.execute("""
+            UPDATE valuator_data SET subject_full_baths = 1 + abs(random()) % 3, subject_half_baths = abs(random()) % 2,
+                                     subject_site_size = 2000 + abs(random()) % 10000, subject_garage = (1 + abs(random()) % 3) || ' Car',
+                                     subject_condition = 'C' || (2 + abs(random()) % 4), subject_view = 'N;Res;'
+        """)
+        conn.commit()
+        file_numbers = [f"F{i:07d}" for i in range(args.files)]
+        rates = {'gla': 55}
+
+        for start in range(0, args.files, args.batch):
+            batch = file_numbers[start:start + args.batch]
+            started = time.perf_counter()
+            grid = valuation.load_grid(conn, batch)
+            loaded = time.perf_counter()
+            adjusted = valuation.adjust(grid, rates)
+            computed = time.perf_counter()
+            valuation.results(grid, adjusted)
+            finished = time.perf_counter()
+            reference = reference_valuation(grid, rates)
+            python_time = time.perf_counter() - finished
+
+            mismatches = sum(1 for got, want in zip(adjusted['indicated'].tolist(), reference)
+                             if not (got == want or abs(got - want) <= 0.01 or (got != got and want != want)))
+            comps = int(adjusted['sold'].sum())
+            print(f"{len(batch)} files, {comps} comps: load {(loaded - started) * 1e3:7.1f} ms  adjust {(computed - loaded) * 1e3:6.1f} ms  "
+                  f"to JSON {(finished - computed) * 1e3:6.1f} ms  | python loop {python_time * 1e3:7.1f} ms "
+                  f"({python_time / (computed - loaded):.0f}x slower)  mismatches: {mismatches}")
+            if mismatches:
+                raise SystemExit(f"{mismatches} indicated values differ from the plain-Python computation")
+        conn.close()
+
+
+def bench_suggest(args):
+    """Time comp suggestions: first load, searches and incremental refreshes, with rankings checked against a plain scan."""
+    import spatial
+    import suggest
+    import valuation
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = build_synthetic_db(os.path.join(tmpdir, 'suggest.db'), args.files, 'normalized', max_comps=args.comps)
+        suggest.create_sale_changes(conn)
+        # Scatter sales over a metro-sized area (about 40 x 35 miles) and the last 18 months
+        conn.create_function('jitter', 2, lambda low, high, rng=random.Random(4): rng.uniform(low, high))
+        conn.execute("""
+            UPDATE valuator_data SET latitude = jitter(39.5, 40.1), longitude = jitter(-105.3, -104.6),
+                                     subject_sale_price = 200000 + abs(random()) % 700000,
+                                     subject_sale_date = date('now', '-' || (abs(random()) % 540) || ' days')
+        """)
+        conn.execute("""
+            UPDATE comparables SET latitude = jitter(39.5, 40.1), longitude = jitter(-105.3, -104.6),
+                                   sale_date = date('now', '-' || (abs(random()) % 540) || ' days')
+        """)
+        conn.commit()
+
+        index = suggest.sale_index
+        started = time.perf_counter()
+        index.refresh(conn)
+        print(f"loaded {index.stats()['sales']} sales in {(time.perf_counter() - started) * 1e3:.0f} ms")
+
+        rng = random.Random(5)
+        file_numbers = [f"F{rng.randrange(args.files):07d}" for _ in range(args.samples)]
+        timings, found = [], 0
+        for file_number in file_numbers:
+            started = time.perf_counter()
+            found += len(suggest.suggest_comps(conn, file_number, args.k, args.radius, args.months))
+            timings.append(time.perf_counter() - started)
+        print(f"suggest  k={args.k} {args.radius} mi {args.months} mo  p50: {percentile(timings, 50) * 1e3:6.2f} ms  "
+              f"p99: {percentile(timings, 99) * 1e3:6.2f} ms  ({found / len(file_numbers):.1f} suggestions per file)")
+
+        # Saves between searches: each search first reloads the files changed since the last one
+        timings = []
+        for file_number in file_numbers[:args.saves]:
+            file_id = int(file_number[1:]) + 1
+            conn.execute("UPDATE comparables SET sale_price = sale_price + 1000 WHERE file_id = ?", (file_id,))
+            conn.execute("UPDATE valuator_data SET subject_gla = subject_gla + 10 WHERE id = ?", (file_id,))
+            conn.commit()
+            started = time.perf_counter()
+            suggest.suggest_comps(conn, file_number, args.k, args.radius, args.months)
+            timings.append(time.perf_counter() - started)
+        print(f"after a save         p50: {percentile(timings, 50) * 1e3:6.2f} ms  p99: {percentile(timings, 99) * 1e3:6.2f} ms  "
+              f"(index stats: {index.stats()})")
+
+        # Same ranking from a plain-Python scan over every sale in the database
+        rows = conn.execute(suggest.SALES_SQL.format(subject_filter='', comp_filter='')).fetchall()
+        features = valuation.feature_matrix(rows, offset=12).tolist()
+        rates = valuation.rate_vector().tolist()
+        today = suggest.date.today().toordinal()
+        window = args.months * suggest.DAYS_PER_MONTH
+        mismatches = 0
+        for file_number in file_numbers[:args.check_samples]:
+            subject = conn.execute(suggest.SUBJECT_SQL, (file_number,)).fetchone()
+            subject_features = valuation.feature_matrix([subject], offset=6)[0].tolist()
+            scored = []
+            for row, candidate in zip(rows, features):
+                if row[0] // spatial.LOCATION_SLOTS == subject[0]:
+                    continue
+                distance = spatial.haversine_miles(subject[1], subject[2], row[10], row[11])
+                age = today - suggest.sale_day(row[9])
+                if distance > args.radius or not 0 <= age <= window:
+                    continue
+                gross = sum(abs(s - c) * rate for s, c, rate in zip(subject_features, candidate, rates) if s == s and c == c)
+                missing = sum(1 for s, c in zip(subject_features, candidate) if s == s and c != c)
+                scored.append(gross / row[8] + suggest.SUGGEST_DISTANCE_COST * distance / args.radius
+                              + suggest.SUGGEST_AGE_COST * age / window + suggest.SUGGEST_MISSING_COST * missing)
+            expected = [round(value, 4) for value in sorted(scored)[:args.k]]
+            got = [suggestion['score'] for suggestion in suggest.suggest_comps(conn, file_number, args.k, args.radius, args.months)]
+            mismatches += any(abs(a - b) > 1e-4 for a, b in zip(got, expected)) or len(got) != len(expected)
+        print(f"checked {args.check_samples} rankings against a plain scan: {mismatches} mismatches")
+        if mismatches:
+            raise SystemExit(f"{mismatches} rankings differ from the plain-Python scan")
+        conn.close()
+
+
+def bench_market_rates(args):
+    """Fit market rates to synthetic sales priced from known per-ZIP rates; time full and incremental updates and lookups."""
+    import market_rates
+    import suggest
+    import valuation
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = build_synthetic_db(os.path.join(tmpdir, 'market.db'), args.files, 'normalized', max_comps=args.comps)
+        suggest.create_sale_changes(conn)
+        market_rates.create_market_rates_tables(conn)
+        conn.execute("""
+            UPDATE valuator_data SET subject_full_baths = 1 + abs(random()) % 3, subject_half_baths = abs(random()) % 2,
+                                     subject_site_size = 2000 + abs(random()) % 10000
+        """)
+
+        # Price every sale from its file's ZIP rates, a per-file location premium, a market trend and noise
+        rng = random.Random(6)
+        today = suggest.date.today().toordinal()
+        zips = sorted({row[0] for row in conn.execute("SELECT zip FROM valuator_data")})
+        true_rates = {zip_code: {'gla': 40 + 3 * n % 30, 'beds': 4000, 'full_baths': 8000, 'half_baths': 3000, 'year_built': 500, 'site_size': 1.5}
+                      for n, zip_code in enumerate(zips)}
+        columns = [valuation.FEATURES.index(name) for name in market_rates.FIT_FEATURES]
+        zip_of = dict(conn.execute("SELECT id, zip FROM valuator_data"))
+        premium = {file_id: rng.gauss(250000, 60000) for file_id in zip_of}
+
+        def priced(rows, offset):
+            """(price, sale date) for each (file_id, ...) row, its features from index offset on."""
+            sales = []
+            for row, features in zip(rows, valuation.feature_matrix(rows, offset)[:, columns].tolist()):
+                rates, age = true_rates[zip_of[row[0]]], rng.randrange(0, 540)
+                value = premium[row[0]] + sum(rates[name] * x for name, x in zip(market_rates.FIT_FEATURES, features)) - 30 * age
+                sales.append((round(value + rng.gauss(0, args.noise)), suggest.date.fromordinal(today - age).isoformat()))
+            return sales
+
+        subjects = conn.execute(f"SELECT id, {suggest.SUBJECT_FEATURE_COLUMNS} FROM valuator_data").fetchall()
+        conn.executemany("UPDATE valuator_data SET subject_sale_price = ?, subject_sale_date = ? WHERE id = ?",
+                         [(*sale, row[0]) for row, sale in zip(subjects, priced(subjects, 1))])
+        comps = conn.execute(f"SELECT file_id, slot, {suggest.COMP_FEATURE_COLUMNS} FROM comparables").fetchall()
+        conn.executemany("UPDATE comparables SET sale_price = ?, sale_date = ? WHERE file_id = ? AND slot = ?",
+                         [(*sale, row[0], row[1]) for row, sale in zip(comps, priced(comps, 2))])
+        conn.commit()
+
+        started = time.perf_counter()
+        fitted = market_rates.update_market_rates(conn)
+        full_time = time.perf_counter() - started
+        results = {area: json.loads(rates) for area, rates in conn.execute("SELECT area, rates FROM market_rates WHERE rates IS NOT NULL AND area LIKE 'zip:%'")}
+        errors = [abs(rates.get('gla', 0) - true_rates[area[4:]]['gla']) for area, rates in results.items()]
+        print(f"full fit: {fitted} areas ({len(results)} ZIPs with rates) in {full_time * 1e3:.0f} ms  "
+              f"GLA rate error median {percentile(errors, 50):.2f} max {max(errors):.2f} $/sqft")
+        sample = sorted(results)[0]
+        print(f"  {sample}: fitted {results[sample]}  true {true_rates[sample[4:]]}")
+
+        # A few saves: only areas whose changed-file count reaches MARKET_RATES_REFIT_FILES are refitted
+        for rounds in range(args.rounds):
+            file_ids = rng.sample(sorted(zip_of), args.changed)
+            conn.executemany("UPDATE comparables SET sale_price = sale_price + 1 WHERE file_id = ?", [(file_id,) for file_id in file_ids])
+            conn.commit()
+            started = time.perf_counter()
+            fitted = market_rates.update_market_rates(conn)
+            print(f"after {args.changed} changed files: refitted {fitted} areas in {(time.perf_counter() - started) * 1e3:.0f} ms")
+
+        file_numbers = [f"F{i:07d}" for i in rng.sample(range(args.files), min(1000, args.files))]
+        started = time.perf_counter()
+        found = market_rates.rates_for_files(conn, file_numbers)
+        print(f"rate lookup for {len(file_numbers)} files: {(time.perf_counter() - started) * 1e3:.1f} ms ({len(found)} with market rates)")
+        if max(errors) > args.tolerance:
+            raise SystemExit(f"A fitted GLA rate is off by more than {args.tolerance} $/sqft")
+        conn.close()
+
+
+def bench_upstream(args):
+    """Load-test /get-lat-lng and form_step1 + ATTOM enrichment offline against fake_upstream.py."""
+    import fake_upstream
+
+    profile = fake_upstream.UpstreamProfile(args.latency_ms, args.latency_sd_ms, args.error_rate, args.throttle_rate,
+                                            args.not_found_rate, seed=args.seed)
+    server = fake_upstream.serve(profile=profile)
+    base = f"http://127.0.0.1:{server.server_port}"
+    os.environ.update({
+        'ATTOM_BASE_URL': base + fake_upstream.ATTOM_PATH, 'GOOGLE_GEOCODE_URL': base + fake_upstream.GEOCODE_PATH,
+        'ATTOM_API_KEY': 'offline', 'GOOGLE_GEOCODING_API_KEY': 'offline', 'JOB_BACKOFF_SECONDS': '0.2',
+        'GEOCODE_RATE_LIMIT': str(args.geocode_rate_limit),
+    })
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)  # app.py keeps its databases in the working directory
+        try:
+            import app as valuator_app
+            import jobs
+            with valuator_app.app.app_context():
+                valuator_app.init_db()
+            _bench_upstream(args, valuator_app, jobs.runner)
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+    print(f"fake upstream requests: {profile.counts}")
+
+
+def _bench_upstream(args, valuator_app, runner):
+    import geocode
+
+    rng = random.Random(args.seed)
+    addresses = [f"{rng.randrange(1, 9999)} {rng.choice(['ELM', 'OAK', 'PINE', 'MAPLE', 'CEDAR'])} ST" for _ in range(args.requests)]
+
+    def client():
+        test_client = valuator_app.app.test_client()
+        with test_client.session_transaction() as session:
+            session['user_id'] = 1
+        return test_client
+
+    latencies = []
+    clients = [client() for _ in range(args.threads)]
+    started = time.perf_counter()
+
+    def geocode_unique(n):
+        for address in addresses[n::args.threads]:
+            request_started = time.perf_counter()
+            clients[n].post('/get-lat-lng', json={'address': f"{address}, DENVER, CO"})
+            latencies.append(time.perf_counter() - request_started)
+
+    threads = [threading.Thread(target=geocode_unique, args=(n,)) for n in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    print(f"/get-lat-lng  {len(latencies) / elapsed:7.0f} req/s  p50: {percentile(latencies, 50) * 1e3:7.2f} ms  p99: {percentile(latencies, 99) * 1e3:7.2f} ms")
+
+    # Repeat lookups of the same addresses are answered from the geocode cache without calling Google
+    cache = geocode.geocode_cache
+    latencies.clear()
+    hits = cache.memory_hits + cache.db_hits
+    for address in addresses:
+        request_started = time.perf_counter()
+        clients[0].post('/get-lat-lng', json={'address': f"{address}, DENVER, CO"})
+        latencies.append(time.perf_counter() - request_started)
+    print(f"/get-lat-lng repeat  p50: {percentile(latencies, 50) * 1e3:7.3f} ms  p99: {percentile(latencies, 99) * 1e3:7.3f} ms  "
+          f"cache hits: {cache.memory_hits + cache.db_hits - hits}/{len(addresses)}")
+
+    # Hot addresses: every thread geocodes the same few addresses at once, as when a subdivision's files are opened together
+    hot = [f"{n} HOT SPRINGS RD, DENVER, CO" for n in range(args.hot_addresses)]  # Not geocoded yet
+    before = valuator_app.geocode_flight.stats()
+
+    def geocode_hot(n):
+        for i in range(args.requests // args.threads):
+            clients[n].post('/get-lat-lng', json={'address': hot[(i + n) % len(hot)]})
+
+    threads = [threading.Thread(target=geocode_hot, args=(n,)) for n in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    after = valuator_app.geocode_flight.stats()
+    calls, coalesced = after['calls'] - before['calls'], after['coalesced'] - before['coalesced']
+    print(f"/get-lat-lng over {len(hot)} hot addresses: {args.requests // args.threads * args.threads} requests, "
+          f"{calls} upstream calls, {coalesced} coalesced, the rest cache hits")
+
+    latencies.clear()
+    started = time.perf_counter()
+
+    def submit(n):
+        for i in range(n, len(addresses), args.threads):
+            request_started = time.perf_counter()
+            clients[n].post('/form-step1', data={'file_number': f"B{i:06d}", 'address': addresses[i], 'city': 'DENVER', 'state': 'CO', 'zip': '80212'})
+            latencies.append(time.perf_counter() - request_started)
+
+    threads = [threading.Thread(target=submit, args=(n,)) for n in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(f"/form-step1   {len(latencies) / (time.perf_counter() - started):7.0f} req/s  p50: {percentile(latencies, 50) * 1e3:7.2f} ms  p99: {percentile(latencies, 99) * 1e3:7.2f} ms")
+
+    with db.connection() as conn:
+        while conn.execute("SELECT count(*) FROM jobs WHERE status IN ('pending', 'running')").fetchone()[0]:
+            time.sleep(0.05)
+        outcomes = dict(conn.execute("SELECT COALESCE(result, status), count(*) FROM jobs GROUP BY 1").fetchall())
+    print(f"ATTOM enrichment for {len(addresses)} files finished {time.perf_counter() - started:.1f}s after the first submit: {outcomes}")
+
+    # Comp enrichment: uncached comps per file, looked up in parallel; compare with --latency-ms for one call
+    latencies.clear()
+    for i in range(min(args.comp_files, len(addresses))):
+        comps = [{'slot': slot, 'address': f"{rng.randrange(1, 9999)} COMP {i} ST", 'city': 'DENVER', 'state': 'CO', 'zip': '80212'}
+                 for slot in range(1, args.comps + 1)]
+        request_started = time.perf_counter()
+        clients[0].post('/api/comp-data/enrich', json={'file_number': f"B{i:06d}", 'comps': comps})
+        latencies.append(time.perf_counter() - request_started)
+    if latencies:
+        print(f"/api/comp-data/enrich  {args.comps} comps  p50: {percentile(latencies, 50) * 1e3:7.2f} ms  p99: {percentile(latencies, 99) * 1e3:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the valuator database and service layers.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('connections', help=bench_connections.__doc__)
+    p.add_argument('--rows', type=int, default=10000)
+    p.add_argument('--threads', type=int, default=8)
+    p.add_argument('--seconds', type=float, default=3.0)
+    p.add_argument('--write-ratio', type=float, default=0.1)
+    p.set_defaults(func=bench_connections)
+
+    p = subparsers.add_parser('comparables', help=bench_comparables.__doc__)
+    p.add_argument('--files', type=int, default=100000, help="Number of synthetic files (use 1000000 for the full comparison)")
+    p.add_argument('--samples', type=int, default=2000)
+    p.set_defaults(func=bench_comparables)
+
+    p = subparsers.add_parser('plans', help=bench_plans.__doc__)
+    p.add_argument('--files', type=int, default=5000)
+    p.set_defaults(func=bench_plans)
+
+    p = subparsers.add_parser('subject-batch', help=bench_subject_batch.__doc__)
+    p.add_argument('--files', type=int, default=100000)
+    p.add_argument('--batch', type=int, default=500)
+    p.set_defaults(func=bench_subject_batch)
+
+    p = subparsers.add_parser('search', help=bench_search.__doc__)
+    p.add_argument('--files', type=int, default=100000, help="Number of synthetic files (use 1000000 for the full comparison)")
+    p.add_argument('--samples', type=int, default=200)
+    p.set_defaults(func=bench_search)
+
+    p = subparsers.add_parser('nearby', help=bench_nearby.__doc__)
+    p.add_argument('--files', type=int, default=250000, help="Number of synthetic files, each with up to 3 comps")
+    p.add_argument('--radius', type=float, default=1.0, help="Search radius in miles")
+    p.add_argument('--samples', type=int, default=500)
+    p.add_argument('--scan-samples', type=int, default=3)
+    p.set_defaults(func=bench_nearby)
+
+    p = subparsers.add_parser('writes', help=bench_writes.__doc__)
+    p.add_argument('--files', type=int, default=20000)
+    p.add_argument('--writers', type=int, default=50)
+    p.add_argument('--seconds', type=float, default=5.0)
+    p.set_defaults(func=bench_writes)
+
+    p = subparsers.add_parser('attom-parse', help=bench_attom_parse.__doc__)
+    p.add_argument('--records', type=int, default=100000)
+    p.add_argument('--distinct', type=int, default=1000)
+    p.add_argument('--pagesize', type=int, default=10)
+    p.add_argument('--sparse', type=float, default=0.2, help="Fraction of records missing two sections")
+    p.add_argument('--rounds', type=int, default=3)
+    p.set_defaults(func=bench_attom_parse)
+
+    p = subparsers.add_parser('addresses', help=bench_addresses.__doc__)
+    p.add_argument('--addresses', type=int, default=200000)
+    p.add_argument('--rounds', type=int, default=3)
+    p.set_defaults(func=bench_addresses)
+
+    p = subparsers.add_parser('valuation', help=bench_valuation.__doc__)
+    p.add_argument('--files', type=int, default=30000)
+    p.add_argument('--batch', type=int, default=10000, help="Files valued per call")
+    p.add_argument('--comps', type=int, default=6, help="Most comps per file")
+    p.set_defaults(func=bench_valuation)
+
+    p = subparsers.add_parser('suggest', help=bench_suggest.__doc__)
+    p.add_argument('--files', type=int, default=30000)
+    p.add_argument('--comps', type=int, default=4, help="Most comps per file")
+    p.add_argument('--samples', type=int, default=500)
+    p.add_argument('--saves', type=int, default=200, help="Searches that each follow a save")
+    p.add_argument('--check-samples', type=int, default=20)
+    p.add_argument('--k', type=int, default=6)
+    p.add_argument('--radius', type=float, default=1.0)
+    p.add_argument('--months', type=int, default=12)
+    p.set_defaults(func=bench_suggest)
+
+    p = subparsers.add_parser('market-rates', help=bench_market_rates.__doc__)
+    p.add_argument('--files', type=int, default=30000)
+    p.add_argument('--comps', type=int, default=4, help="Most comps per file")
+    p.add_argument('--noise', type=float, default=5000.0, help="Sale price noise, standard deviation in $")
+    p.add_argument('--rounds', type=int, default=3)
+    p.add_argument('--changed', type=int, default=200, help="Files changed between incremental updates")
+    p.add_argument('--tolerance', type=float, default=5.0, help="Largest acceptable GLA rate error in $/sqft")
+    p.set_defaults(func=bench_market_rates)
+
+    p = subparsers.add_parser('upstream', help=bench_upstream.__doc__)
+    p.add_argument('--requests', type=int, default=400)
+    p.add_argument('--threads', type=int, default=8)
+    p.add_argument('--latency-ms', type=float, default=80.0)
+    p.add_argument('--latency-sd-ms', type=float, default=20.0)
+    p.add_argument('--error-rate', type=float, default=0.02)
+    p.add_argument('--throttle-rate', type=float, default=0.01)
+    p.add_argument('--not-found-rate', type=float, default=0.05)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--geocode-rate-limit', type=float, default=0, help="Google calls per second to allow (0 = unlimited, to time the app itself)")
+    p.add_argument('--hot-addresses', type=int, default=4, help="Addresses shared by all threads in the coalescing stage")
+    p.add_argument('--comp-files', type=int, default=50, help="Files whose comps are enriched in one request each")
+    p.add_argument('--comps', type=int, default=3, help="Comps per enrichment request")
+    p.set_defaults(func=bench_upstream)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
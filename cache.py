@@ -0,0 +1,142 @@
+#!/home/dh_kfekwx/bin/python3
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import db
+from writer import get_writer
+
+_MISSING = object()
+CACHE_PURGE_EVERY = 1000  # Expired rows of a namespace are deleted after this many writes to it
+
+
+def create_cache_table(conn):
+    """Create the shared api_cache table; value is JSON, or NULL for a cached "no result"."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS api_cache (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID
+    ''')
+
+
+class PersistentCache:
+    """TTL cache for upstream API responses, persisted in SQLite and fronted by a per-process LRU.
+
+    get() checks the LRU, then the api_cache table, and returns the cached value (None for a cached
+    "no result") or MISSING. Writes to SQLite go through the single-writer queue without waiting, so
+    filling the cache never adds a commit to the caller's latency.
+    """
+
+    MISSING = _MISSING
+
+    def __init__(self, namespace, ttl, negative_ttl, lru_size, db_name=db.VALUATOR_DB):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lru_size = lru_size
+        self.db_name = db_name
+        self._lru = OrderedDict()  # key -> (expires_at, value, size in bytes)
+        self._lock = threading.Lock()
+        self._table_ready = False
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.bytes_served = 0  # Response bytes answered from the cache instead of the upstream
+        self.writes = 0
+
+    def _ensure_table(self):
+        if not self._table_ready:
+            with db.connection(self.db_name) as conn:
+                create_cache_table(conn)
+                conn.commit()
+            self._table_ready = True
+
+    def _remember(self, key, expires_at, value, size):
+        with self._lock:
+            self._lru[key] = (expires_at, value, size)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def _count_hit(self, value, size):
+        if value is None:
+            self.negative_hits += 1
+        self.bytes_served += size
+
+    def get(self, key):
+        """Return the cached value for key, None for a cached "no result", or MISSING."""
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._lru.move_to_end(key)
+                    self.memory_hits += 1
+                    self._count_hit(entry[1], entry[2])
+                    return entry[1]
+                del self._lru[key]
+
+        self._ensure_table()
+        with db.connection(self.db_name) as conn:
+            row = conn.execute("SELECT value, expires_at FROM api_cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+                               (self.namespace, key, now)).fetchone()
+        if row is None:
+            self.misses += 1
+            return _MISSING
+        text, expires_at = row
+        value = None if text is None else json.loads(text)
+        size = len(text or '')
+        self._remember(key, expires_at, value, size)
+        self.db_hits += 1
+        self._count_hit(value, size)
+        return value
+
+    def set(self, key, value):
+        """Cache value (None caches a "no result" with the shorter negative TTL)."""
+        text = None if value is None else json.dumps(value, separators=(',', ':'))
+        expires_at = time.time() + (self.negative_ttl if value is None else self.ttl)
+        self._remember(key, expires_at, value, len(text or ''))
+        self._ensure_table()
+        writer = get_writer(self.db_name)
+        writer.submit(self._store, key, text, expires_at)
+        self.writes += 1
+        if self.writes % CACHE_PURGE_EVERY == 0:
+            writer.submit(self.purge_expired)
+
+    def _store(self, conn, key, text, expires_at):
+        conn.execute("INSERT OR REPLACE INTO api_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                     (self.namespace, key, text, expires_at))
+
+    def purge_expired(self, conn):
+        """Delete expired rows of this namespace; returns how many were removed."""
+        return conn.execute("DELETE FROM api_cache WHERE namespace = ? AND expires_at <= ?", (self.namespace, time.time())).rowcount
+
+    def stats(self, conn):
+        """Hit/miss counters for this process plus entry counts and stored bytes from SQLite."""
+        self._ensure_table()
+        entries, negative, stored = conn.execute('''
+            SELECT count(*), count(*) - count(value), COALESCE(sum(length(value)), 0)
+            FROM api_cache WHERE namespace = ? AND expires_at > ?
+        ''', (self.namespace, time.time())).fetchone()
+        hits = self.memory_hits + self.db_hits
+        lookups = hits + self.misses
+        return {
+            'hits': hits,
+            'memory_hits': self.memory_hits,
+            'db_hits': self.db_hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'hit_rate': round(hits / lookups, 4) if lookups else None,
+            'bytes_served': self.bytes_served,
+            'entries': entries,
+            'negative_entries': negative,
+            'bytes_stored': stored,
+            'memory_entries': len(self._lru),
+        }
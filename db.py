@@ -0,0 +1,428 @@
+#!/home/dh_kfekwx/bin/python3
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from flask import g, has_app_context
+
+from addresses import address_keys
+
+VALUATOR_DB = 'valuator.db'
+USERS_DB = 'users.db'
+
+# Pragmas applied once when a pooled connection is opened, tunable per deployment through the environment.
+# journal_mode=WAL lets readers keep going while a single writer commits, which is what removes most "database is locked" errors.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-16000')),  # Negative values are KiB, so ~16MB of page cache
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(64 * 1024 * 1024))),
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+
+
+def open_connection(db_name):
+    """Open a new SQLite connection with the configured pragmas and busy timeout."""
+    conn = sqlite3.connect(db_name, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    for name, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value};")
+    return conn
+
+
+class ConnectionPool:
+    """Per-worker pool of ready-to-use connections to one database file."""
+
+    def __init__(self, db_name, size=SQLITE_POOL_SIZE):
+        self.db_name = db_name
+        self.size = size
+        self.opened = 0
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _check_fork(self):
+        # Connections must never cross a fork, so a forked worker starts with an empty pool.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle = queue.LifoQueue(maxsize=self.size)
+                    self._pid = os.getpid()
+                    self.opened = 0
+
+    def acquire(self):
+        """Check out an idle connection, opening a new one if none is free."""
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.opened += 1
+            return open_connection(self.db_name)
+
+    def release(self, conn):
+        """Return a connection to the pool, rolling back anything left uncommitted."""
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        """Close every idle connection."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_name):
+    """Return the pool for db_name, creating it on first use."""
+    pool = _pools.get(db_name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(db_name, ConnectionPool(db_name))
+    return pool
+
+
+@contextmanager
+def connection(db_name=VALUATOR_DB):
+    """Borrow a pooled connection outside of a request (startup, scripts, background threads)."""
+    pool = get_pool(db_name)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+@contextmanager
+def transaction(conn):
+    """Run a write block under BEGIN IMMEDIATE so the write lock is taken up front instead of on upgrade."""
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def get_db(db_name=VALUATOR_DB):
+    """Return the connection scoped to the current app context, checking it out of the pool on first use."""
+    if not has_app_context():
+        raise RuntimeError("get_db() needs an app context; use db.connection() outside of requests.")
+    conns = g.setdefault('_db_connections', {})
+    conn = conns.get(db_name)
+    if conn is None:
+        conn = conns[db_name] = get_pool(db_name).acquire()
+    return conn
+
+
+def close_db(exception=None):
+    """Hand every connection used by this app context back to its pool."""
+    conns = g.pop('_db_connections', {})
+    for db_name, conn in conns.items():
+        get_pool(db_name).release(conn)
+
+
+def init_app(app):
+    """Register the teardown that returns connections to the pool."""
+    app.teardown_appcontext(close_db)
+
+
+def create_valuator_table(conn):
+    """Create valuator_data, one row per file holding the subject property.
+
+    address_key (see addresses.address_key) is indexed to find files for the same property; databases created
+    before it existed get the column added in place and filled by backfill_address_keys().
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS valuator_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_number TEXT UNIQUE NOT NULL,
+            address TEXT,
+            unit TEXT,
+            city TEXT,
+            state TEXT,
+            zip TEXT,
+            latitude REAL,
+            longitude REAL,
+            property_type TEXT,
+            borrower_name TEXT,
+            county TEXT,
+            parcel_number TEXT,
+            subject_data_source TEXT,
+            subject_mls TEXT,
+            subject_original_list_price REAL,
+            subject_original_list_date TEXT,
+            subject_sale_price REAL,
+            subject_sale_date TEXT,
+            subject_cdom INTEGER,
+            subject_site_size REAL,
+            subject_location TEXT,
+            subject_view TEXT,
+            subject_year_built INTEGER DEFAULT NULL,
+            subject_des_style TEXT,
+            subject_condition TEXT,
+            subject_beds INTEGER,
+            subject_full_baths INTEGER,
+            subject_half_baths INTEGER,
+            subject_gla REAL,
+            subject_basement TEXT,
+            subject_garage TEXT,
+            additional_comments TEXT,
+            address_key TEXT
+        )
+    ''')
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(valuator_data);")}
+    if 'address_key' not in existing:
+        conn.execute("ALTER TABLE valuator_data ADD COLUMN address_key TEXT;")
+    conn.execute("CREATE INDEX IF NOT EXISTS valuator_data_address_key ON valuator_data (address_key);")
+
+
+def backfill_address_keys(conn, batch_size=5000):
+    """Fill address_key for files saved without one, in short batches; returns the number of files keyed.
+
+    Files without a street keep a NULL key. The address_key index serves the IS NULL scan, so once
+    every file is keyed a run costs one index probe.
+    """
+    keyed = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, address, unit, zip FROM valuator_data WHERE address_key IS NULL AND id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return keyed
+        last_id = rows[-1][0]
+        updates = [(key, row[0]) for key, row in zip(address_keys((row[1], row[2], row[3]) for row in rows), rows) if key]
+        with transaction(conn):
+            conn.executemany("UPDATE valuator_data SET address_key = ? WHERE id = ?", updates)
+        keyed += len(updates)
+
+
+# Per-comparable fields, stored once per (file_id, slot) row in `comparables`.
+# Older databases carried these as comp1_*/comp2_*/comp3_* columns on valuator_data.
+COMP_COLUMNS = [
+    ('address', 'TEXT'),
+    ('unit', 'TEXT'),
+    ('city', 'TEXT'),
+    ('state', 'TEXT'),
+    ('zip', 'TEXT'),
+    ('data_source', 'TEXT'),
+    ('mls', 'TEXT'),
+    ('original_list_price', 'REAL'),
+    ('original_list_date', 'TEXT'),
+    ('sale_price', 'REAL'),
+    ('sale_date', 'TEXT'),
+    ('cdom', 'INTEGER'),
+    ('site_size', 'REAL'),
+    ('location', 'TEXT'),
+    ('view', 'TEXT'),
+    ('year_built', 'INTEGER DEFAULT NULL'),
+    ('des_style', 'TEXT'),
+    ('condition', 'TEXT'),
+    ('beds', 'INTEGER'),
+    ('full_baths', 'INTEGER'),
+    ('half_baths', 'INTEGER'),
+    ('gla', 'REAL'),
+    ('basement', 'TEXT'),
+    ('garage', 'TEXT'),
+]
+COMP_FIELDS = [name for name, _ in COMP_COLUMNS]
+# Comp coordinates are kept out of COMP_COLUMNS: they are not form fields and never existed in the legacy comp{n}_* layout.
+COMP_LOCATION_COLUMNS = [('latitude', 'REAL'), ('longitude', 'REAL')]
+LEGACY_COMP_SLOTS = (1, 2, 3)
+COMPARABLES_MIGRATED_VERSION = 1  # PRAGMA user_version once legacy comps have been copied
+
+
+def create_comparables_table(conn):
+    """Create the comparables child table; one row per comp, clustered by file so a file's comps share pages.
+
+    Databases created before comps had coordinates get the latitude/longitude columns added in place.
+    """
+    columns = ',\n            '.join(f"{name} {col_type}" for name, col_type in COMP_COLUMNS + COMP_LOCATION_COLUMNS)
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS comparables (
+            file_id INTEGER NOT NULL REFERENCES valuator_data(id) ON DELETE CASCADE,
+            slot INTEGER NOT NULL,
+            {columns},
+            PRIMARY KEY (file_id, slot)
+        ) WITHOUT ROWID
+    ''')
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(comparables);")}
+    for name, col_type in COMP_LOCATION_COLUMNS:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE comparables ADD COLUMN {name} {col_type};")
+
+
+def has_legacy_comp_columns(conn):
+    """Return True if valuator_data still carries the wide comp1_*/comp2_*/comp3_* columns."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(valuator_data);")}
+    return 'comp1_address' in columns
+
+
+def migrate_comparables(conn, batch_size=5000):
+    """Copy comps from the legacy wide columns into `comparables`.
+
+    Runs in short id-range batches so request handlers can keep writing in between, and uses
+    INSERT OR IGNORE so an interrupted run can simply be restarted. Once finished it bumps
+    PRAGMA user_version so comps removed later are not copied back. Returns the number copied.
+    """
+    if conn.execute("PRAGMA user_version;").fetchone()[0] >= COMPARABLES_MIGRATED_VERSION:
+        return 0
+    if not has_legacy_comp_columns(conn):
+        conn.execute(f"PRAGMA user_version = {COMPARABLES_MIGRATED_VERSION};")
+        return 0
+
+    columns = ', '.join(COMP_FIELDS)
+    statements = []
+    for slot in LEGACY_COMP_SLOTS:
+        legacy_columns = ', '.join(f"comp{slot}_{name}" for name in COMP_FIELDS)
+        statements.append(f'''
+            INSERT OR IGNORE INTO comparables (file_id, slot, {columns})
+            SELECT id, {slot}, {legacy_columns} FROM valuator_data
+            WHERE id > ? AND id <= ? AND COALESCE(comp{slot}_address, '') != ''
+        ''')
+
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM valuator_data;").fetchone()[0]
+    copied = 0
+    for low in range(0, max_id, batch_size):
+        with transaction(conn):
+            for statement in statements:
+                copied += conn.execute(statement, (low, low + batch_size)).rowcount
+    conn.execute(f"PRAGMA user_version = {COMPARABLES_MIGRATED_VERSION};")
+    return copied
+
+
+# Comparable lookup behind /api/comp-data: the unique file_number index finds the file and the
+# (file_id, slot) primary key finds the comp, so neither table is scanned.
+COMP_LOOKUP_SQL = f'''
+    SELECT {", ".join(f"c.{field}" for field in COMP_FIELDS)}
+    FROM valuator_data v JOIN comparables c ON c.file_id = v.id
+    WHERE v.file_number = ? AND
+          c.slot = ? AND
+          c.address = ? AND
+          c.city = ? AND
+          c.zip = ?
+'''
+
+# Hot-path queries that must always be answered from an index, with sample parameters for EXPLAIN.
+INDEXED_QUERIES = {
+    'file_number lookup': ("SELECT * FROM valuator_data WHERE file_number = ?", ('F0000001',)),
+    'comparables by file': ("SELECT * FROM comparables WHERE file_id = ? ORDER BY slot", (1,)),
+    'comp lookup': (COMP_LOOKUP_SQL, ('F0000001', 1, '1 MAIN ST', 'DENVER', '80212')),
+    'address key lookup': ("SELECT file_number FROM valuator_data WHERE address_key = ?", ('1 MAIN ST|80212|',)),
+    'batch file_number lookup': ("SELECT * FROM valuator_data WHERE file_number IN (SELECT value FROM json_each(?))", ('["F0000001", "F0000002"]',)),
+}
+
+
+def query_plan(conn, sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for sql."""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def full_table_scans(conn, sql, params=()):
+    """Return the plan lines where sql falls back to scanning a whole table (walking a parameter list such as json_each is fine)."""
+    return [detail for detail in query_plan(conn, sql, params) if detail.startswith('SCAN') and 'VIRTUAL TABLE' not in detail]
+
+
+class SchemaRegistry:
+    """Column lists and generated SQL for one database, rebuilt only when PRAGMA schema_version changes.
+
+    Statements are built once per schema version and handed out as identical strings, so sqlite3's
+    per-connection statement cache keeps them prepared. Asking for a column that does not exist
+    raises KeyError instead of silently reading the wrong tuple slot.
+    """
+
+    def __init__(self):
+        self.version = None
+        self._columns = {}
+        self._types = {}
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, conn):
+        """Reload table columns if the schema changed since the last call; returns self."""
+        version = conn.execute("PRAGMA schema_version;").fetchone()[0]
+        if version != self.version:
+            with self._lock:
+                tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")]
+                info = {table: conn.execute(f"PRAGMA table_info({table});").fetchall() for table in tables}
+                self._columns = {table: tuple(row[1] for row in rows) for table, rows in info.items()}
+                self._types = {table: {row[1]: row[2].upper() for row in rows} for table, rows in info.items()}
+                self._statements = {}
+                self.version = version
+        return self
+
+    def columns(self, table):
+        """Return the column names of table in declaration order."""
+        return self._columns[table]
+
+    def types(self, table):
+        """Return {column: declared type} for table."""
+        return self._types[table]
+
+    def _check(self, table, columns):
+        known = self._columns.get(table, ())
+        missing = [column for column in columns if column not in known]
+        if missing:
+            raise KeyError(f"{table} has no column(s): {', '.join(missing)}")
+
+    def _statement(self, key, build):
+        sql = self._statements.get(key)
+        if sql is None:
+            self._check(key[1], key[2])
+            sql = self._statements[key] = build()
+        return sql
+
+    def select(self, table, columns, where, order_by=None):
+        """Return SELECT sql projecting only `columns`."""
+        columns = tuple(columns)
+        suffix = f" ORDER BY {order_by}" if order_by else ""
+        return self._statement(('select', table, columns, where, order_by),
+                               lambda: f"SELECT {', '.join(columns)} FROM {table} WHERE {where}{suffix}")
+
+    def insert(self, table, columns):
+        """Return INSERT sql for `columns`."""
+        columns = tuple(columns)
+        return self._statement(('insert', table, columns),
+                               lambda: f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})")
+
+    def update(self, table, columns, where):
+        """Return UPDATE sql setting `columns`; parameters are the new values followed by the where parameters."""
+        columns = tuple(columns)
+        return self._statement(('update', table, columns, where),
+                               lambda: f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in columns)} WHERE {where}")
+
+    def fetch_one(self, conn, table, columns, where, params):
+        """Return the first matching row as a {column: value} dict, or None."""
+        row = conn.execute(self.select(table, columns, where), params).fetchone()
+        return dict(zip(columns, row)) if row else None
+
+    def fetch_all(self, conn, table, columns, where, params, order_by=None):
+        """Return every matching row as a {column: value} dict."""
+        return [dict(zip(columns, row)) for row in conn.execute(self.select(table, columns, where, order_by), params)]
+
+
+_schemas = {}
+
+
+def get_schema(conn, db_name=VALUATOR_DB):
+    """Return the schema registry for db_name, refreshed against conn."""
+    schema = _schemas.get(db_name)
+    if schema is None:
+        schema = _schemas.setdefault(db_name, SchemaRegistry())
+    return schema.refresh(conn)
@@ -0,0 +1,69 @@
+#!/home/dh_kfekwx/bin/python3
+
+import csv
+import io
+import json
+import zlib
+
+EXPORT_PAGE_SIZE = 2000
+
+
+def export_columns(schema):
+    """Columns of valuator_data to export, leaving out the legacy comp{n}_* columns that are no longer maintained."""
+    return [column for column in schema.columns('valuator_data') if not (column.startswith('comp') and column[4:5].isdigit())]
+
+
+def iter_rows(conn, columns, after=0, limit=None, page_size=EXPORT_PAGE_SIZE):
+    """Yield valuator_data rows with id > after in id order.
+
+    Each page is its own short keyset query (id > last id seen), so no read snapshot is held open
+    for the whole export and writers and WAL checkpoints are never held up by a slow client.
+    """
+    select = f"SELECT {', '.join(columns)} FROM valuator_data WHERE id > ? ORDER BY id LIMIT ?"
+    id_index = columns.index('id')
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        page = conn.execute(select, (after, size)).fetchall()
+        if not page:
+            return
+        yield from page
+        after = page[-1][id_index]
+        if remaining is not None:
+            remaining -= len(page)
+
+
+def ndjson_chunks(columns, rows, rows_per_chunk=500):
+    """Encode rows as newline-delimited JSON objects, buffering a few hundred rows per chunk."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row)), separators=(',', ':')))
+        if len(lines) == rows_per_chunk:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def csv_chunks(columns, rows, rows_per_chunk=500):
+    """Encode rows as CSV with a header line, buffering a few hundred rows per chunk."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % rows_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip a stream of text chunks incrementally."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,208 @@
+#!/home/dh_kfekwx/bin/python3
+
+# Local stand-in for the ATTOM property detail and Google Geocoding APIs, for offline load tests:
+#
+#   python fake_upstream.py --port 8099 --latency-ms 120 --latency-sd-ms 40 --error-rate 0.02
+#   ATTOM_BASE_URL=http://127.0.0.1:8099/propertyapi/v1.0.0/property/detail \
+#   GOOGLE_GEOCODE_URL=http://127.0.0.1:8099/maps/api/geocode/json python app.py
+#
+# Responses are seeded from the output.json ATTOM sample and derived from a hash of the address, so the
+# same address always gets the same property and coordinates across runs.
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ATTOM_PATH = '/propertyapi/v1.0.0/property/detail'
+GEOCODE_PATH = '/maps/api/geocode/json'
+SAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output.json')
+
+
+def load_sample(path=SAMPLE_PATH):
+    """Load the ATTOM sample response, skipping the // comment lines at the top of output.json."""
+    with open(path, encoding='utf-8') as f:
+        return json.loads(re.sub(r'^\s*//.*$', '', f.read(), flags=re.M))
+
+
+def address_rng(*parts):
+    """A random generator seeded from the normalized address, so responses are reproducible."""
+    key = ' '.join(' '.join(part.upper().split()) for part in parts if part)
+    return random.Random(int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:8], 'big'))
+
+
+class UpstreamProfile:
+    """Latency and failure distribution applied to every fake response."""
+
+    def __init__(self, latency_ms=0.0, latency_sd_ms=0.0, error_rate=0.0, throttle_rate=0.0, not_found_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.latency_sd_ms = latency_sd_ms
+        self.error_rate = error_rate  # Fraction answered 503
+        self.throttle_rate = throttle_rate  # Fraction answered 429
+        self.not_found_rate = not_found_rate  # Fraction of addresses ATTOM "does not know" (always the same ones)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def delay(self):
+        with self._lock:
+            delay = self._rng.gauss(self.latency_ms, self.latency_sd_ms) if self.latency_sd_ms else self.latency_ms
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def failure(self):
+        """Return 503, 429 or None for this request."""
+        with self._lock:
+            roll = self._rng.random()
+        if roll < self.error_rate:
+            return 503
+        if roll < self.error_rate + self.throttle_rate:
+            return 429
+        return None
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+def attom_response(sample, address1, address2, not_found_rate):
+    """Return (status, body) shaped like ATTOM's property/detail answer for this address."""
+    rng = address_rng(address1, address2)
+    if not address1 or rng.random() < not_found_rate:
+        return 400, {"status": {"version": "1.0.0", "code": 1, "msg": "SuccessWithoutResult", "total": 0}}
+
+    body = copy.deepcopy(sample)
+    prop = body["property"][0]
+    attom_id = rng.randrange(10 ** 8, 10 ** 9)
+    city, _, state_zip = (address2 or '').partition(',')
+    state, _, postal = state_zip.strip().partition(' ')
+    living = rng.randrange(600, 4200)
+    full_baths = rng.randrange(1, 4)
+    prop["identifier"].update({"Id": attom_id, "attomId": attom_id, "apn": f"{rng.randrange(10000):05d}-{rng.randrange(100):02d}-{rng.randrange(1000):03d}-000"})
+    prop["address"].update({"line1": address1.upper(), "line2": (address2 or '').upper(), "locality": city.strip().upper(),
+                            "countrySubd": state.upper(), "postal1": postal, "oneLine": f"{address1}, {address2}".upper()})
+    prop["lot"]["lotsize2"] = rng.randrange(2000, 15000)
+    prop["summary"]["yearbuilt"] = rng.randrange(1890, 2024)
+    prop["building"]["size"].update({"livingsize": living, "bldgsize": living, "universalsize": living})
+    prop["building"]["rooms"].update({"beds": rng.randrange(1, 6), "bathsfull": full_baths, "bathstotal": full_baths + 0.5 * rng.randrange(0, 2)})
+    prop["building"]["interior"]["bsmtsize"] = rng.choice([0, 0, rng.randrange(300, 1500)])
+    body["status"].update({"attomId": attom_id, "transactionID": hashlib.md5(str(attom_id).encode()).hexdigest(),
+                           "responseDateTime": time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())})
+    return 200, body
+
+
+def geocode_response(address, key, center=(39.74, -104.99), spread=0.3):
+    """Return (status, body) shaped like the Google Geocoding JSON answer for this address."""
+    if not key:
+        return 200, {"results": [], "status": "REQUEST_DENIED", "error_message": "You must use an API key to authenticate each request to Google Maps Platform APIs."}
+    if not address or not re.search(r'\d', address):
+        return 200, {"results": [], "status": "ZERO_RESULTS"}
+    rng = address_rng(address)
+    lat = round(center[0] + rng.uniform(-spread, spread), 7)
+    lng = round(center[1] + rng.uniform(-spread, spread), 7)
+    return 200, {
+        "results": [{
+            "formatted_address": ' '.join(address.split()).title() + ", USA",
+            "geometry": {"location": {"lat": lat, "lng": lng}, "location_type": "ROOFTOP",
+                         "viewport": {"northeast": {"lat": lat + 0.0013, "lng": lng + 0.0013},
+                                      "southwest": {"lat": lat - 0.0013, "lng": lng - 0.0013}}},
+            "place_id": hashlib.sha1(address.upper().encode()).hexdigest()[:27],
+            "types": ["street_address"],
+        }],
+        "status": "OK",
+    }
+
+
+def make_handler(profile, sample):
+    class FakeUpstreamHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive, like the real APIs
+        # Buffer headers and body into one write and disable Nagle, so the fake adds no latency of its own
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(data)))
+            if status == 429:
+                self.send_header('Retry-After', '1')
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {name: values[0] for name, values in parse_qs(url.query).items()}
+            if url.path == '/__stats':
+                return self.send_json(200, profile.counts)
+            if url.path not in (ATTOM_PATH, GEOCODE_PATH):
+                return self.send_json(404, {"error": "Unknown path"})
+
+            name = 'attom' if url.path == ATTOM_PATH else 'google'
+            profile.count(name)
+            profile.delay()
+            failure = profile.failure()
+            if failure:
+                profile.count(f"{name}_{failure}")
+                return self.send_json(failure, {"error": "Service Unavailable" if failure == 503 else "Too Many Requests"})
+
+            if name == 'attom':
+                if not self.headers.get('APIKey'):
+                    return self.send_json(401, {"status": {"code": 2, "msg": "Invalid API key"}})
+                status, body = attom_response(sample, query.get('address1', ''), query.get('address2', ''), profile.not_found_rate)
+            else:
+                status, body = geocode_response(query.get('address', ''), query.get('key'))
+            self.send_json(status, body)
+
+    return FakeUpstreamHandler
+
+
+def make_server(port=0, profile=None, sample_path=SAMPLE_PATH):
+    """Create the fake upstream server on 127.0.0.1 (port 0 picks a free port, see server.server_port)."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(profile or UpstreamProfile(), load_sample(sample_path)))
+    server.daemon_threads = True
+    return server
+
+
+def serve(port=0, profile=None, sample_path=SAMPLE_PATH):
+    """Start the fake upstream on a background thread, for benchmarks that run it in-process; returns the server."""
+    server = make_server(port, profile, sample_path)
+    threading.Thread(target=server.serve_forever, name='fake-upstream', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake ATTOM property detail and Google Geocoding APIs for offline load tests.")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Mean added latency per response")
+    parser.add_argument('--latency-sd-ms', type=float, default=0.0, help="Standard deviation of the added latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered 503")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of requests answered 429")
+    parser.add_argument('--not-found-rate', type=float, default=0.05, help="Fraction of addresses ATTOM has no record for")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sample', default=SAMPLE_PATH, help="ATTOM sample response to build answers from")
+    args = parser.parse_args()
+
+    profile = UpstreamProfile(args.latency_ms, args.latency_sd_ms, args.error_rate, args.throttle_rate, args.not_found_rate, args.seed)
+    server = make_server(args.port, profile, args.sample)
+    base = f"http://127.0.0.1:{args.port}"
+    print(f"ATTOM_BASE_URL={base}{ATTOM_PATH}")
+    print(f"GOOGLE_GEOCODE_URL={base}{GEOCODE_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/home/dh_kfekwx/bin/python3
+
+# Offline ZIP code gazetteer: city, state, county (name and FIPS code) and an approximate centroid for every active US ZIP.
+#
+# zip_gazetteer.csv.gz ships with the app. ZIP, city, state and county come from the MIT-licensed `zipcodes` package
+# (its coordinates are GeoNames data, CC BY 4.0) and county FIPS codes from the Census 2020 county list. On first use,
+# the CSV is compiled into gazetteer.db, which every worker opens read-only and memory-mapped, so the OS page cache
+# holds one copy for all of them and a lookup never touches the network. After replacing the CSV:
+#
+#   python gazetteer.py build
+
+import argparse
+import csv
+import gzip
+import os
+import re
+import sqlite3
+import threading
+import time
+
+GAZETTEER_SOURCE = os.getenv('GAZETTEER_SOURCE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zip_gazetteer.csv.gz'))
+GAZETTEER_DB = os.getenv('GAZETTEER_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.db'))
+GAZETTEER_COLUMNS = ['zip', 'city', 'state', 'county', 'county_fips', 'latitude', 'longitude']
+
+_conn = None
+_pid = None
+_lock = threading.Lock()
+
+
+def build(source=GAZETTEER_SOURCE, path=GAZETTEER_DB):
+    """Compile the gazetteer CSV (optionally gzipped) into a SQLite file; returns the number of ZIPs."""
+    opener = gzip.open if source.endswith('.gz') else open
+    with opener(source, 'rt', encoding='utf-8', newline='') as f:
+        rows = [tuple(row[name] or None for name in GAZETTEER_COLUMNS) for row in csv.DictReader(f)]
+
+    # Build beside the target and rename, so workers building at the same time never see a half-written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute('''
+            CREATE TABLE zip_codes (
+                zip TEXT PRIMARY KEY,
+                city TEXT,
+                state TEXT,
+                county TEXT,
+                county_fips TEXT,
+                latitude REAL,
+                longitude REAL
+            ) WITHOUT ROWID
+        ''')
+        conn.executemany(f"INSERT OR REPLACE INTO zip_codes VALUES ({', '.join('?' * len(GAZETTEER_COLUMNS))})", rows)
+        conn.commit()
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    return len(rows)
+
+
+def _connection():
+    """This process's read-only connection, compiling the database first if it is missing or older than the CSV."""
+    global _conn, _pid
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                if os.path.exists(GAZETTEER_SOURCE) and (not os.path.exists(GAZETTEER_DB) or
+                                                         os.path.getmtime(GAZETTEER_DB) < os.path.getmtime(GAZETTEER_SOURCE)):
+                    build()
+                if os.path.exists(GAZETTEER_DB):
+                    # immutable: the file never changes while the app runs, so SQLite skips locking entirely
+                    _conn = sqlite3.connect(f"file:{GAZETTEER_DB}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+                    _conn.execute(f"PRAGMA mmap_size = {os.path.getsize(GAZETTEER_DB)}")
+                else:
+                    _conn = None
+                _pid = os.getpid()
+    return _conn
+
+
+def lookup(zip_code):
+    """Return the gazetteer row for a 5-digit ZIP (ZIP+4 is accepted) as a dict, or None."""
+    match = re.match(r'\s*(\d{5})(?:-\d{4})?\s*$', zip_code or '')
+    conn = _connection() if match else None
+    if conn is None:
+        return None
+    with _lock:
+        row = conn.execute(f"SELECT {', '.join(GAZETTEER_COLUMNS)} FROM zip_codes WHERE zip = ?", (match.group(1),)).fetchone()
+    return dict(zip(GAZETTEER_COLUMNS, row)) if row else None
+
+
+def find_zip(address):
+    """The ZIP in a one-line address ("4529 Winona Ct, Denver, CO 80212"), looked for after the street; or None."""
+    _, _, rest = (address or '').partition(',')
+    zips = re.findall(r'\b(\d{5})(?:-\d{4})?\b', rest)
+    return zips[-1] if zips else None
+
+
+def approximate_location(address):
+    """The centroid of the address's ZIP as {'latitude', 'longitude', 'approximate': True}, or None."""
+    info = lookup(find_zip(address))
+    if info is None or info['latitude'] is None:
+        return None
+    return {'latitude': info['latitude'], 'longitude': info['longitude'], 'approximate': True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the bundled ZIP gazetteer CSV into the SQLite file the app reads.")
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--source', default=GAZETTEER_SOURCE)
+    parser.add_argument('--output', default=GAZETTEER_DB)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    count = build(args.source, args.output)
+    print(f"Wrote {count} ZIP codes to {args.output} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
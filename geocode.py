@@ -0,0 +1,146 @@
+#!/home/dh_kfekwx/bin/python3
+
+import os
+
+import requests
+
+import db
+import gazetteer
+from addresses import key_prefix, normalize_line, split_unit
+from cache import PersistentCache
+from http_client import client
+from singleflight import SingleFlight
+
+GOOGLE_GEOCODING_API_KEY = os.getenv('GOOGLE_GEOCODING_API_KEY')
+GOOGLE_GEOCODE_URL = os.getenv('GOOGLE_GEOCODE_URL', "https://maps.googleapis.com/maps/api/geocode/json")  # fake_upstream.py for offline load tests
+
+# Google allows caching coordinates for up to 30 days; unknown addresses are retried sooner.
+geocode_cache = PersistentCache(
+    'google-geocode',
+    ttl=int(os.getenv('GEOCODE_CACHE_TTL_SECONDS', str(30 * 24 * 3600))),
+    negative_ttl=int(os.getenv('GEOCODE_CACHE_NEGATIVE_TTL_SECONDS', str(3600))),
+    lru_size=int(os.getenv('GEOCODE_CACHE_LRU_SIZE', '4096')),
+)
+geocode_flight = SingleFlight('google-geocode')  # Concurrent lookups of the same address share one Geocoding call
+stored_hits = 0  # Lookups answered from coordinates already saved on a file or comp
+approximate_hits = 0  # Lookups answered with a ZIP centroid because Google failed
+# Statuses for a request Google may well answer later; any other error status is a problem with the request or the key
+TRANSIENT_STATUSES = frozenset({'OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'})
+
+
+class GeocodeError(Exception):
+    """Google answered with an error status (REQUEST_DENIED, OVER_QUERY_LIMIT, ...); never cached."""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def create_geocode_indexes(conn):
+    """Index comp addresses by ZIP, so coordinates already saved can answer a geocode lookup.
+
+    Subjects are found through the valuator_data address_key index, which replaced the ZIP index.
+    """
+    conn.execute("DROP INDEX IF EXISTS valuator_data_zip")
+    conn.execute("CREATE INDEX IF NOT EXISTS comparables_zip ON comparables (zip)")
+    conn.commit()
+
+
+# Saved coordinates for subjects at the street address (any unit: every address_key from "STREET|ZIP|" up to,
+# not including, "STREET|ZIP}") and for every comp in the ZIP, whose street is compared normalized in Python.
+STORED_LOCATION_SQL = '''
+    SELECT address, latitude, longitude FROM valuator_data
+    WHERE address_key >= :prefix AND address_key < :prefix_end AND COALESCE(latitude, '') != '' AND COALESCE(longitude, '') != ''
+    UNION ALL
+    SELECT address, latitude, longitude FROM comparables WHERE zip = :zip AND latitude IS NOT NULL AND longitude IS NOT NULL
+'''
+
+
+def geocode_key(address):
+    """Cache key for a one-line address, so case, punctuation and USPS spelling variants share an entry."""
+    return normalize_line(address)
+
+
+def stored_location(conn, address):
+    """Coordinates already saved for this street address and ZIP on a file or comp, or None.
+
+    Addresses arrive as one line ("4529 Winona Ct, Denver, CO 80212"); without a ZIP there is nothing to match on.
+    """
+    zip_code = gazetteer.find_zip(address)
+    line = address.partition(',')[0]
+    prefix = key_prefix(line, zip_code)
+    if prefix is None:
+        return None
+    street = split_unit(line)[0]
+    params = {'prefix': prefix, 'prefix_end': prefix[:-1] + '}', 'zip': zip_code}
+    for stored_address, latitude, longitude in conn.execute(STORED_LOCATION_SQL, params):
+        if split_unit(stored_address)[0] == street:
+            try:
+                return {'latitude': float(latitude), 'longitude': float(longitude)}
+            except (TypeError, ValueError):
+                continue
+    return None
+
+
+def request_geocode(address):
+    """Call the Google Geocoding API: the location, None for ZERO_RESULTS, or GeocodeError for other statuses."""
+    geocode_data = client.get('google', GOOGLE_GEOCODE_URL, params={'address': address, 'key': GOOGLE_GEOCODING_API_KEY}).json()
+    status = geocode_data.get('status', 'Unknown error')
+    if status == 'OK':
+        location = geocode_data['results'][0]['geometry']['location']
+        return {'latitude': location['lat'], 'longitude': location['lng']}
+    if status == 'ZERO_RESULTS':
+        return None
+    raise GeocodeError(status)
+
+
+def _load_geocode(key, address):
+    location = request_geocode(address)
+    geocode_cache.set(key, location)
+    return location
+
+
+def geocode(address, approximate=True):
+    """Return {'latitude', 'longitude'} for a one-line address, or None if Google knows no such place.
+
+    Checks the geocode cache, then coordinates already saved in the database, and only then calls Google
+    (one call for any number of concurrent lookups of the same address). If Google is unreachable or answers
+    with a TRANSIENT_STATUSES error, the centroid of the address's ZIP is returned with 'approximate': True
+    (and not cached), unless approximate is False. Otherwise the error is raised (GeocodeError or a requests exception).
+    """
+    global stored_hits, approximate_hits
+    key = geocode_key(address)
+    location = geocode_cache.get(key)
+    if location is not geocode_cache.MISSING:
+        return location
+
+    with db.connection() as conn:
+        location = stored_location(conn, address)
+    if location is not None:
+        stored_hits += 1
+        geocode_cache.set(key, location)
+        return location
+    try:
+        return geocode_flight.do(key, _load_geocode, key, address)
+    except (GeocodeError, requests.RequestException) as e:
+        if not approximate or (isinstance(e, GeocodeError) and e.status not in TRANSIENT_STATUSES):
+            raise
+        location = gazetteer.approximate_location(address)
+        if location is None:
+            raise
+        print(f"Geocoding failed ({e}); using the ZIP centroid for {address}")
+        approximate_hits += 1
+        return location
+
+
+def geocode_many(addresses):
+    """Geocode many one-line addresses in parallel (GEOCODE_CONCURRENCY at a time, within the Google rate limit).
+
+    Returns one entry per address, in order: the location, None, or the exception raised.
+    """
+    return client.run_parallel('google', geocode, addresses)
+
+
+def stats(conn):
+    """Geocode cache counters plus lookups answered from saved coordinates and from ZIP centroids."""
+    return {**geocode_cache.stats(conn), 'stored_hits': stored_hits, 'approximate_hits': approximate_hits}
@@ -0,0 +1,169 @@
+#!/home/dh_kfekwx/bin/python3
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))  # Keep-alive connections kept per upstream host
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))
+HTTP_BACKOFF_SECONDS = 0.3  # Retry n waits about 0.3 * 2**(n - 1) seconds, plus jitter
+
+# (connect, read) timeouts in seconds per upstream, so a hung upstream can never hold a worker indefinitely.
+UPSTREAM_TIMEOUTS = {
+    'attom': (3.05, 10),
+    'google': (3.05, 5),
+}
+
+# Requests per second each worker process may start per upstream (0 = unlimited). Google Geocoding allows 50 QPS
+# per project, so keep rate * worker processes under that.
+UPSTREAM_RATE_LIMITS = {
+    'attom': float(os.getenv('ATTOM_RATE_LIMIT', '0')),
+    'google': float(os.getenv('GEOCODE_RATE_LIMIT', '10')),
+}
+# Lookups run at once per upstream by run_parallel(); keep each at or below HTTP_POOL_SIZE.
+UPSTREAM_CONCURRENCY = {
+    'attom': int(os.getenv('ATTOM_CONCURRENCY', '4')),
+    'google': int(os.getenv('GEOCODE_CONCURRENCY', '4')),
+}
+
+
+def make_retry():
+    """Bounded retries for idempotent GETs on connection errors and 429/502/503/504, honouring Retry-After."""
+    options = dict(
+        total=HTTP_RETRIES, connect=HTTP_RETRIES, read=HTTP_RETRIES, status=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_SECONDS, status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset({'GET'}), respect_retry_after_header=True, raise_on_status=False,
+    )
+    try:
+        return Retry(backoff_jitter=HTTP_BACKOFF_SECONDS, **options)
+    except TypeError:
+        return Retry(**options)  # urllib3 < 2 has no jitter option
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` calls per second in bursts of up to `burst`; acquire() sleeps until the caller's turn."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waits = 0
+        self.waited_seconds = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Take the token even if it is not there yet; the debt orders waiting callers first come, first served
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            if wait:
+                self.waits += 1
+                self.waited_seconds += wait
+        if wait:
+            time.sleep(wait)
+
+
+class HttpClient:
+    """One keep-alive requests.Session per worker process, shared by every thread that calls an upstream."""
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE):
+        self.pool_size = pool_size
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.counts = {}  # upstream -> {'requests', 'errors', 'retries'}
+        self.limiters = {}  # upstream -> RateLimiter, for upstreams with a rate limit
+        self._executors = {}
+
+    def session(self):
+        """Return this process's session, creating it after a fork so sockets are never shared between workers."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=len(UPSTREAM_TIMEOUTS), pool_maxsize=self.pool_size,
+                                          pool_block=False, max_retries=make_retry())
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+                    self.counts = {}
+                    self.limiters = {upstream: RateLimiter(rate) for upstream, rate in UPSTREAM_RATE_LIMITS.items() if rate > 0}
+                    self._executors = {}
+        return self._session
+
+    def get(self, upstream, url, **kwargs):
+        """GET url on behalf of an upstream in UPSTREAM_TIMEOUTS, using its timeouts unless given.
+
+        Waits first if the upstream's rate limit is used up.
+        """
+        kwargs.setdefault('timeout', UPSTREAM_TIMEOUTS[upstream])
+        session = self.session()
+        limiter = self.limiters.get(upstream)
+        if limiter is not None:
+            limiter.acquire()
+        counts = self.counts.setdefault(upstream, {'requests': 0, 'errors': 0, 'retries': 0})
+        counts['requests'] += 1
+        try:
+            response = session.get(url, **kwargs)
+        except requests.RequestException:
+            counts['errors'] += 1
+            raise
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None:
+            counts['retries'] += len(retries.history)
+        return response
+
+    def run_parallel(self, upstream, fn, items):
+        """Call fn(item) for every item, at most UPSTREAM_CONCURRENCY[upstream] at once across this process.
+
+        Returns one entry per item, in order: fn's result, or the exception it raised.
+        """
+        self.session()
+        executor = self._executors.get(upstream)
+        if executor is None:
+            with self._lock:
+                executor = self._executors.get(upstream)
+                if executor is None:
+                    executor = self._executors[upstream] = ThreadPoolExecutor(max_workers=UPSTREAM_CONCURRENCY[upstream],
+                                                                               thread_name_prefix=upstream)
+        futures = [executor.submit(fn, item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stats(self):
+        """Per-upstream request counters and per-host connection pool usage for this process."""
+        pools = {}
+        session = self._session
+        if session is not None and self._pid == os.getpid():
+            manager = session.get_adapter('https://').poolmanager
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                pools[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                    'maxsize': pool.pool.maxsize if pool.pool is not None else self.pool_size,
+                    # urllib3 fills unopened slots with None, so only real connections count as idle
+                    'idle': sum(conn is not None for conn in list(pool.pool.queue)) if pool.pool is not None else 0,
+                    'connections_opened': pool.num_connections,
+                    'requests': pool.num_requests,
+                }
+        limits = {upstream: {'rate': limiter.rate, 'waits': limiter.waits, 'waited_seconds': round(limiter.waited_seconds, 3)}
+                  for upstream, limiter in self.limiters.items()}
+        return {'pool_size': self.pool_size, 'upstreams': self.counts, 'pools': pools, 'rate_limits': limits}
+
+
+client = HttpClient()
@@ -0,0 +1,206 @@
+#!/home/dh_kfekwx/bin/python3
+
+import argparse
+import csv
+import gzip
+import json
+import math
+import re
+import sys
+import time
+from itertools import islice
+
+import db
+from addresses import address_keys
+from spatial import LOCATION_SLOTS
+
+COMP_KEY = re.compile(r'^comp(\d+)_(\w+)$')
+
+
+def open_input(path):
+    """Open a CSV/JSONL file for streaming text reads; '-' is stdin and .gz files are decompressed on the fly."""
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def read_records(stream, fmt):
+    """Yield one dict per input record without reading the whole file.
+
+    A JSONL line that is not a JSON object is yielded as a ValueError naming the line, for import_batch to reject.
+    """
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield ValueError(f"line {number} is not valid JSON: {e}")
+                continue
+            yield record if isinstance(record, dict) else ValueError(f"line {number} is not a JSON object")
+
+
+def coerce(value, col_type):
+    """Convert a raw CSV/JSON value to the column's declared type; blanks become NULL.
+
+    Raises ValueError for a number column given something that is not a finite number.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if value == '':
+            return None
+        if col_type in ('REAL', 'INTEGER'):
+            value = value.replace('$', '').replace(',', '')
+    if col_type in ('REAL', 'INTEGER'):
+        number = float(value)
+        if not math.isfinite(number):
+            raise ValueError(f"{value!r} is not a finite number")
+        return number if col_type == 'REAL' else int(number)
+    return str(value)
+
+
+def split_record(record, subject_types, comp_types):
+    """Split one input record into (subject values, {slot: comp values}), coerced to column types.
+
+    Comps may arrive as flat comp{n}_{field} keys (CSV) or as a "comparables" list of objects (JSONL).
+    Raises ValueError for a comp that is not an object or whose slot is outside 1..LOCATION_SLOTS - 1.
+    """
+    subject = {}
+    comps = {}
+    for key, value in record.items():
+        if key == 'comparables':
+            for index, comp in enumerate(value or [], 1):
+                if not isinstance(comp, dict):
+                    raise ValueError(f"comparable {index} is not an object")
+                slot = int(comp.get('slot', index))
+                comps[slot] = {field: coerce(comp.get(field), comp_types[field]) for field in db.COMP_FIELDS}
+            continue
+        match = COMP_KEY.match(key)
+        if match and match.group(2) in comp_types:
+            comps.setdefault(int(match.group(1)), {})[match.group(2)] = coerce(value, comp_types[match.group(2)])
+        elif key in subject_types and key != 'id':
+            subject[key] = coerce(value, subject_types[key])
+    comps = {slot: {field: comp.get(field) for field in db.COMP_FIELDS} for slot, comp in comps.items() if any(comp.values())}
+    for slot in comps:
+        if not 1 <= slot < LOCATION_SLOTS:
+            raise ValueError(f"comparable slot {slot} is outside 1..{LOCATION_SLOTS - 1}")
+    return subject, comps
+
+
+def file_ids(conn, file_numbers, chunk_size=500):
+    """Return {file_number: id} for the given file numbers, querying in chunks to stay under SQLite's variable limit."""
+    file_numbers = list(file_numbers)
+    ids = {}
+    for start in range(0, len(file_numbers), chunk_size):
+        chunk = file_numbers[start:start + chunk_size]
+        placeholders = ', '.join(['?'] * len(chunk))
+        ids.update(conn.execute(f"SELECT file_number, id FROM valuator_data WHERE file_number IN ({placeholders})", chunk))
+    return ids
+
+
+def import_batch(conn, schema, records, update):
+    """Coerce and write one batch in a single transaction; returns (files written, comps written, rejected)."""
+    subject_types = schema.types('valuator_data')
+    comp_types = schema.types('comparables')
+    columns = [column for column in schema.columns('valuator_data') if column != 'id']
+
+    rows = {}
+    rejected = 0
+    for record in records:
+        if not isinstance(record, dict):  # read_records yields a ValueError for a line it could not turn into a record
+            print(f"Skipping record: {record if isinstance(record, Exception) else 'not an object'}", file=sys.stderr)
+            rejected += 1
+            continue
+        try:
+            subject, comps = split_record(record, subject_types, comp_types)
+        except (AttributeError, OverflowError, TypeError, ValueError) as e:
+            print(f"Skipping record {record.get('file_number')!r}: {e}", file=sys.stderr)
+            rejected += 1
+            continue
+        if not subject.get('file_number'):
+            print("Skipping record without file_number", file=sys.stderr)
+            rejected += 1
+            continue
+        rows[subject['file_number']] = (subject, comps)  # A later duplicate in the same batch wins
+
+    # Key the whole batch in one pass; records without an address keep the stored key on update
+    subjects = [subject for subject, _ in rows.values() if subject.get('address')]
+    for subject, key in zip(subjects, address_keys((subject['address'], subject.get('unit'), subject.get('zip')) for subject in subjects)):
+        subject['address_key'] = key
+
+    with db.transaction(conn):
+        existing = file_ids(conn, rows)
+        if not update:
+            rows = {file_number: row for file_number, row in rows.items() if file_number not in existing}
+        if not rows:
+            return 0, 0, rejected
+
+        # Upsert keeps the existing id on update, so comparables stay attached to their file; fields missing from the input keep their stored value.
+        assignments = ', '.join(f"{column} = COALESCE(excluded.{column}, {column})" for column in columns if column != 'file_number')
+        conn.executemany(
+            f"{schema.insert('valuator_data', columns)} ON CONFLICT(file_number) DO UPDATE SET {assignments}",
+            [tuple(subject.get(column) for column in columns) for subject, _ in rows.values()]
+        )
+        ids = file_ids(conn, rows)
+
+        comp_rows = [(ids[file_number], slot, *comp.values())
+                     for file_number, (_, comps) in rows.items() for slot, comp in sorted(comps.items())]
+        if update:
+            conn.executemany("DELETE FROM comparables WHERE file_id = ?",
+                             [(ids[file_number],) for file_number, (_, comps) in rows.items() if comps])
+        conn.executemany(schema.insert('comparables', ['file_id', 'slot', *db.COMP_FIELDS]), comp_rows)
+    return len(rows), len(comp_rows), rejected
+
+
+def run_import(path, fmt, db_name, batch_size, update):
+    """Stream path into db_name batch by batch, printing progress; memory use is bounded by batch_size."""
+    conn = db.open_connection(db_name)
+    db.create_valuator_table(conn)
+    db.create_comparables_table(conn)
+    conn.commit()
+    schema = db.get_schema(conn, db_name)
+
+    started = time.perf_counter()
+    seen = files = comps = rejected = 0
+    with open_input(path) as stream:
+        records = read_records(stream, fmt)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            written = import_batch(conn, schema, batch, update)
+            seen += len(batch)
+            files += written[0]
+            comps += written[1]
+            rejected += written[2]
+            elapsed = time.perf_counter() - started
+            print(f"{seen} records read, {files} files and {comps} comparables written, {seen / elapsed:.0f} rows/sec", file=sys.stderr)
+    conn.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Imported {files} files and {comps} comparables from {seen} records in {elapsed:.1f}s "
+          f"({seen / elapsed if elapsed else 0:.0f} rows/sec); {seen - files - rejected} skipped as existing, {rejected} rejected.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import historical appraisal files (CSV or JSONL) into valuator_data.")
+    parser.add_argument('path', help="Input file, optionally .gz, or '-' for stdin")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension")
+    parser.add_argument('--db', default=db.VALUATOR_DB)
+    parser.add_argument('--batch-size', type=int, default=10000, help="Records per transaction")
+    parser.add_argument('--update', action='store_true', help="Overwrite files that already exist instead of skipping them")
+    args = parser.parse_args()
+
+    fmt = args.format or ('jsonl' if re.search(r'\.(jsonl|ndjson|json)(\.gz)?$', args.path) else 'csv')
+    run_import(args.path, fmt, args.db, args.batch_size, args.update)
+
+
+if __name__ == "__main__":
+    main()
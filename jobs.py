@@ -0,0 +1,187 @@
+#!/home/dh_kfekwx/bin/python3
+
+import os
+import random
+import threading
+import time
+
+import db
+from writer import get_writer
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '6'))
+JOB_BACKOFF_SECONDS = float(os.getenv('JOB_BACKOFF_SECONDS', '5'))  # First retry delay, doubled on every attempt
+JOB_MAX_BACKOFF_SECONDS = 600
+JOB_LEASE_SECONDS = 120  # A running job whose worker died is picked up again once its lease runs out
+JOB_POLL_SECONDS = 2.0
+
+
+class RetryableJobError(Exception):
+    """Raise from a job handler for a transient failure; the job is retried with backoff."""
+
+
+class JobFailed(Exception):
+    """Raise from a job handler for a permanent failure; the job is marked failed without retrying."""
+
+
+def create_jobs_table(conn):
+    """Create the jobs table: one row per (kind, key). Re-queueing a key resets its job unless the job is running;
+    a running job is flagged with rerun instead and goes back to pending when it finishes.
+
+    Tables created before re-queued running jobs were flagged for a rerun get the rerun column added in place.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,
+            result TEXT,
+            last_error TEXT,
+            rerun INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            UNIQUE (kind, key)
+        )
+    ''')
+    if 'rerun' not in {row[1] for row in conn.execute("PRAGMA table_info(jobs);")}:
+        conn.execute("ALTER TABLE jobs ADD COLUMN rerun INTEGER NOT NULL DEFAULT 0;")
+    # Only pending and running jobs are ever claimed, so finished ones stay out of the index
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (run_after) WHERE status IN ('pending', 'running')")
+
+
+def backoff(attempts):
+    """Delay in seconds before retry number `attempts`: exponential and capped, jittered so a burst of failures spreads out."""
+    delay = min(JOB_MAX_BACKOFF_SECONDS, JOB_BACKOFF_SECONDS * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _enqueue(conn, kind, key, now):
+    # A running job is never reset, or a second worker would claim it while it runs; it is flagged to run again when it finishes
+    conn.execute("UPDATE jobs SET rerun = 1, updated_at = ? WHERE kind = ? AND key = ? AND status = 'running'", (now, kind, key))
+    conn.execute('''
+        INSERT INTO jobs (kind, key, status, attempts, run_after, created_at, updated_at) VALUES (?, ?, 'pending', 0, ?, ?, ?)
+        ON CONFLICT (kind, key) DO UPDATE SET status = 'pending', attempts = 0, run_after = excluded.run_after,
+                                              result = NULL, last_error = NULL, updated_at = excluded.updated_at
+        WHERE jobs.status != 'running'
+    ''', (kind, key, now, now, now))
+
+
+def _claim(conn, now):
+    return conn.execute('''
+        UPDATE jobs SET status = 'running', attempts = attempts + 1, rerun = 0, run_after = ?, updated_at = ?
+        WHERE id = (SELECT id FROM jobs WHERE status IN ('pending', 'running') AND run_after <= ? ORDER BY run_after LIMIT 1)
+        RETURNING id, kind, key, attempts
+    ''', (now + JOB_LEASE_SECONDS, now, now)).fetchone()
+
+
+def _finish(conn, job_id, attempts, status, result, error, run_after, now):
+    # attempts guards against a worker whose lease expired overwriting the outcome of the worker that took over.
+    # A job re-queued while it ran goes back to pending as a fresh job, whatever this run's outcome.
+    conn.execute('''
+        UPDATE jobs SET status = CASE WHEN rerun THEN 'pending' ELSE ? END, attempts = CASE WHEN rerun THEN 0 ELSE attempts END,
+                        run_after = CASE WHEN rerun THEN ? ELSE ? END, rerun = 0, result = ?, last_error = ?, updated_at = ?
+        WHERE id = ? AND attempts = ? AND status = 'running'
+    ''', (status, now, run_after, result, error, now, job_id, attempts))
+
+
+class JobRunner:
+    """Worker threads that run persisted jobs from the `jobs` table through registered handlers.
+
+    Jobs are claimed with a lease, so a job left running by a crashed or restarted process is picked up
+    again once the lease expires. All job bookkeeping is written through the single-writer queue.
+    """
+
+    def __init__(self, db_name=db.VALUATOR_DB, workers=JOB_WORKERS):
+        self.db_name = db_name
+        self.workers = workers
+        self.handlers = {}
+        self._wake = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def register(self, kind, handler):
+        """Run handler(key) for jobs of this kind; its return value is stored as the job result."""
+        self.handlers[kind] = handler
+
+    def start(self):
+        """Start the worker threads once per process; safe to call on every request."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            with db.connection(self.db_name) as conn:
+                create_jobs_table(conn)
+                conn.commit()
+            for n in range(self.workers):
+                threading.Thread(target=self._work, name=f"jobs-{n}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def enqueue(self, kind, key):
+        """Persist a job for key (re-queueing it if it already exists, or flagging it to run again if it is running) and wake a worker."""
+        get_writer(self.db_name).run(_enqueue, kind, key, time.time())
+        self._wake.set()
+
+    def status(self, conn, kind, key):
+        """Return the job for (kind, key) as a dict, or None if none was ever queued."""
+        row = conn.execute('''
+            SELECT status, attempts, result, last_error, run_after, updated_at FROM jobs WHERE kind = ? AND key = ?
+        ''', (kind, key)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(['status', 'attempts', 'result', 'last_error', 'retry_at', 'updated_at'], row))
+        if job['status'] != 'pending' or not job['attempts']:
+            job['retry_at'] = None
+        return job
+
+    def _work(self):
+        writer = get_writer(self.db_name)
+        while True:
+            job = None
+            try:
+                # Check for a due job with a plain read first, so idle workers never take the write lock
+                with db.connection(self.db_name) as conn:
+                    next_due = conn.execute("SELECT MIN(run_after) FROM jobs WHERE status IN ('pending', 'running')").fetchone()[0]
+                if next_due is not None and next_due <= time.time():
+                    job = writer.run(_claim, time.time())
+            except Exception as e:
+                print(f"Error claiming job: {e}")
+                next_due = None
+            if job is None:
+                # Sleep until the next retry is due, a new job is queued, or the poll interval passes (jobs queued by other processes)
+                wait = JOB_POLL_SECONDS if next_due is None else min(JOB_POLL_SECONDS, max(0.0, next_due - time.time()))
+                self._wake.wait(wait)
+                self._wake.clear()
+                continue
+            self._run(writer, *job)
+
+    def _run(self, writer, job_id, kind, key, attempts):
+        handler = self.handlers.get(kind)
+        result, error, status, run_after = None, None, 'done', None
+        try:
+            if handler is None:
+                raise JobFailed(f"No handler registered for job kind {kind!r}")
+            result = handler(key)
+        except JobFailed as e:
+            status, error = 'failed', str(e)
+        except Exception as e:
+            # Anything else (RetryableJobError, network or database errors) is retried until attempts run out
+            error = str(e) or type(e).__name__
+            if attempts >= JOB_MAX_ATTEMPTS:
+                status = 'failed'
+            else:
+                status, run_after = 'pending', time.time() + backoff(attempts)
+        if error:
+            print(f"Job {kind} {key} attempt {attempts} {status}: {error}")
+        now = time.time()
+        try:
+            writer.run(_finish, job_id, attempts, status, result, error, run_after if run_after is not None else now, now)
+        except Exception as e:
+            # The job stays running until its lease runs out, then it is claimed again
+            print(f"Error finishing job {kind} {key}: {e}")
+
+
+runner = JobRunner()
@@ -0,0 +1,233 @@
+#!/home/dh_kfekwx/bin/python3
+
+# Market-derived adjustment rates: $ per sq ft of GLA, per bedroom, per bath, per year built and per sq ft of site,
+# fitted from our own stored sales for every ZIP and county, and looked up by primary key when files are valued.
+#
+# The fit is a paired-sales regression. The sales on one file (its sold subject and its comps) share a location and
+# a market, so each sale is compared with the other sales of its file: every price and feature has its file's mean
+# subtracted, and NumPy least squares finds the rates that best explain the remaining price differences. The sale date
+# is fitted too, so market movement between a file's sales is not taken for a feature's value.
+#
+# Saves log their file in sale_changes (suggest.py). update_market_rates() counts the changed files per area and only
+# refits an area once enough of its files changed since its last fit (MARKET_RATES_REFIT_*). It runs as a background job
+# after Step 2 saves, or by hand after an import:
+#
+#   python market_rates.py update [--full]
+
+import argparse
+import json
+import os
+import time
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+import db
+import gazetteer
+import valuation
+from suggest import change_bounds, changed_files, sale_day
+from writer import get_writer
+
+FIT_FEATURES = ['gla', 'beds', 'full_baths', 'half_baths', 'year_built', 'site_size']
+MARKET_RATES_MIN_SALES = int(os.getenv('MARKET_RATES_MIN_SALES', '60'))  # Sales on files with at least two usable sales
+MARKET_RATES_MIN_FILES = int(os.getenv('MARKET_RATES_MIN_FILES', '15'))
+# An area is refitted once this many of its files changed, and at least this share of the files in its last fit
+MARKET_RATES_REFIT_FILES = int(os.getenv('MARKET_RATES_REFIT_FILES', '25'))
+MARKET_RATES_REFIT_SHARE = float(os.getenv('MARKET_RATES_REFIT_SHARE', '0.05'))
+
+# Every sold subject and comp with its file and the file's ZIP; comps are found near their subject, so they share its area.
+# {zip_filter} narrows an incremental update to the files of the areas it refits.
+SALES_SQL = f'''
+    SELECT v.id, v.zip, CAST(v.subject_sale_price AS REAL), v.subject_sale_date, {', '.join(f"v.subject_{name}" for name in valuation.FEATURES)}
+    FROM valuator_data v WHERE CAST(v.subject_sale_price AS REAL) > 0 {{zip_filter}}
+    UNION ALL
+    SELECT c.file_id, v.zip, CAST(c.sale_price AS REAL), c.sale_date, {', '.join(f"c.{name}" for name in valuation.FEATURES)}
+    FROM valuator_data v JOIN comparables c ON c.file_id = v.id WHERE CAST(c.sale_price AS REAL) > 0 {{zip_filter}}
+'''
+
+
+def create_market_rates_tables(conn):
+    """Create market_rates (one row per area, 'zip:80212' or 'county:08031') and the update job's progress row."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS market_rates (
+            area TEXT PRIMARY KEY,
+            rates TEXT,
+            sales INTEGER NOT NULL DEFAULT 0,
+            files INTEGER NOT NULL DEFAULT 0,
+            r2 REAL,
+            pending INTEGER NOT NULL DEFAULT 0,
+            fitted_at REAL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE TABLE IF NOT EXISTS market_rates_progress (id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL)")
+    conn.commit()
+
+
+@lru_cache(maxsize=4096)
+def area_keys(zip_code):
+    """The areas a ZIP belongs to, most specific first: ['zip:80212', 'county:08031'], or [] without a valid ZIP."""
+    zip5 = (zip_code or '').strip()[:5]
+    if not (len(zip5) == 5 and zip5.isdigit()):
+        return []
+    info = gazetteer.lookup(zip5)
+    return [f"zip:{zip5}"] + ([f"county:{info['county_fips']}"] if info and info['county_fips'] else [])
+
+
+def fit(groups, prices, days, features):
+    """Fit FIT_FEATURES rates to one area's sales; groups holds each sale's file id and features is (N, len(FIT_FEATURES)).
+
+    Returns {'rates', 'sales', 'files', 'r2'}; rates is None when there are too few paired sales, and leaves out any
+    feature that never differs within a file or whose fitted rate is not positive (DEFAULT_RATES applies to those).
+    """
+    design = np.column_stack([features, days])
+    complete = np.isfinite(prices) & np.isfinite(design).all(axis=1)
+    groups, prices, design = groups[complete], prices[complete], design[complete]
+    _, inverse, counts = np.unique(groups, return_inverse=True, return_counts=True)
+    paired = counts[inverse] >= 2  # A file's only usable sale has nothing to be compared with
+    prices, design = prices[paired], design[paired]
+    _, inverse, counts = np.unique(groups[paired], return_inverse=True, return_counts=True)
+    result = {'rates': None, 'sales': len(prices), 'files': len(counts), 'r2': None}
+    if len(prices) < MARKET_RATES_MIN_SALES or len(counts) < MARKET_RATES_MIN_FILES:
+        return result
+
+    y = prices - (np.bincount(inverse, prices) / counts)[inverse]
+    means = np.column_stack([np.bincount(inverse, column) for column in design.T]) / counts[:, None]
+    x = design - means[inverse]
+    varies = np.abs(x).max(axis=0) > 1e-9
+    coefficients = np.zeros(x.shape[1])
+    coefficients[varies] = np.linalg.lstsq(x[:, varies], y, rcond=None)[0]
+    total = float((y ** 2).sum())
+    result['r2'] = round(1 - float(((y - x @ coefficients) ** 2).sum()) / total, 4) if total > 0 else None
+    result['rates'] = {name: round(float(rate), 2) for name, rate, varied in zip(FIT_FEATURES, coefficients, varies)
+                       if varied and rate > 0}
+    return result
+
+
+def fit_areas(conn, areas=None):
+    """Fit every area with sales, or only the given ones, from one pass over their stored sales; {area: fit()}."""
+    if areas is None:
+        rows = conn.execute(SALES_SQL.format(zip_filter='')).fetchall()
+    else:
+        zips = [zip_code for (zip_code,) in conn.execute("SELECT DISTINCT zip FROM valuator_data") if areas.intersection(area_keys(zip_code))]
+        rows = conn.execute(SALES_SQL.format(zip_filter="AND v.zip IN (SELECT value FROM json_each(:zips))"), {'zips': json.dumps(zips)}).fetchall()
+    groups = np.array([row[0] for row in rows], dtype=np.int64)
+    prices = np.array([row[2] for row in rows], dtype=float)
+    days = np.array([sale_day(row[3]) for row in rows], dtype=float)
+    columns = [valuation.FEATURES.index(name) for name in FIT_FEATURES]
+    features = valuation.feature_matrix(rows, offset=4)[:, columns]
+
+    members = {}  # area -> row numbers
+    for i, row in enumerate(rows):
+        for area in area_keys(row[1]):
+            if areas is None or area in areas:
+                members.setdefault(area, []).append(i)
+    return {area: fit(groups[index], prices[index], days[index], features[index])
+            for area, index in ((area, np.array(index)) for area, index in members.items())}
+
+
+def plan_update(conn, full=False):
+    """Work out an update from sale_changes: (progress seq it starts from or None, last seq, changed files per area,
+    fits of the areas due for a refit).
+
+    Everything is refitted on the first run, with full=True, or when sale_changes was trimmed past the last run.
+    """
+    first, last = change_bounds(conn)
+    progress = conn.execute("SELECT seq FROM market_rates_progress WHERE id = 1").fetchone()
+    planned_from = progress[0] if progress else None
+    pending = Counter()
+    if full or progress is None or progress[0] < first - 1:
+        return planned_from, last, pending, fit_areas(conn)
+
+    file_ids = changed_files(conn, progress[0], last)
+    for (zip_code,) in conn.execute("SELECT zip FROM valuator_data WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(file_ids),)):
+        pending.update(area_keys(zip_code))
+    stored = {area: (changed, files) for area, changed, files in conn.execute(
+        "SELECT area, pending, files FROM market_rates WHERE area IN (SELECT value FROM json_each(?))", (json.dumps(list(pending)),))}
+    due = set()
+    for area, count in pending.items():
+        changed, files = stored.get(area, (0, 0))
+        if changed + count >= max(MARKET_RATES_REFIT_FILES, MARKET_RATES_REFIT_SHARE * files):
+            due.add(area)
+    return planned_from, last, pending, fit_areas(conn, due) if due else {}
+
+
+def store_update(conn, planned_from, seq, pending, fits, now):
+    """Write a planned update: add the changed-file counts, store the new fits and remember seq.
+
+    Skipped, returning False, when another update stored its progress since this one was planned from planned_from;
+    writing both would count the same changed files twice.
+    """
+    progress = conn.execute("SELECT seq FROM market_rates_progress WHERE id = 1").fetchone()
+    if (progress[0] if progress else None) != planned_from:
+        return False
+    conn.executemany('''
+        INSERT INTO market_rates (area, pending) VALUES (?, ?)
+        ON CONFLICT (area) DO UPDATE SET pending = pending + excluded.pending
+    ''', list(pending.items()))
+    conn.executemany('''
+        INSERT INTO market_rates (area, rates, sales, files, r2, pending, fitted_at) VALUES (?, ?, ?, ?, ?, 0, ?)
+        ON CONFLICT (area) DO UPDATE SET rates = excluded.rates, sales = excluded.sales, files = excluded.files,
+                                         r2 = excluded.r2, pending = 0, fitted_at = excluded.fitted_at
+    ''', [(area, json.dumps(result['rates']) if result['rates'] is not None else None, result['sales'], result['files'],
+           result['r2'], now) for area, result in fits.items()])
+    conn.execute("INSERT INTO market_rates_progress (id, seq) VALUES (1, ?) ON CONFLICT (id) DO UPDATE SET seq = excluded.seq", (seq,))
+    return True
+
+
+def update_market_rates(conn, full=False, write=None):
+    """Refit the areas with enough changed files (all of them if full); returns the number of areas fitted, 0 if another
+    update was stored while this one was planned.
+
+    write(fn, *args) runs the store on the writer thread inside the app (writer.get_writer().run); without it the
+    update is written in a transaction on conn.
+    """
+    planned_from, seq, pending, fits = plan_update(conn, full)
+    if write is None:
+        with db.transaction(conn):
+            stored = store_update(conn, planned_from, seq, pending, fits, time.time())
+    else:
+        stored = write(store_update, planned_from, seq, pending, fits, time.time())
+    if not stored:
+        print("Market rates were updated by another run while this one was planned; skipped it")
+        return 0
+    return len(fits)
+
+
+def update_job(key):
+    """Job handler for 'market-rates' jobs: an incremental update, written through the single-writer queue."""
+    with db.connection() as conn:
+        return f"fitted {update_market_rates(conn, write=get_writer().run)} areas"
+
+
+def rates_for_files(conn, file_numbers):
+    """{file_number: (area, rates)} for the given files whose ZIP, or else county, has fitted rates."""
+    zips = dict(conn.execute("SELECT file_number, zip FROM valuator_data WHERE file_number IN (SELECT value FROM json_each(?))",
+                             (json.dumps(list(file_numbers)),)))
+    areas = {area for zip_code in zips.values() for area in area_keys(zip_code)}
+    fitted = {area: json.loads(rates) for area, rates in conn.execute(
+        "SELECT area, rates FROM market_rates WHERE rates IS NOT NULL AND area IN (SELECT value FROM json_each(?))",
+        (json.dumps(sorted(areas)),))}
+    found = {}
+    for file_number, zip_code in zips.items():
+        area = next((area for area in area_keys(zip_code) if area in fitted), None)
+        if area is not None:
+            found[file_number] = (area, fitted[area])
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit market adjustment rates per ZIP and county from the stored sales.")
+    parser.add_argument('command', choices=['update'])
+    parser.add_argument('--full', action='store_true', help="Refit every area, not only those with enough changed files")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with db.connection() as conn:
+        create_market_rates_tables(conn)
+        fitted = update_market_rates(conn, full=args.full)
+    print(f"Fitted {fitted} areas in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
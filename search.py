@@ -0,0 +1,127 @@
+#!/home/dh_kfekwx/bin/python3
+
+import sqlite3
+
+# One search row per file (rowid = valuator_data.id). comp_addresses holds every comp address of the file
+# joined together, so a file can be found by any of its comparables as well as by its own fields.
+SUBJECT_SEARCH_COLUMNS = ['address', 'city', 'borrower_name', 'parcel_number', 'additional_comments']
+SEARCH_COLUMNS = SUBJECT_SEARCH_COLUMNS + ['comp_addresses']
+MIN_QUERY_LENGTH = 3  # Trigrams need at least three characters to match anything
+FUZZY_TRIGRAMS = 5  # Rarest query trigrams OR-ed together by the typo-tolerant fallback
+
+COMP_ADDRESSES_SQL = "(SELECT group_concat(address, ' | ') FROM comparables WHERE file_id = {file_id})"
+
+SEARCH_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_search_insert AFTER INSERT ON valuator_data BEGIN
+        INSERT INTO file_search (rowid, {', '.join(SEARCH_COLUMNS)})
+        VALUES (new.id, {', '.join(f'new.{column}' for column in SUBJECT_SEARCH_COLUMNS)}, {COMP_ADDRESSES_SQL.format(file_id='new.id')});
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_search_update AFTER UPDATE OF {', '.join(SUBJECT_SEARCH_COLUMNS)} ON valuator_data BEGIN
+        UPDATE file_search SET {', '.join(f'{column} = new.{column}' for column in SUBJECT_SEARCH_COLUMNS)} WHERE rowid = new.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS file_search_delete AFTER DELETE ON valuator_data BEGIN
+        DELETE FROM file_search WHERE rowid = old.id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_search_comp_insert AFTER INSERT ON comparables BEGIN
+        UPDATE file_search SET comp_addresses = {COMP_ADDRESSES_SQL.format(file_id='new.file_id')} WHERE rowid = new.file_id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_search_comp_update AFTER UPDATE OF address ON comparables BEGIN
+        UPDATE file_search SET comp_addresses = {COMP_ADDRESSES_SQL.format(file_id='new.file_id')} WHERE rowid = new.file_id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_search_comp_delete AFTER DELETE ON comparables BEGIN
+        UPDATE file_search SET comp_addresses = {COMP_ADDRESSES_SQL.format(file_id='old.file_id')} WHERE rowid = old.file_id;
+    END
+    ''',
+]
+
+
+def search_available(conn):
+    """Return True if the file_search index exists in this database."""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_search';").fetchone() is not None
+
+
+def create_search_index(conn):
+    """Create the FTS5 file_search table and its sync triggers, backfilling existing files on first creation.
+
+    Uses the trigram tokenizer (SQLite 3.34+) for substring and typo-tolerant matching, falling back to
+    unicode61 with prefix indexes on older builds. Returns False if this SQLite has no FTS5 at all.
+    """
+    if search_available(conn):
+        return True
+    columns = ', '.join(SEARCH_COLUMNS)
+    try:
+        conn.execute(f"CREATE VIRTUAL TABLE file_search USING fts5({columns}, tokenize = 'trigram')")
+    except sqlite3.OperationalError:
+        try:
+            conn.execute(f"CREATE VIRTUAL TABLE file_search USING fts5({columns}, prefix = '2 3 4')")
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search is unavailable in this SQLite build: {e}")
+            return False
+    # Per-term document counts, used to pick the most selective trigrams for fuzzy queries
+    conn.execute("CREATE VIRTUAL TABLE file_search_terms USING fts5vocab(file_search, 'row')")
+    for trigger in SEARCH_TRIGGERS:
+        conn.execute(trigger)
+    conn.execute(f'''
+        INSERT INTO file_search (rowid, {columns})
+        SELECT id, {', '.join(SUBJECT_SEARCH_COLUMNS)}, {COMP_ADDRESSES_SQL.format(file_id='valuator_data.id')}
+        FROM valuator_data
+    ''')
+    conn.commit()
+    return True
+
+
+def phrase(text):
+    """Quote text as a single FTS5 phrase so user input is never parsed as query syntax."""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def fuzzy_query(conn, text):
+    """OR together the rarest trigrams of text that occur in the index, or return None if none do.
+
+    A typo only breaks the few trigrams that span it; those have no documents and drop out, and the
+    remaining rare trigrams still pick out the intended file while keeping the posting lists short.
+    """
+    text = ' '.join(text.lower().split())
+    trigrams = list(dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2)))
+    counts = {}
+    for trigram in trigrams:  # One term = ? lookup each; fts5vocab scans the whole vocabulary for IN (...)
+        row = conn.execute("SELECT doc FROM file_search_terms WHERE term = ?", (trigram,)).fetchone()
+        if row:
+            counts[trigram] = row[0]
+    rarest = sorted(counts, key=counts.get)[:FUZZY_TRIGRAMS]
+    return ' OR '.join(phrase(trigram) for trigram in rarest) or None
+
+
+def search_files(conn, text, limit=10):
+    """Return up to `limit` files matching text, best first.
+
+    Substring/prefix (phrase *) matches are tried first, newest file first, which FTS5 answers without
+    scoring every hit. Only when there are none does it fall back to ranking by shared trigrams, which
+    still finds "4529 WINONA CT" for "winnona ct".
+    """
+    text = ' '.join(text.split())
+    if len(text) < MIN_QUERY_LENGTH:
+        return []
+    select = '''
+        SELECT v.file_number, v.address, v.city, v.state, v.zip, v.borrower_name, v.parcel_number
+        FROM file_search JOIN valuator_data v ON v.id = file_search.rowid
+        WHERE file_search MATCH ? ORDER BY {order} LIMIT ?
+    '''
+    columns = ['file_number', 'address', 'city', 'state', 'zip', 'borrower_name', 'parcel_number']
+    rows = conn.execute(select.format(order='file_search.rowid DESC'), (phrase(text) + ' *', limit)).fetchall()
+    if not rows:
+        fuzzy = fuzzy_query(conn, text)
+        if fuzzy:
+            rows = conn.execute(select.format(order='rank'), (fuzzy, limit)).fetchall()
+    return [dict(zip(columns, row)) for row in rows]
@@ -0,0 +1,72 @@
+#!/home/dh_kfekwx/bin/python3
+
+import os
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key: the first caller runs the lookup, later ones share its result.
+
+    Only calls that overlap in time are merged; nothing is kept once the lookup finishes (that is the caches' job).
+    Counters are per worker process.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._in_flight = {}  # key -> Future of the running lookup
+        self.calls = 0  # Lookups actually run
+        self.coalesced = 0  # Callers answered by a lookup another caller had in flight
+        self.errors = 0
+
+    def _check_fork(self):
+        # A lookup running in the parent never finishes in a forked child, so the child starts empty.
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._in_flight = {}
+            self._pid = os.getpid()
+            self.calls = self.coalesced = self.errors = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """Return fn(*args, **kwargs), or the result of the identical call already in flight for key.
+
+        If the shared call raises, every caller waiting on it gets the same exception.
+        """
+        self._check_fork()
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self._in_flight[key] = Future()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.errors += 1
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        """Lookups run, callers coalesced onto them, and the share of upstream traffic saved."""
+        requested = self.calls + self.coalesced
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'in_flight': len(self._in_flight),
+            'saved_rate': round(self.coalesced / requested, 4) if requested else None,
+        }
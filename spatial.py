@@ -0,0 +1,171 @@
+#!/home/dh_kfekwx/bin/python3
+
+import math
+import sqlite3
+
+# One R*Tree entry per located subject or comp. Comparables are WITHOUT ROWID, so entries are keyed by
+# file_id * LOCATION_SLOTS + slot, with slot 0 standing for the file's subject. Points are stored as
+# zero-size boxes; the R*Tree keeps 32-bit floats rounded outward, so it only prefilters and the exact
+# distance always comes from the REAL latitude/longitude columns.
+LOCATION_SLOTS = 256
+EARTH_RADIUS_MILES = 3958.8
+# Only REAL coordinates are indexed; a blank saved as '' is not NULL and would otherwise land at (0, 0)
+LOCATED = "typeof({row}latitude) = 'real' AND typeof({row}longitude) = 'real'"
+
+_SUBJECT_ENTRY = '''
+        INSERT OR REPLACE INTO file_locations (id, min_lat, max_lat, min_lng, max_lng)
+        SELECT new.id * {slots}, new.latitude, new.latitude, new.longitude, new.longitude
+        WHERE {located};'''.format(slots=LOCATION_SLOTS, located=LOCATED.format(row='new.'))
+_COMP_ENTRY = '''
+        INSERT OR REPLACE INTO file_locations (id, min_lat, max_lat, min_lng, max_lng)
+        SELECT new.file_id * {slots} + new.slot, new.latitude, new.latitude, new.longitude, new.longitude
+        WHERE {located} AND new.slot BETWEEN 1 AND {last_slot};'''.format(
+    slots=LOCATION_SLOTS, last_slot=LOCATION_SLOTS - 1, located=LOCATED.format(row='new.'))
+
+LOCATION_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_locations_insert AFTER INSERT ON valuator_data BEGIN{_SUBJECT_ENTRY}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_locations_update AFTER UPDATE OF latitude, longitude ON valuator_data BEGIN
+        DELETE FROM file_locations WHERE id = old.id * {LOCATION_SLOTS};{_SUBJECT_ENTRY}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_locations_delete AFTER DELETE ON valuator_data BEGIN
+        DELETE FROM file_locations WHERE id BETWEEN old.id * {LOCATION_SLOTS} AND old.id * {LOCATION_SLOTS} + {LOCATION_SLOTS - 1};
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_locations_comp_insert AFTER INSERT ON comparables BEGIN{_COMP_ENTRY}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_locations_comp_update AFTER UPDATE OF latitude, longitude ON comparables BEGIN
+        DELETE FROM file_locations WHERE id = old.file_id * {LOCATION_SLOTS} + old.slot;{_COMP_ENTRY}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS file_locations_comp_delete AFTER DELETE ON comparables BEGIN
+        DELETE FROM file_locations WHERE id = old.file_id * {LOCATION_SLOTS} + old.slot;
+    END
+    ''',
+]
+
+# Subjects and comps whose R*Tree box overlaps the search box. The R*Tree drives both halves and each
+# hit is joined back by primary key, so the cost follows the number of nearby points, not the table size.
+NEARBY_SQL = f'''
+    SELECT 'subject', v.file_number, NULL, v.address, v.city, v.state, v.zip,
+           v.subject_sale_price, v.subject_sale_date, v.latitude, v.longitude
+    FROM file_locations l JOIN valuator_data v ON v.id = l.id / {LOCATION_SLOTS}
+    WHERE :subjects AND l.max_lat >= :south AND l.min_lat <= :north AND l.max_lng >= :west AND l.min_lng <= :east
+          AND l.id % {LOCATION_SLOTS} = 0 AND (:since IS NULL OR v.subject_sale_date >= :since)
+    UNION ALL
+    SELECT 'comp', v.file_number, c.slot, c.address, c.city, c.state, c.zip,
+           c.sale_price, c.sale_date, c.latitude, c.longitude
+    FROM file_locations l
+         JOIN comparables c ON c.file_id = l.id / {LOCATION_SLOTS} AND c.slot = l.id % {LOCATION_SLOTS}
+         JOIN valuator_data v ON v.id = c.file_id
+    WHERE :comps AND l.max_lat >= :south AND l.min_lat <= :north AND l.max_lng >= :west AND l.min_lng <= :east
+          AND l.id % {LOCATION_SLOTS} != 0 AND (:since IS NULL OR c.sale_date >= :since)
+'''
+NEARBY_FIELDS = ['kind', 'file_number', 'slot', 'address', 'city', 'state', 'zip', 'sale_price', 'sale_date', 'latitude', 'longitude']
+
+
+def locations_available(conn):
+    """Return True if the file_locations index exists in this database."""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_locations';").fetchone() is not None
+
+
+def repair_location_index(conn):
+    """Replace sync triggers from before LOCATED and drop the entries they made for '' coordinates; a no-op once done."""
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'file_locations_%'").fetchall()
+    if all('typeof' in sql for _, sql in triggers if 'INSERT' in sql):
+        return
+    for name, _ in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    for trigger in LOCATION_TRIGGERS:
+        conn.execute(trigger)
+    conn.execute(f'''
+        DELETE FROM file_locations WHERE id IN
+            (SELECT id * {LOCATION_SLOTS} FROM valuator_data WHERE NOT ({LOCATED.format(row='')}))
+    ''')
+    conn.execute(f'''
+        DELETE FROM file_locations WHERE id IN
+            (SELECT file_id * {LOCATION_SLOTS} + slot FROM comparables WHERE NOT ({LOCATED.format(row='')}))
+    ''')
+    conn.commit()
+
+
+def create_location_index(conn):
+    """Create the file_locations R*Tree and its sync triggers, backfilling located subjects and comps on first creation.
+
+    Returns False if this SQLite build has no R*Tree module.
+    """
+    if locations_available(conn):
+        repair_location_index(conn)
+        return True
+    try:
+        conn.execute("CREATE VIRTUAL TABLE file_locations USING rtree(id, min_lat, max_lat, min_lng, max_lng)")
+    except sqlite3.OperationalError as e:
+        print(f"Spatial search is unavailable in this SQLite build: {e}")
+        return False
+    for trigger in LOCATION_TRIGGERS:
+        conn.execute(trigger)
+    conn.execute(f'''
+        INSERT INTO file_locations (id, min_lat, max_lat, min_lng, max_lng)
+        SELECT id * {LOCATION_SLOTS}, latitude, latitude, longitude, longitude FROM valuator_data
+        WHERE {LOCATED.format(row='')}
+    ''')
+    conn.execute(f'''
+        INSERT INTO file_locations (id, min_lat, max_lat, min_lng, max_lng)
+        SELECT file_id * {LOCATION_SLOTS} + slot, latitude, latitude, longitude, longitude FROM comparables
+        WHERE {LOCATED.format(row='')} AND slot BETWEEN 1 AND {LOCATION_SLOTS - 1}
+    ''')
+    conn.commit()
+    return True
+
+
+def haversine_miles(lat1, lng1, lat2, lng2):
+    """Great-circle distance in miles between two points given in degrees."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lng, radius_miles):
+    """Return (south, north, west, east) degrees enclosing every point within radius_miles of (lat, lng)."""
+    dlat = math.degrees(radius_miles / EARTH_RADIUS_MILES)
+    south, north = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+    if north >= 90.0 or south <= -90.0:
+        return south, north, -180.0, 180.0  # The circle covers a pole, so every longitude is in range
+    dlng = math.degrees(math.asin(min(1.0, math.sin(radius_miles / EARTH_RADIUS_MILES) / math.cos(math.radians(lat)))))
+    return south, north, lng - dlng, lng + dlng
+
+
+def nearby(conn, lat, lng, radius_miles=1.0, since=None, kinds=('subject', 'comp'), limit=100):
+    """Return up to `limit` (None for all) subjects and comps within radius_miles of (lat, lng), nearest first, with distance_miles.
+
+    since is an ISO date (YYYY-MM-DD); when given only properties sold on or after it are returned.
+    The R*Tree bounding-box query does the heavy lifting and haversine only checks the candidates.
+    """
+    south, north, west, east = bounding_box(lat, lng, radius_miles)
+    boxes = [(west, east)]
+    if west < -180.0:  # Split boxes that cross the antimeridian
+        boxes = [(-180.0, east), (west + 360.0, 180.0)]
+    elif east > 180.0:
+        boxes = [(west, 180.0), (-180.0, east - 360.0)]
+
+    results = []
+    for west, east in boxes:
+        params = {'south': south, 'north': north, 'west': west, 'east': east, 'since': since,
+                  'subjects': 'subject' in kinds, 'comps': 'comp' in kinds}
+        for row in conn.execute(NEARBY_SQL, params):
+            result = dict(zip(NEARBY_FIELDS, row))
+            distance = haversine_miles(lat, lng, result['latitude'], result['longitude'])
+            if distance <= radius_miles:
+                result['distance_miles'] = round(distance, 4)
+                results.append(result)
+    results.sort(key=lambda result: result['distance_miles'])
+    return results[:limit]
@@ -129,3 +129,114 @@ async function fetchCompData(compNumber) {
         alert('An unexpected error occurred while fetching comparable data.');
     }
 }
+
+// Fetch ATTOM details for every comp with an address in one request; the server looks them up in parallel.
+// Only empty fields are filled, so nothing the appraiser has already typed is overwritten.
+async function enrichComps() {
+    const fileNumber = document.getElementById('file_number').value;
+    const comps = [];
+    document.querySelectorAll('input[id^="comp"][id$="_address"]').forEach(input => {
+        const slot = parseInt(input.id.slice(4, -'_address'.length), 10);
+        if (!Number.isInteger(slot) || !input.value) return;
+        const value = field => document.getElementById(`comp${slot}_${field}`)?.value || '';
+        comps.push({slot, address: input.value, city: value('city'), state: value('state'), zip: value('zip')});
+    });
+    if (!fileNumber || comps.length === 0) {
+        alert('Enter at least one comparable address first.');
+        return;
+    }
+
+    const button = document.getElementById('enrich_comps_button');
+    if (button) button.disabled = true;
+    try {
+        const response = await fetch('/api/comp-data/enrich', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({file_number: fileNumber, comps}),
+        });
+        const data = await response.json();
+        if (data.error) {
+            alert(data.error);
+            return;
+        }
+
+        const missing = [];
+        for (const [slot, comp] of Object.entries(data.comps)) {
+            if (comp.status !== 'updated') {
+                missing.push(`Comparable ${slot}: ${comp.status === 'error' ? comp.error : 'no ATTOM record'}`);
+                continue;
+            }
+            for (const [field, value] of Object.entries(comp)) {
+                const input = document.getElementById(`comp${slot}_${field}`);
+                if (input && !input.value && value !== null && value !== undefined) {
+                    input.value = value;
+                }
+            }
+        }
+        if (missing.length) alert(missing.join('\n'));
+    } catch (error) {
+        console.error('Error enriching comparables:', error);
+        alert('An unexpected error occurred while fetching comparable data.');
+    } finally {
+        if (button) button.disabled = false;
+    }
+}
+
+// Poll the background ATTOM enrichment queued by Step 1 and fill in the subject fields it saved.
+// Only empty fields are filled, so nothing the appraiser has already typed is overwritten.
+async function watchEnrichment() {
+    const statusElement = document.getElementById('enrichment_status');
+    if (!statusElement || !['pending', 'running'].includes(statusElement.dataset.status)) {
+        return;
+    }
+    const fileNumber = document.getElementById('file_number').value;
+    const note = document.getElementById('enrichment_note');
+    if (note) note.hidden = false;
+
+    let delay = 1000;
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, delay));
+        delay = Math.min(delay * 2, 15000); // Back off while ATTOM retries are pending
+
+        let job;
+        try {
+            const response = await fetch(`/api/enrichment-status?file_number=${encodeURIComponent(fileNumber)}`);
+            if (!response.ok) break;
+            job = await response.json();
+        } catch (error) {
+            console.error('Error checking enrichment status:', error);
+            continue;
+        }
+        if (job.status === 'failed') {
+            console.error('ATTOM enrichment failed:', job.last_error);
+            break;
+        }
+        if (job.status !== 'done') continue;
+
+        const response = await fetch(`/api/subject-data?file_number=${encodeURIComponent(fileNumber)}`);
+        const data = await response.json();
+        const fields = {
+            county: data.county,
+            parcel_number: data.parcel_number,
+            subject_gla: data.gla,
+            subject_beds: data.beds,
+            subject_full_baths: data.full_baths,
+            subject_half_baths: data.half_baths,
+            subject_site_size: data.site_size,
+            subject_view: data.view,
+            subject_condition: data.condition,
+            subject_basement: data.basement,
+            subject_garage: data.garage,
+        };
+        for (const [field, value] of Object.entries(fields)) {
+            const input = document.getElementById(field);
+            if (input && !input.value && value !== null && value !== undefined) {
+                input.value = value;
+            }
+        }
+        break;
+    }
+    if (note) note.hidden = true;
+}
+
+document.addEventListener('DOMContentLoaded', watchEnrichment);
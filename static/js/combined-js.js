@@ -99,6 +99,9 @@ document.addEventListener("DOMContentLoaded", function () {
                     console.log(`Geocoded Lat/Lng: ${data.latitude}, ${data.longitude}`);
                 } else {
                     console.error('Geocoding failed:', data.error || 'Unknown error');
+                    // Keep no coordinates from an earlier address
+                    latField.value = '';
+                    lngField.value = '';
                 }
             })
             .catch((error) => {
@@ -6,8 +6,9 @@
  * Key Features:
  * - **Map Integration:** Uses Leaflet with OpenStreetMap to display dynamic markers 
  *   for the subject property and comparables, updating based on user input.
- * - **Address Geocoding:** Geocodes addresses via Nominatim API to place markers 
- *   on the map and handles incomplete or invalid address inputs.
+ * - **Address Geocoding:** Draws the subject and comps from the coordinates saved with
+ *   the file (rendered into #saved_markers), and geocodes only addresses edited on the
+ *   page, in one call to the server's /api/geocode-batch (cached, rate limited).
  * - **Google Maps Autocomplete:** Enhances address input fields with suggestions 
  *   and auto-fills related fields like city, state, and ZIP, while supporting manual entry.
  * - **Days on Market (DOM) Calculation:** Calculates the time a property was on 
@@ -56,6 +57,9 @@ document.addEventListener('DOMContentLoaded', function () {
                     console.log('Lat/Lng fetched for manual input:', data);
                 } else {
                     console.error('Failed to fetch coordinates:', data.error);
+                    // Keep no coordinates from an earlier address
+                    latField.value = '';
+                    lngField.value = '';
                 }
             })
             .catch(error => console.error('Error fetching Lat/Lng:', error));
@@ -105,102 +109,130 @@ document.addEventListener('DOMContentLoaded', function () {
     // Layer for markers
     var markersLayer = L.layerGroup().addTo(map);
 
-    // Function to geocode addresses and add markers
-    function geocodeAndAddMarkers() {
-        // Clear existing markers
-        markersLayer.clearLayers();
+    // One marker per label. Saved coordinates are drawn as the page loads; edited addresses are geocoded
+    // in one server call that replaces just their markers. Calls are debounced, and a newer call aborts
+    // the one in flight, so markers always match the latest addresses.
+    const MARKER_PREFIXES = [
+        { prefix: 'subject', label: 'Subject' },
+        { prefix: 'comp1', label: 'Comp 1' },
+        { prefix: 'comp2', label: 'Comp 2' },
+        { prefix: 'comp3', label: 'Comp 3' },
+    ];
+    const GEOCODE_DEBOUNCE_MS = 400;
+    let geocodeTimer = null;
+    let geocodeController = null;
+    const markers = {};  // label -> Leaflet marker
+    const editedPrefixes = new Set();  // Address fields changed since the page loaded
 
-        var addresses = [
-            {
-                label: 'Subject',
-                address: document.getElementById('subject_address').value,
-                city: document.getElementById('subject_city').value,
-                state: document.getElementById('subject_state').value,
-                zip: document.getElementById('subject_zip').value,
-            },
-            {
-                label: 'Comp 1',
-                address: document.getElementById('comp1_address').value,
-                city: document.getElementById('comp1_city').value,
-                state: document.getElementById('comp1_state').value,
-                zip: document.getElementById('comp1_zip').value,
-            },
-            {
-                label: 'Comp 2',
-                address: document.getElementById('comp2_address').value,
-                city: document.getElementById('comp2_city').value,
-                state: document.getElementById('comp2_state').value,
-                zip: document.getElementById('comp2_zip').value,
-            },
-            {
-                label: 'Comp 3',
-                address: document.getElementById('comp3_address').value,
-                city: document.getElementById('comp3_city').value,
-                state: document.getElementById('comp3_state').value,
-                zip: document.getElementById('comp3_zip').value,
-            },
-        ];
+    function setMarker(item) {
+        if (markers[item.label]) {
+            markersLayer.removeLayer(markers[item.label]);
+        }
+        const marker = markers[item.label] = L.marker([item.latitude, item.longitude]).addTo(markersLayer);
+        // Approximate markers sit on the ZIP centroid because Google could not be reached
+        marker.bindPopup(`<b>${item.label}</b><br>${item.address || ''}${item.approximate ? '<br><i>Approximate (ZIP centroid)</i>' : ''}`);
+        return marker;
+    }
 
-        addresses.forEach(function (item) {
-            // Check if address fields are not empty
-            if (item.address && item.city && item.state && item.zip) {
-                var fullAddress = `${item.address}, ${item.city}, ${item.state} ${item.zip}`;
-                geocodeAddress(fullAddress, function (latlng) {
-                    if (latlng) {
-                        var marker = L.marker(latlng).addTo(markersLayer);
-                        marker.bindPopup(`<b>${item.label}</b><br>${fullAddress}`);
-                    }
-                });
+    // Addresses to geocode: those edited on the page, plus any complete address with no saved marker
+    function collectAddresses() {
+        const addresses = [];
+        MARKER_PREFIXES.forEach(function ({ prefix, label }) {
+            if (markers[label] && !editedPrefixes.has(prefix)) {
+                return;
+            }
+            const value = field => document.getElementById(`${prefix}_${field}`)?.value.trim() || '';
+            const [address, city, state, zip] = ['address', 'city', 'state', 'zip'].map(value);
+            // Only complete addresses are geocoded
+            if (address && city && state && zip) {
+                addresses.push({ label, address: `${address}, ${city}, ${state} ${zip}` });
             } else {
-                console.warn('Incomplete address for:', item.label);
+                console.warn('Incomplete address for:', label);
             }
         });
+        return addresses;
     }
 
-    // Geocode function using Nominatim API
-    function geocodeAddress(address, callback) {
-        var url = 'https://nominatim.openstreetmap.org/search?format=json&limit=3&q=' + encodeURIComponent(address);
+    function geocodeAndAddMarkers() {
+        const addresses = collectAddresses();
+        if (addresses.length === 0) {
+            return;
+        }
+        if (geocodeController) {
+            geocodeController.abort();
+        }
+        const controller = geocodeController = new AbortController();
 
-        fetch(url)
+        fetch('/api/geocode-batch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ addresses }),
+            signal: controller.signal,
+        })
             .then((response) => response.json())
             .then((data) => {
-                if (data && data.length > 0) {
-                    var lat = data[0].lat;
-                    var lon = data[0].lon;
-                    callback([lat, lon]);
-                } else {
-                    console.error('Address not found: ' + address);
-                    callback(null);
+                if (controller !== geocodeController) {
+                    return; // Superseded by a newer call
+                }
+                if (data.error) {
+                    console.error('Error geocoding addresses:', data.error);
+                    return;
                 }
+                data.markers.forEach(function (item) {
+                    if (item.error) {
+                        console.error(`Address not found: ${item.address} (${item.error})`);
+                        if (markers[item.label]) {
+                            markersLayer.removeLayer(markers[item.label]);  // No longer this label's address
+                            delete markers[item.label];
+                        }
+                        return;
+                    }
+                    setMarker(item);
+                });
             })
             .catch((error) => {
-                console.error('Error fetching geocode data:', error);
-                callback(null);
+                if (error.name !== 'AbortError') {
+                    console.error('Error fetching geocode data:', error);
+                }
             });
     }
 
+    function scheduleGeocode() {
+        clearTimeout(geocodeTimer);
+        geocodeTimer = setTimeout(geocodeAndAddMarkers, GEOCODE_DEBOUNCE_MS);
+    }
+
     // Add event listeners to update map when addresses change
-    ['subject', 'comp1', 'comp2', 'comp3'].forEach(function (prefix) {
+    MARKER_PREFIXES.forEach(function ({ prefix }) {
         ['address', 'city', 'state', 'zip'].forEach(function (field) {
             var input = document.getElementById(prefix + '_' + field);
             if (input) {
                 input.addEventListener('change', function () {
-                    geocodeAndAddMarkers();
+                    editedPrefixes.add(prefix);
+                    scheduleGeocode();
                 });
             }
         });
     });
 
+    // Draw the saved subject and comps; a page view with saved coordinates makes no geocoding calls
+    let savedMarkers = [];
+    try {
+        savedMarkers = JSON.parse(document.getElementById('saved_markers')?.textContent || '[]');
+    } catch (error) {
+        console.error('Invalid saved marker data:', error);
+    }
+    savedMarkers.forEach(setMarker);
+
     // If valid latitude and longitude, center the map on those coordinates
     if (latitude && longitude) {
         map.setView([latitude, longitude], 14);  // Zoom in closer to the location
-        var marker = L.marker([latitude, longitude]).addTo(markersLayer);
-        marker.bindPopup(`<b>Subject Property</b><br>${latitude}, ${longitude}`).openPopup();
+        markers['Subject']?.openPopup();
     } else {
         console.error("Invalid latitude/longitude data");
     }
 
-    // Initial call to populate map if addresses are pre-filled
+    // Geocode any pre-filled address that has no saved coordinates yet
     geocodeAndAddMarkers();
 });
 
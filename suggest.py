@@ -0,0 +1,306 @@
+#!/home/dh_kfekwx/bin/python3
+
+# Comp suggestions: rank earlier sales (sold subjects and comps of other files) as comparables for a file.
+#
+# Each worker keeps every located sale in NumPy arrays sorted by latitude. A search binary-searches the latitude band,
+# filters longitude, sale date and exact distance with array operations, then scores all remaining candidates at once.
+# The index follows saves incrementally: triggers log the id of every file whose sales change in sale_changes, and each
+# search first reloads only the files logged since this worker last looked.
+
+import json
+import os
+import threading
+from datetime import date
+from functools import lru_cache
+
+import numpy as np
+
+import valuation
+from addresses import address_key
+from spatial import EARTH_RADIUS_MILES, LOCATED, LOCATION_SLOTS, bounding_box
+
+SUGGEST_RADIUS_MILES = float(os.getenv('SUGGEST_RADIUS_MILES', '1'))
+SUGGEST_MONTHS = int(os.getenv('SUGGEST_MONTHS', '12'))
+# A candidate's score is its gross adjustment as a share of its sale price (valuation.py rates), plus these costs in the
+# same units: a candidate at the edge of the radius, or sold at the start of the date window, costs as much as a 10% or
+# 5% adjustment, and each feature the subject has but the candidate lacks counts as a 2% adjustment.
+SUGGEST_DISTANCE_COST = float(os.getenv('SUGGEST_DISTANCE_COST', '0.10'))
+SUGGEST_AGE_COST = float(os.getenv('SUGGEST_AGE_COST', '0.05'))
+SUGGEST_MISSING_COST = float(os.getenv('SUGGEST_MISSING_COST', '0.02'))
+SALE_CHANGES_KEEP = int(os.getenv('SALE_CHANGES_KEEP', '100000'))  # Workers further behind than this reload everything
+COMPACT_TAIL_ROWS = 2048  # Re-sort once this many refreshed rows sit unsorted at the end of the arrays
+DAYS_PER_MONTH = 30.44
+
+SUBJECT_FEATURE_COLUMNS = ', '.join(f"subject_{name}" for name in valuation.FEATURES)
+COMP_FEATURE_COLUMNS = ', '.join(valuation.FEATURES)
+
+# Sold, dated, located subjects and comps (prices are cast, as a stray '' would compare greater than 0, and only REAL coordinates count); {subject_filter} and {comp_filter} narrow the load to changed files.
+SALES_SQL = f'''
+    SELECT v.id * {LOCATION_SLOTS}, v.file_number, 0, v.address, v.unit, v.city, v.state, v.zip,
+           CAST(v.subject_sale_price AS REAL), v.subject_sale_date, v.latitude, v.longitude, {', '.join(f"v.subject_{name}" for name in valuation.FEATURES)}
+    FROM valuator_data v
+    WHERE {LOCATED.format(row='v.')} AND CAST(v.subject_sale_price AS REAL) > 0 AND v.subject_sale_date != ''
+          {{subject_filter}}
+    UNION ALL
+    SELECT c.file_id * {LOCATION_SLOTS} + c.slot, v.file_number, c.slot, c.address, c.unit, c.city, c.state, c.zip,
+           CAST(c.sale_price AS REAL), c.sale_date, c.latitude, c.longitude, {', '.join(f"c.{name}" for name in valuation.FEATURES)}
+    FROM comparables c JOIN valuator_data v ON v.id = c.file_id
+    WHERE {LOCATED.format(row='c.')} AND CAST(c.sale_price AS REAL) > 0 AND c.sale_date != ''
+          AND c.slot BETWEEN 1 AND {LOCATION_SLOTS - 1} {{comp_filter}}
+'''
+SALE_INFO_FIELDS = ['file_number', 'slot', 'address', 'unit', 'city', 'state', 'zip', 'sale_price', 'sale_date']
+
+# Any change to a file's subject or comps that SALES_SQL reads logs the file
+SALE_CHANGE_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS sale_changes_insert AFTER INSERT ON valuator_data BEGIN
+        INSERT INTO sale_changes (file_id) VALUES (new.id);
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS sale_changes_update
+    AFTER UPDATE OF file_number, address, unit, city, state, zip, latitude, longitude, subject_sale_price, subject_sale_date,
+                    {SUBJECT_FEATURE_COLUMNS} ON valuator_data BEGIN
+        INSERT INTO sale_changes (file_id) VALUES (new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS sale_changes_delete AFTER DELETE ON valuator_data BEGIN
+        INSERT INTO sale_changes (file_id) VALUES (old.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS sale_changes_comp_insert AFTER INSERT ON comparables BEGIN
+        INSERT INTO sale_changes (file_id) VALUES (new.file_id);
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS sale_changes_comp_update
+    AFTER UPDATE OF address, unit, city, state, zip, latitude, longitude, sale_price, sale_date, {COMP_FEATURE_COLUMNS} ON comparables BEGIN
+        INSERT INTO sale_changes (file_id) VALUES (new.file_id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS sale_changes_comp_delete AFTER DELETE ON comparables BEGIN
+        INSERT INTO sale_changes (file_id) VALUES (old.file_id);
+    END
+    ''',
+]
+
+
+def create_sale_changes(conn):
+    """Create the sale_changes log and the triggers that fill it, and trim it to the last SALE_CHANGES_KEEP entries."""
+    # AUTOINCREMENT: a seq is never reused after trimming, so a worker's last seen seq stays meaningful
+    conn.execute("CREATE TABLE IF NOT EXISTS sale_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, file_id INTEGER NOT NULL)")
+    for trigger in SALE_CHANGE_TRIGGERS:
+        conn.execute(trigger)
+    conn.execute("DELETE FROM sale_changes WHERE seq <= (SELECT MAX(seq) FROM sale_changes) - ?", (SALE_CHANGES_KEEP,))
+    conn.commit()
+
+
+def change_bounds(conn):
+    """(first, last) seq in sale_changes, (0, 0) while it is empty."""
+    # Separate subqueries: SQLite answers a lone MIN or MAX from the end of the primary key, but scans for both at once
+    return conn.execute(
+        "SELECT COALESCE((SELECT MIN(seq) FROM sale_changes), 0), COALESCE((SELECT MAX(seq) FROM sale_changes), 0)").fetchone()
+
+
+def changed_files(conn, after, through):
+    """Ids of the files logged in sale_changes after seq `after`, up to and including `through`."""
+    return [row[0] for row in conn.execute("SELECT DISTINCT file_id FROM sale_changes WHERE seq > ? AND seq <= ?", (after, through))]
+
+
+@lru_cache(maxsize=8192)
+def sale_day(text):
+    """Day number (date.toordinal) of an ISO sale date, NaN if it is not one."""
+    try:
+        return float(date.fromisoformat((text or '')[:10]).toordinal())
+    except ValueError:
+        return float('nan')
+
+
+def distances_miles(lat, lng, lats, lngs):
+    """Haversine distances in miles from (lat, lng) to arrays of points, all in degrees."""
+    lat, lng, lats, lngs = np.radians(lat), np.radians(lng), np.radians(lats), np.radians(lngs)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SaleIndex:
+    """This worker's arrays of located sales, keyed like file_locations (file_id * LOCATION_SLOTS + slot).
+
+    Rows [0, sorted_count) are sorted by latitude; rows reloaded since the last compaction follow unsorted, and
+    replaced rows stay in place marked dead until the next compaction.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self.refreshes = 0
+        self._reset()
+
+    def _reset(self):
+        self.seq = None  # Last sale_changes entry applied; None until the first full load
+        self.keys = np.empty(0, dtype=np.int64)
+        self.lats, self.lngs, self.days, self.prices = (np.empty(0) for _ in range(4))
+        self.features = np.empty((0, len(valuation.FEATURES)))
+        self.alive = np.empty(0, dtype=bool)
+        self.info = []  # SALE_INFO_FIELDS tuples, row for row
+        self.sorted_count = 0
+
+    def _load(self, conn, file_ids=None):
+        """Read the sales of the given files (every file if None) as arrays, in the order of self's fields."""
+        if file_ids is None:
+            sql, params = SALES_SQL.format(subject_filter='', comp_filter=''), ()
+        else:
+            sql = SALES_SQL.format(subject_filter="AND v.id IN (SELECT value FROM json_each(:ids))",
+                                   comp_filter="AND c.file_id IN (SELECT value FROM json_each(:ids))")
+            params = {'ids': json.dumps(file_ids)}
+        rows = conn.execute(sql, params).fetchall()
+        return (
+            np.array([row[0] for row in rows], dtype=np.int64),
+            np.array([row[10] for row in rows], dtype=float).reshape(-1),
+            np.array([row[11] for row in rows], dtype=float).reshape(-1),
+            np.array([sale_day(row[9]) for row in rows], dtype=float).reshape(-1),
+            np.array([row[8] for row in rows], dtype=float).reshape(-1),
+            valuation.feature_matrix(rows, offset=12),
+            [(row[1], row[2], *row[3:10]) for row in rows],
+        )
+
+    def _append(self, keys, lats, lngs, days, prices, features, info):
+        self.keys = np.concatenate([self.keys, keys])
+        self.lats = np.concatenate([self.lats, lats])
+        self.lngs = np.concatenate([self.lngs, lngs])
+        self.days = np.concatenate([self.days, days])
+        self.prices = np.concatenate([self.prices, prices])
+        self.features = np.concatenate([self.features, features])
+        self.alive = np.concatenate([self.alive, np.ones(len(keys), dtype=bool)])
+        self.info.extend(info)
+
+    def _compact(self):
+        """Drop dead rows and sort everything by latitude again."""
+        order = np.flatnonzero(self.alive)
+        order = order[np.argsort(self.lats[order], kind='stable')]
+        self.keys, self.lats, self.lngs = self.keys[order], self.lats[order], self.lngs[order]
+        self.days, self.prices, self.features = self.days[order], self.prices[order], self.features[order]
+        self.alive = np.ones(len(order), dtype=bool)
+        self.info = [self.info[i] for i in order.tolist()]
+        self.sorted_count = len(order)
+
+    def refresh(self, conn):
+        """Bring the arrays up to date with sale_changes: reload changed files, or everything on first use."""
+        first, last = change_bounds(conn)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()  # Forked: rebuild in this process rather than share arrays with the parent
+                self._pid = os.getpid()
+            if self.seq == last:
+                return
+            if self.seq is None or self.seq < first - 1:  # First use, or the log was trimmed past this worker
+                self._reset()
+                self._append(*self._load(conn))
+                self._compact()
+            else:
+                file_ids = changed_files(conn, self.seq, last)
+                self.alive &= ~np.isin(self.keys // LOCATION_SLOTS, file_ids)
+                self._append(*self._load(conn, file_ids))
+                dead = len(self.alive) - int(self.alive.sum())
+                if len(self.keys) - self.sorted_count > COMPACT_TAIL_ROWS or dead > len(self.keys) // 4:
+                    self._compact()
+            self.seq = last
+            self.refreshes += 1
+
+    def candidates(self, lat, lng, radius_miles, first_day, last_day):
+        """Sales between the two day numbers within radius_miles of (lat, lng), as a dict of arrays plus 'info' and 'distances'.
+
+        The arrays are copies, so a refresh in another thread cannot shift them.
+        """
+        south, north, west, east = bounding_box(lat, lng, radius_miles)
+        with self._lock:
+            sorted_lats = self.lats[:self.sorted_count]
+            rows = np.concatenate([
+                np.arange(np.searchsorted(sorted_lats, south, 'left'), np.searchsorted(sorted_lats, north, 'right')),
+                np.arange(self.sorted_count, len(self.keys)),
+            ])
+            lats, lngs, days = self.lats[rows], self.lngs[rows], self.days[rows]
+            # Longitudes are compared modulo 360, so boxes crossing the antimeridian need no splitting
+            keep = (self.alive[rows] & (lats >= south) & (lats <= north) & ((lngs - west) % 360.0 <= east - west)
+                    & (days >= first_day) & (days <= last_day))
+            rows = rows[keep]
+            distances = distances_miles(lat, lng, self.lats[rows], self.lngs[rows])
+            rows, distances = rows[distances <= radius_miles], distances[distances <= radius_miles]
+            return {
+                'keys': self.keys[rows], 'lats': self.lats[rows], 'lngs': self.lngs[rows], 'days': self.days[rows],
+                'prices': self.prices[rows], 'features': self.features[rows], 'distances': distances,
+                'info': [self.info[i] for i in rows.tolist()],
+            }
+
+    def stats(self):
+        return {'sales': int(self.alive.sum()), 'rows': len(self.keys), 'unsorted': len(self.keys) - self.sorted_count,
+                'seq': self.seq, 'refreshes': self.refreshes}
+
+
+sale_index = SaleIndex()
+
+# Coordinates other than REAL (older rows stored '') come back as NULL
+SUBJECT_SQL = f'''
+    SELECT id, CASE WHEN {LOCATED.format(row='')} THEN latitude END, CASE WHEN {LOCATED.format(row='')} THEN longitude END,
+           address, unit, zip, {SUBJECT_FEATURE_COLUMNS}
+    FROM valuator_data WHERE file_number = ?
+'''
+
+
+def score(subject, features, prices, distances, ages, radius_miles, window_days, rates=None):
+    """Score candidates against the subject's features (lower is more similar); see the SUGGEST_* costs above."""
+    lines = np.abs(subject[None, :] - features) * valuation.rate_vector(rates)
+    gross_pct = np.nan_to_num(lines).sum(axis=1) / prices
+    missing = (np.isnan(features) & ~np.isnan(subject)[None, :]).sum(axis=1)
+    return (gross_pct + SUGGEST_DISTANCE_COST * distances / radius_miles + SUGGEST_AGE_COST * ages / window_days
+            + SUGGEST_MISSING_COST * missing), gross_pct
+
+
+def suggest_comps(conn, file_number, k=6, radius_miles=SUGGEST_RADIUS_MILES, months=SUGGEST_MONTHS, rates=None, as_of=None):
+    """The k best earlier sales to use as comps for a file, best first; None if the file is missing or has no usable coordinates.
+
+    Candidates are sales within radius_miles of the subject, sold in the `months` before as_of (a date, default today),
+    from other files. A property sold once but used on several files is suggested once, and sales of the subject
+    property itself are left out. rates override valuation.DEFAULT_RATES for the adjustment part of the score.
+    """
+    subject = conn.execute(SUBJECT_SQL, (file_number,)).fetchone()
+    if subject is None or subject[1] is None or subject[2] is None:
+        return None
+    file_id, lat, lng, address, unit, zip_code = subject[:6]
+    subject_features = valuation.feature_matrix([subject], offset=6)[0]
+
+    sale_index.refresh(conn)
+    last_day = (as_of or date.today()).toordinal()
+    window_days = months * DAYS_PER_MONTH
+    found = sale_index.candidates(lat, lng, radius_miles, last_day - window_days, last_day)
+    others = found['keys'] // LOCATION_SLOTS != file_id
+    scores, gross_pct = score(subject_features, found['features'], found['prices'], found['distances'],
+                              last_day - found['days'], radius_miles, window_days, rates)
+    scores[~others] = np.inf
+
+    # Rank a few more than k, since repeats of the same sale are dropped on the way
+    count = int(others.sum())
+    wanted = min(count, 4 * k)
+    best = np.argpartition(scores, wanted)[:wanted] if wanted < len(scores) else np.arange(len(scores))
+    best = best[np.argsort(scores[best], kind='stable')][:wanted]
+    seen = {address_key(address, unit, zip_code)} - {None}
+    suggestions = []
+    for i in best.tolist():
+        info = dict(zip(SALE_INFO_FIELDS, found['info'][i]))
+        sale = (address_key(info['address'], info['unit'], info['zip']) or info['address'], info['sale_date'])
+        if sale[0] in seen or sale in seen:
+            continue
+        seen.add(sale)
+        suggestions.append({
+            'kind': 'subject' if info['slot'] == 0 else 'comp', **info,
+            'latitude': float(found['lats'][i]), 'longitude': float(found['lngs'][i]),
+            'distance_miles': round(float(found['distances'][i]), 4),
+            'gross_adjustment_pct': round(float(gross_pct[i]), 4),
+            'score': round(float(scores[i]), 4),
+        })
+        if len(suggestions) == k:
+            break
+    return suggestions
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def valuator(tmp_path_factory):
+    """The app module, on fresh databases in a temporary directory (valuator.db and users.db are opened relative to it)."""
+    os.chdir(tmp_path_factory.mktemp('data'))
+    import app
+    with app.app.app_context():
+        app.init_db()
+        app.init_users_db()
+    return app
+
+
+@pytest.fixture
+def client(valuator):
+    """A test client with a logged-in session."""
+    client = valuator.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    return client
+
+
+@pytest.fixture(scope='session')
+def add_file(valuator):
+    """Insert a file with the given valuator_data columns and comps ({slot: {column: value}}); returns its id."""
+    from writer import get_writer
+
+    def add(file_number, comps=None, **columns):
+        columns = {'file_number': file_number, **columns}
+
+        def insert(conn):
+            file_id = conn.execute(f"INSERT INTO valuator_data ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                                   tuple(columns.values())).lastrowid
+            for slot, comp in (comps or {}).items():
+                conn.execute(f"INSERT INTO comparables (file_id, slot, {', '.join(comp)}) VALUES (?, ?, {', '.join('?' * len(comp))})",
+                             (file_id, slot, *comp.values()))
+            return file_id
+        return get_writer().run(insert)
+    return add
@@ -0,0 +1,13 @@
+import pytest
+
+from db import connection
+
+
+@pytest.mark.parametrize('slot', [-3, 0, 256, 1000])
+def test_out_of_range_slot_is_rejected(client, add_file, slot):
+    file_id = add_file(f"T-ENRICH-{slot}", address='40 Pine St', zip='80212')
+
+    response = client.post('/api/comp-data/enrich', json={'file_number': f"T-ENRICH-{slot}", 'comps': [{'slot': slot, 'address': '42 Pine St'}]})
+    assert response.status_code == 400
+    with connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM comparables WHERE file_id = ?", (file_id,)).fetchone()[0] == 0
@@ -0,0 +1,34 @@
+from db import connection
+
+
+def test_save_keeps_fields_the_form_does_not_post(client, add_file):
+    file_id = add_file('T-STEP2-1', address='10 Main St', city='Denver', state='CO', zip='80212',
+                       subject_sale_price=500000.0, subject_sale_date='2026-01-05', subject_cdom=12,
+                       subject_original_list_price=510000.0, subject_original_list_date='2025-12-01',
+                       comps={1: {'address': '12 Main St', 'sale_price': 480000.0, 'year_built': 1990}})
+
+    response = client.post('/form-step2/T-STEP2-1', data={
+        'subject_address': '10 Main St', 'subject_city': 'Denver', 'subject_state': 'CO', 'subject_zip': '80212',
+        'subject_gla': '1800', 'comp1_address': '12 Main St', 'comp1_sale_price': '485000', 'comp1_gla': '1700',
+    })
+    assert response.status_code == 302
+
+    with connection() as conn:
+        subject = conn.execute('''
+            SELECT subject_sale_price, subject_sale_date, subject_cdom, subject_original_list_price, subject_original_list_date, subject_gla
+            FROM valuator_data WHERE id = ?
+        ''', (file_id,)).fetchone()
+        comp = conn.execute("SELECT sale_price, year_built, gla FROM comparables WHERE file_id = ? AND slot = 1", (file_id,)).fetchone()
+    assert tuple(subject) == (500000.0, '2026-01-05', 12, 510000.0, '2025-12-01', 1800.0)
+    assert tuple(comp) == (485000.0, 1990, 1700.0)
+
+
+def test_replaced_comp_does_not_inherit_the_old_comps_fields(client, add_file):
+    file_id = add_file('T-STEP2-2', address='20 Main St', zip='80212', comps={1: {'address': '22 Main St', 'year_built': 1990}})
+
+    client.post('/form-step2/T-STEP2-2', data={'subject_address': '20 Main St', 'comp1_address': '', 'comp1_sale_price': ''})
+    client.post('/form-step2/T-STEP2-2', data={'subject_address': '20 Main St', 'comp2_address': '30 Oak St'})
+
+    with connection() as conn:
+        comps = conn.execute("SELECT slot, address, year_built FROM comparables WHERE file_id = ?", (file_id,)).fetchall()
+    assert [tuple(comp) for comp in comps] == [(2, '30 Oak St', None)]
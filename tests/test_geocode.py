@@ -0,0 +1,32 @@
+import pytest
+import requests
+
+import geocode
+from geocode import GeocodeError
+
+
+def failing(error):
+    def request_geocode(address):
+        raise error
+    return request_geocode
+
+
+@pytest.mark.parametrize('error', [GeocodeError('OVER_QUERY_LIMIT'), requests.ConnectionError('unreachable')])
+def test_transient_failure_falls_back_to_the_zip_centroid(valuator, monkeypatch, error):
+    monkeypatch.setattr(geocode, 'request_geocode', failing(error))
+    location = geocode.geocode(f"1 Transient St {type(error).__name__}, Denver, CO 80212")
+    assert location['approximate'] is True
+
+
+@pytest.mark.parametrize('status', ['REQUEST_DENIED', 'INVALID_REQUEST'])
+def test_request_errors_are_raised(valuator, monkeypatch, status):
+    monkeypatch.setattr(geocode, 'request_geocode', failing(GeocodeError(status)))
+    with pytest.raises(GeocodeError):
+        geocode.geocode(f"1 Denied St {status}, Denver, CO 80212")
+
+
+def test_step1_lookup_never_returns_a_centroid(client, monkeypatch):
+    monkeypatch.setattr(geocode, 'request_geocode', failing(GeocodeError('OVER_QUERY_LIMIT')))
+    response = client.post('/get-lat-lng', json={'address': '1 Step One St, Denver, CO 80212'})
+    assert response.status_code == 500
+    assert response.get_json() == {'error': 'OVER_QUERY_LIMIT'}
@@ -0,0 +1,40 @@
+import json
+import sqlite3
+
+import import_data
+
+
+def run(tmp_path, lines, fmt='jsonl'):
+    path = tmp_path / f"input.{fmt}"
+    path.write_text('\n'.join(lines) + '\n')
+    db_name = str(tmp_path / 'import.db')
+    import_data.run_import(str(path), fmt, db_name, batch_size=2, update=False)
+    conn = sqlite3.connect(db_name)
+    files = dict(conn.execute("SELECT file_number, subject_gla FROM valuator_data"))
+    comps = conn.execute("SELECT slot FROM comparables").fetchall()
+    conn.close()
+    return files, comps
+
+
+def test_bad_jsonl_lines_are_rejected_one_at_a_time(tmp_path, capsys):
+    files, comps = run(tmp_path, [
+        json.dumps({'file_number': 'I-1', 'subject_gla': 1500}),
+        '[1, 2]',
+        '{"file_number": "I-2", ',
+        json.dumps({'file_number': 'I-3', 'subject_beds': 'inf'}),
+        '{"file_number": "I-4", "comparables": [{"slot": 1e999, "address": "1 Elm St"}]}',
+        json.dumps({'file_number': 'I-5', 'comparables': [{'slot': 2, 'address': '5 Elm St'}]}),
+    ])
+    assert files == {'I-1': 1500.0, 'I-5': None}
+    assert comps == [(2,)]
+    errors = capsys.readouterr()
+    assert 'line 2 is not a JSON object' in errors.err
+    assert 'line 3 is not valid JSON' in errors.err
+    assert "Imported 2 files and 1 comparables from 6 records" in errors.out
+    assert '4 rejected' in errors.out
+
+
+def test_non_finite_number_in_csv_is_rejected(tmp_path, capsys):
+    files, _ = run(tmp_path, ['file_number,subject_gla,subject_beds', 'C-1,1500,3', 'C-2,1600,inf', 'C-3,nan,2'], fmt='csv')
+    assert files == {'C-1': 1500.0}
+    assert '2 rejected' in capsys.readouterr().out
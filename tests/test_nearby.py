@@ -0,0 +1,33 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def near(add_file):
+    add_file('T-NEAR-OLD', latitude=-33.86, longitude=151.2, subject_sale_price=400000.0, subject_sale_date='2001-01-01')
+    add_file('T-NEAR-NEW', latitude=-33.861, longitude=151.201, subject_sale_price=400000.0, subject_sale_date='2099-01-01')
+    return {'lat': -33.86, 'lng': 151.2, 'kind': 'subject'}
+
+
+def found(response):
+    return sorted(result['file_number'] for result in response.get_json()['results'])
+
+
+def test_months_keeps_recent_sales_only(client, near):
+    response = client.get('/api/nearby', query_string={**near, 'months': 2})
+    assert response.status_code == 200
+    assert found(response) == ['T-NEAR-NEW']
+
+
+@pytest.mark.parametrize('months', [0, -2, 100000])
+def test_months_out_of_range_is_rejected(client, near, months):
+    assert client.get('/api/nearby', query_string={**near, 'months': months}).status_code == 400
+
+
+@pytest.mark.parametrize('limit', [0, -1])
+def test_limit_below_one_is_rejected(client, near, limit):
+    assert client.get('/api/nearby', query_string={**near, 'limit': limit}).status_code == 400
+
+
+def test_limit_caps_the_results(client, near):
+    assert found(client.get('/api/nearby', query_string={**near, 'limit': 1})) == ['T-NEAR-OLD']
+    assert found(client.get('/api/nearby', query_string={**near, 'limit': 10000})) == ['T-NEAR-NEW', 'T-NEAR-OLD']
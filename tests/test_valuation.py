@@ -0,0 +1,17 @@
+import json
+
+
+def reject_constant(name):
+    raise AssertionError(f"response carries {name}, which is not valid JSON")
+
+
+def test_file_without_sold_comps_values_to_valid_json(client, add_file):
+    add_file('T-VALUE-1', zip='80212', subject_gla=1800.0,
+             comps={1: {'address': '1 Elm St', 'gla': 1700.0}, 2: {'address': '2 Elm St', 'gla': 1900.0, 'sale_price': 0}})
+
+    response = client.post('/api/valuation', json={'file_number': 'T-VALUE-1'})
+    assert response.status_code == 200
+    valuation = json.loads(response.get_data(as_text=True), parse_constant=reject_constant)['valuations']['T-VALUE-1']
+    assert valuation['indicated_value'] is None
+    assert [comp['weight'] for comp in valuation['comps']] == [0.0, 0.0]
+    assert all(comp['adjusted_price'] is None for comp in valuation['comps'])
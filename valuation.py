@@ -0,0 +1,264 @@
+#!/home/dh_kfekwx/bin/python3
+
+# Sales comparison approach: adjust each comp's sale price for its differences from the subject and reconcile the
+# adjusted prices into an indicated value. Files are valued in batches as NumPy arrays shaped
+# (files, comps, features), so one vectorized pass covers thousands of files.
+#
+# Adjustment rates are dollars per unit of difference (per sq ft, per bedroom, per condition step, ...). Defaults come
+# from the environment, can be replaced per file by market-derived rates (market_rates.py), and any of them can be
+# overridden per request.
+
+import json
+import os
+import re
+from functools import lru_cache
+
+import numpy as np
+
+# Comp column (the subject's is subject_<name>) -> default $ per unit the subject has more of than the comp.
+DEFAULT_RATES = {
+    'gla': float(os.getenv('ADJUST_GLA_PER_SQFT', '50')),  # Gross living area, per sq ft
+    'beds': float(os.getenv('ADJUST_PER_BED', '5000')),
+    'full_baths': float(os.getenv('ADJUST_PER_FULL_BATH', '10000')),
+    'half_baths': float(os.getenv('ADJUST_PER_HALF_BATH', '5000')),
+    'year_built': float(os.getenv('ADJUST_PER_YEAR_BUILT', '1000')),  # Per year newer, i.e. per year of age
+    'site_size': float(os.getenv('ADJUST_SITE_PER_SQFT', '2')),
+    'garage': float(os.getenv('ADJUST_PER_GARAGE_STALL', '7500')),
+    'condition': float(os.getenv('ADJUST_PER_CONDITION_STEP', '15000')),  # Per UAD step, C1 best to C6 worst
+    'view': float(os.getenv('ADJUST_PER_VIEW_STEP', '10000')),
+}
+FEATURES = list(DEFAULT_RATES)
+
+# Lender guidelines: comps adjusted by more than this share of their sale price are flagged
+NET_ADJUSTMENT_LIMIT = float(os.getenv('NET_ADJUSTMENT_LIMIT', '0.15'))
+GROSS_ADJUSTMENT_LIMIT = float(os.getenv('GROSS_ADJUSTMENT_LIMIT', '0.25'))
+# Comps are weighted by 1 / (gross adjustment % + floor): the least adjusted comps count most, without an
+# unadjusted comp taking all the weight.
+WEIGHT_FLOOR = float(os.getenv('VALUATION_WEIGHT_FLOOR', '0.05'))
+
+SQFT_PER_ACRE = 43560
+SITE_ACRES_BELOW = 100  # Step 2 turns site sizes of an acre or more into acres, so small values are acres
+
+# ATTOM's condition words on the UAD scale
+CONDITION_WORDS = {'EXCELLENT': 2, 'GOOD': 3, 'AVERAGE': 4, 'FAIR': 5, 'POOR': 6}
+# Step 2 view choices; UAD view strings ("N;Res;") are rated by their first letter instead
+VIEW_RATINGS = {'NONE': 0, 'PARK': 1, 'CITY': 1, 'GOLF': 1, 'MOUNTAIN': 2, 'WATER': 2}
+UAD_VIEW_RATINGS = {'A': -1, 'N': 0, 'B': 1}  # Adverse, neutral, beneficial
+
+
+@lru_cache(maxsize=1024)
+def condition_rating(text):
+    """Higher is better: C1 -> 6 ... C6 -> 1; ATTOM's words map onto the same scale. NaN if unknown."""
+    text = (text or '').strip().upper()
+    match = re.match(r'C([1-6])\b', text)
+    step = int(match.group(1)) if match else CONDITION_WORDS.get(text)
+    return 7.0 - step if step else float('nan')
+
+
+@lru_cache(maxsize=1024)
+def view_rating(text):
+    """0 for no particular view, higher for better views, -1 for an adverse UAD view; NaN if unknown."""
+    text = (text or '').strip().upper()
+    if len(text) > 1 and text[1] == ';':
+        rating = UAD_VIEW_RATINGS.get(text[0])
+    else:
+        rating = VIEW_RATINGS.get(text)
+    return float('nan') if rating is None else float(rating)
+
+
+@lru_cache(maxsize=1024)
+def garage_stalls(text):
+    """Number of stalls in "2 Car Attached" / "1 car"; 0 for "None"; NaN if unknown."""
+    text = (text or '').strip().upper()
+    match = re.match(r'(\d+)\s*-?\s*CAR', text)
+    if match:
+        return float(match.group(1))
+    return 0.0 if text in ('NONE', '0') else float('nan')
+
+
+def _number(value):
+    try:
+        return float(value) if value not in (None, '') else float('nan')
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def _numbers(values):
+    """Column of stored numbers as a float array, NaN where missing."""
+    try:
+        return np.array(values, dtype=float)  # None becomes NaN
+    except (TypeError, ValueError):
+        return np.array([_number(value) for value in values], dtype=float)  # Stray text, e.g. '' from an old form save
+
+
+# How each feature's stored value becomes a number: text ratings go through the cached parsers above
+_TEXT_FEATURES = {'garage': garage_stalls, 'condition': condition_rating, 'view': view_rating}
+
+
+def feature_matrix(rows, offset=0):
+    """Features of many properties as an (N, K) float array; each row holds the FEATURES values from index offset on."""
+    columns = list(zip(*rows))[offset:offset + len(FEATURES)] if rows else [()] * len(FEATURES)
+    matrix = np.empty((len(rows), len(FEATURES)))
+    for k, (name, values) in enumerate(zip(FEATURES, columns)):
+        parse = _TEXT_FEATURES.get(name)
+        matrix[:, k] = np.fromiter(map(parse, values), float, len(values)) if parse else _numbers(values)
+    site = matrix[:, FEATURES.index('site_size')]
+    site[site < SITE_ACRES_BELOW] *= SQFT_PER_ACRE
+    return matrix
+
+
+def rate_vector(rates=None):
+    """DEFAULT_RATES with overrides applied, as an array in FEATURES order; ValueError for unknown or non-numeric rates."""
+    merged = dict(DEFAULT_RATES)
+    for name, value in (rates or {}).items():
+        if name not in merged:
+            raise ValueError(f"Unknown adjustment {name!r}; expected one of {', '.join(FEATURES)}")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"Adjustment {name!r} must be a number")
+        merged[name] = float(value)
+    return np.array([merged[name] for name in FEATURES])
+
+
+def rate_matrix(file_numbers, rates=None, base_rates=None):
+    """(F, K) rates for the files: DEFAULT_RATES, replaced per file by base_rates ({file_number: {name: rate}}, e.g.
+    market rates), then by the rates overrides for every file."""
+    overrides = rate_vector(rates)
+    matrix = np.tile(rate_vector(), (len(file_numbers), 1))
+    if base_rates:
+        for f, file_number in enumerate(file_numbers):
+            for name, value in base_rates.get(file_number, {}).items():
+                matrix[f, FEATURES.index(name)] = value
+    columns = [FEATURES.index(name) for name in rates or {}]
+    matrix[:, columns] = overrides[columns]
+    return matrix
+
+
+class CompGrid:
+    """Subjects and their comps as arrays: subjects (F, K), comps (F, M, K), prices and slots (F, M).
+
+    Files with fewer than M comps are padded with NaN prices and slot 0.
+    """
+
+    __slots__ = ('file_numbers', 'subjects', 'comps', 'prices', 'slots')
+
+    def __init__(self, subject_rows, comp_rows):
+        """subject_rows: (file_number, *FEATURES values) tuples; comp_rows: (file_number, slot, sale_price, *FEATURES values), any order."""
+        self.file_numbers = [row[0] for row in subject_rows]
+        index = {file_number: i for i, file_number in enumerate(self.file_numbers)}
+        self.subjects = feature_matrix(subject_rows, offset=1)
+
+        comp_rows = [row for row in comp_rows if row[0] in index]
+        counts = [0] * len(self.file_numbers)
+        rows, positions = [], []
+        for row in comp_rows:
+            i = index[row[0]]
+            rows.append(i)
+            positions.append(counts[i])
+            counts[i] += 1
+
+        shape = (len(self.file_numbers), max(counts, default=0))
+        self.comps = np.full(shape + (len(FEATURES),), np.nan)
+        self.prices = np.full(shape, np.nan)
+        self.slots = np.zeros(shape, dtype=np.int64)
+        if comp_rows:
+            self.comps[rows, positions] = feature_matrix(comp_rows, offset=3)
+            self.prices[rows, positions] = _numbers([row[2] for row in comp_rows])
+            self.slots[rows, positions] = [row[1] for row in comp_rows]
+
+
+def adjust(grid, rates=None, base_rates=None):
+    """Apply the adjustments to every comp in the grid at once; returns a dict of arrays.
+
+    Rates are as rate_matrix(). A feature missing on the subject or the comp is not adjusted. Comps without a
+    positive sale price get NaN results and no weight; a file with no such comps gets a NaN indicated value.
+    """
+    rates = rate_matrix(grid.file_numbers, rates, base_rates)
+    lines = np.nan_to_num((grid.subjects[:, None, :] - grid.comps) * rates[:, None, :])  # (F, M, K) dollar adjustments
+    net = lines.sum(axis=2)
+    gross = np.abs(lines).sum(axis=2)
+
+    sold = np.isfinite(grid.prices) & (grid.prices > 0)
+    prices = np.where(sold, grid.prices, np.nan)
+    adjusted = prices + net
+    net_pct = net / prices
+    gross_pct = gross / prices
+
+    weights = np.where(sold, 1.0 / (np.nan_to_num(gross_pct) + WEIGHT_FLOOR), 0.0)
+    totals = weights.sum(axis=1, keepdims=True)
+    # A file without sold comps has nothing to weigh: its weights stay 0 (0/0 would be NaN, which JSON cannot carry)
+    weights = np.divide(weights, totals, out=np.zeros_like(weights), where=totals > 0)
+    indicated = np.where(totals[:, 0] > 0, (weights * np.nan_to_num(adjusted)).sum(axis=1), np.nan)
+    return {
+        'lines': lines, 'net': net, 'gross': gross, 'net_pct': net_pct, 'gross_pct': gross_pct, 'adjusted': adjusted,
+        'weights': weights, 'indicated': indicated, 'sold': sold, 'rates': rates,
+        'exceeds_guidelines': sold & ((np.abs(net_pct) > NET_ADJUSTMENT_LIMIT) | (gross_pct > GROSS_ADJUSTMENT_LIMIT)),
+    }
+
+
+SUBJECT_SELECT = f"""
+    SELECT file_number, {', '.join(f"subject_{name}" for name in FEATURES)}, id
+    FROM valuator_data WHERE file_number IN (SELECT value FROM json_each(?))
+"""
+COMP_SELECT = f"""
+    SELECT file_id, slot, sale_price, {', '.join(FEATURES)}
+    FROM comparables WHERE file_id IN (SELECT value FROM json_each(?)) ORDER BY file_id, slot
+"""
+
+
+def load_grid(conn, file_numbers):
+    """Read the subjects and comps of the given files (two indexed queries) into a CompGrid; unknown files are left out."""
+    subjects = conn.execute(SUBJECT_SELECT, (json.dumps(list(file_numbers)),)).fetchall()
+    file_by_id = {row[-1]: row[0] for row in subjects}
+    comps = conn.execute(COMP_SELECT, (json.dumps(list(file_by_id)),)).fetchall()
+    return CompGrid(subjects, [(file_by_id[row[0]], *row[1:]) for row in comps])
+
+
+def _nulls(array, decimals):
+    """Rounded nested lists with NaN as None, for JSON."""
+    rounded = np.round(array, decimals).astype(object)
+    rounded[np.isnan(array)] = None
+    return rounded.tolist()
+
+
+def results(grid, adjusted):
+    """JSON-ready valuation for each file in the grid: {file_number: {...}}."""
+    # Round and convert whole arrays once; element-by-element conversion would cost more than the valuation
+    lines = np.round(adjusted['lines'], 2).tolist()
+    net, gross = np.round(adjusted['net'], 2).tolist(), np.round(adjusted['gross'], 2).tolist()
+    prices, adjusted_prices = _nulls(grid.prices, 2), _nulls(adjusted['adjusted'], 2)
+    net_pct, gross_pct = _nulls(adjusted['net_pct'], 4), _nulls(adjusted['gross_pct'], 4)
+    weights, flags, slots = np.round(adjusted['weights'], 4).tolist(), adjusted['exceeds_guidelines'].tolist(), grid.slots.tolist()
+    indicated, rates = _nulls(adjusted['indicated'], 2), adjusted['rates'].tolist()
+
+    valuations = {}
+    for f, file_number in enumerate(grid.file_numbers):
+        comps = []
+        for m, slot in enumerate(slots[f]):
+            if not slot:
+                continue  # Padding
+            comps.append({
+                'slot': slot,
+                'sale_price': prices[f][m],
+                'adjustments': dict(zip(FEATURES, lines[f][m])),
+                'net_adjustment': net[f][m],
+                'gross_adjustment': gross[f][m],
+                'net_pct': net_pct[f][m],
+                'gross_pct': gross_pct[f][m],
+                'adjusted_price': adjusted_prices[f][m],
+                'weight': weights[f][m],
+                'exceeds_guidelines': flags[f][m],
+            })
+        sold = [comp['adjusted_price'] for comp in comps if comp['adjusted_price'] is not None]
+        valuations[file_number] = {
+            'indicated_value': indicated[f],
+            'adjusted_range': [min(sold), max(sold)] if sold else None,
+            'rates': dict(zip(FEATURES, rates[f])),
+            'comps': comps,
+        }
+    return valuations
+
+
+def value_files(conn, file_numbers, rates=None, base_rates=None):
+    """Value the given files from their saved subjects and comps; returns {file_number: valuation} for the files found."""
+    grid = load_grid(conn, file_numbers)
+    return results(grid, adjust(grid, rates, base_rates))
@@ -0,0 +1,122 @@
+#!/home/dh_kfekwx/bin/python3
+
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+import db
+
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '64'))
+# Commits from the writer thread are fsynced (FULL) by default: a caller's future only resolves once its write
+# is on disk, and group commit spreads that fsync over every write in the batch.
+WRITE_SYNCHRONOUS = os.getenv('WRITE_SYNCHRONOUS', 'FULL')
+
+
+class WriteQueue:
+    """One writer thread per database that group-commits write intents submitted by request handlers.
+
+    An intent is a callable taking the writer's connection. Intents that arrive while a batch is being
+    committed are drained into the next one, run inside a single BEGIN IMMEDIATE transaction, and each
+    gets its own SAVEPOINT so a failing intent is rolled back without touching the rest of its batch.
+    Futures resolve only after COMMIT, so a returned result always means the write is durable.
+    """
+
+    def __init__(self, db_name, batch_size=WRITE_BATCH_SIZE):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.batches = 0
+        self.intents = 0
+        self._intents = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        # Threads do not survive a fork, so each worker process starts its own writer on first use.
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._intents = queue.Queue()
+                if self._pid != os.getpid() or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name=f"writer-{self.db_name}", daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def submit(self, fn, *args):
+        """Queue fn(conn, *args) for the writer thread; returns a Future with its result once committed."""
+        self._ensure_thread()
+        future = Future()
+        self._intents.put((fn, args, future))
+        return future
+
+    def run(self, fn, *args):
+        """Submit fn(conn, *args) and wait for its committed result, re-raising anything it raised."""
+        return self.submit(fn, *args).result()
+
+    def execute(self, sql, params=()):
+        """Run a single statement through the queue and wait for it to commit; returns the row count."""
+        return self.run(lambda conn: conn.execute(sql, params).rowcount)
+
+    def _run(self):
+        intents = self._intents
+        try:
+            conn = db.open_connection(self.db_name)
+            conn.execute(f"PRAGMA synchronous = {WRITE_SYNCHRONOUS};")
+        except Exception as e:
+            # Fail whatever is waiting; the next submit() starts a fresh writer thread.
+            print(f"Error opening writer connection to {self.db_name}: {e}")
+            while not intents.empty():
+                intents.get_nowait()[2].set_exception(e)
+            return
+        while True:
+            batch = [intents.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(intents.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(conn, [item for item in batch if item[2].set_running_or_notify_cancel()])
+
+    def _commit(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            for fn, args, future in batch:
+                conn.execute("SAVEPOINT intent;")
+                try:
+                    results.append((future, fn(conn, *args), None))
+                    conn.execute("RELEASE intent;")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO intent;")
+                    conn.execute("RELEASE intent;")
+                    results.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            # BEGIN or COMMIT itself failed (e.g. the lock was never granted): nothing in the batch was written.
+            if conn.in_transaction:
+                conn.rollback()
+            print(f"Error committing write batch of {len(batch)}: {e}")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.intents += len(batch)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(db_name=db.VALUATOR_DB):
+    """Return the write queue for db_name, creating it on first use."""
+    writer = _writers.get(db_name)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.setdefault(db_name, WriteQueue(db_name))
+    return writer